@@ -1,24 +1,49 @@
-from flask import Flask, render_template, send_from_directory, request, redirect, url_for, flash, jsonify
+import argparse
+from flask import Flask, Response, g, render_template, send_file, request, redirect, url_for, flash, jsonify
 import database
+import dedupe
+import embeddings
+import jobs
+import logging
 import os
 import json
-from PIL import Image
 import threading
+import time
 import llm_processor
-import scanner
+import metrics
+import scan_jobs
+import thumbnails
+import watcher
 
 from datetime import datetime
 
 app = Flask(__name__)
 app.secret_key = 'supersecretkey' # Needed for flash messaging
 
-# Global status object for scanning
-scan_status = {
-    'is_scanning': False,
-    'progress': 0,
-    'total': 0,
-    'message': 'Idle'
-}
+# Runs scans one at a time; scan_status is the thread-safe status of the current or last scan
+scan_manager = scan_jobs.ScanJobManager()
+scan_status = scan_manager.status
+
+logger = logging.getLogger(__name__)
+
+REQUEST_SECONDS = metrics.Histogram('photomanager_http_request_seconds', 'Time to handle HTTP requests, by route.',
+                                    ['route', 'method', 'status'])
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    # Streaming responses (SSE) are timed until their headers are sent
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, route=route, method=request.method, status=response.status_code)
+    return response
+
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    # Hand the request thread's connection back to the pool for the next request.
+    database.release_db_connection()
 
 # Custom Jinja2 filter for parsing date strings
 def strptime_filter(date_string, format):
@@ -41,19 +66,91 @@ app.jinja_env.filters['month_name'] = month_name_filter
 
 CONFIG_FILE = 'config.json'
 IMAGE_DIRS = []
+# Metadata extraction processes used by scans; None means one per CPU.
+SCAN_WORKERS = None
+# LLM tagging concurrency and images per model request.
+TAGGER_WORKERS = llm_processor.WORKERS
+TAGGER_BATCH_SIZE = llm_processor.BATCH_SIZE
+# Filesystem watcher mode: None (disabled), 'auto', 'inotify' or 'poll'.
+WATCH_MODE = None
+# Minutes between the polling watcher's stat sweeps for files edited in place; None disables them.
+POLL_SWEEP_MINUTES = None
+library_watcher = None
+# Thumbnail store: 'directory' or 'pack', and its disk budget in megabytes.
+THUMBNAIL_STORE = thumbnails.STORE_KIND
+THUMBNAIL_BUDGET_MB = thumbnails.BUDGET_BYTES // (1024 * 1024)
+# Longest edge and format ('jpeg' or 'webp') of the previews shown by the viewer.
+PREVIEW_SIZE = thumbnails.PREVIEW_SIZE
+PREVIEW_FORMAT = thumbnails.PREVIEW_FORMAT.lower()
+# Whether the tagger stores embeddings for semantic search (requires NumPy).
+SEMANTIC_SEARCH = False
+# Whether scans, thumbnail warming, tagging and the watcher run as queued jobs
+# in worker processes (worker.py) instead of threads of the web server.
+JOB_QUEUE = False
 
 def load_config():
-    global IMAGE_DIRS
+    global IMAGE_DIRS, SCAN_WORKERS, WATCH_MODE, POLL_SWEEP_MINUTES, TAGGER_WORKERS, TAGGER_BATCH_SIZE, THUMBNAIL_STORE, THUMBNAIL_BUDGET_MB
+    global PREVIEW_SIZE, PREVIEW_FORMAT, SEMANTIC_SEARCH, JOB_QUEUE, scan_manager, scan_status
     if os.path.exists(CONFIG_FILE):
         with open(CONFIG_FILE, 'r') as f:
             config_data = json.load(f)
             IMAGE_DIRS = config_data.get('image_dirs', [])
+            SCAN_WORKERS = config_data.get('scan_workers')
+            WATCH_MODE = config_data.get('watch')
+            POLL_SWEEP_MINUTES = config_data.get('poll_sweep_minutes', POLL_SWEEP_MINUTES)
+            TAGGER_WORKERS = config_data.get('tagger_workers', TAGGER_WORKERS)
+            TAGGER_BATCH_SIZE = config_data.get('tagger_batch_size', TAGGER_BATCH_SIZE)
+            THUMBNAIL_STORE = config_data.get('thumbnail_store', THUMBNAIL_STORE)
+            THUMBNAIL_BUDGET_MB = config_data.get('thumbnail_budget_mb', THUMBNAIL_BUDGET_MB)
+            PREVIEW_SIZE = config_data.get('preview_size', PREVIEW_SIZE)
+            PREVIEW_FORMAT = config_data.get('preview_format', PREVIEW_FORMAT)
+            SEMANTIC_SEARCH = config_data.get('semantic_search', SEMANTIC_SEARCH)
+            JOB_QUEUE = config_data.get('job_queue', JOB_QUEUE)
+            if config_data.get('database'):
+                database.configure(config_data['database'])
+        thumbnails.configure(THUMBNAIL_STORE, budget_bytes=THUMBNAIL_BUDGET_MB * 1024 * 1024,
+                             preview_size=PREVIEW_SIZE, preview_format=PREVIEW_FORMAT, warm_via_queue=JOB_QUEUE)
+        if JOB_QUEUE:
+            scan_manager = jobs.QueuedScanManager()
+            scan_status = scan_manager.status
+        # Kept next to the database, as its rows refer to image ids
+        embeddings.configure(SEMANTIC_SEARCH, path=os.path.splitext(database.DB_PATH)[0] + '_embeddings')
         return True
     return False
 
 def save_config():
     with open(CONFIG_FILE, 'w') as f:
-        json.dump({'image_dirs': IMAGE_DIRS}, f, indent=4)
+        json.dump({'image_dirs': IMAGE_DIRS, 'scan_workers': SCAN_WORKERS, 'watch': WATCH_MODE,
+                   'poll_sweep_minutes': POLL_SWEEP_MINUTES, 'database': database.DB_PATH,
+                   'tagger_workers': TAGGER_WORKERS, 'tagger_batch_size': TAGGER_BATCH_SIZE,
+                   'thumbnail_store': THUMBNAIL_STORE, 'thumbnail_budget_mb': THUMBNAIL_BUDGET_MB,
+                   'preview_size': PREVIEW_SIZE, 'preview_format': PREVIEW_FORMAT, 'semantic_search': SEMANTIC_SEARCH,
+                   'job_queue': JOB_QUEUE}, f, indent=4)
+
+def start_scan():
+    """
+    Starts a scan of all configured directories in the background. Returns
+    False if a scan is already running, in which case one more scan follows it.
+    """
+    return scan_manager.request_scan(IMAGE_DIRS, SCAN_WORKERS)
+
+def poll_sweep_interval():
+    """Returns the configured sweep interval of the polling watcher in seconds, or None."""
+    return POLL_SWEEP_MINUTES * 60 if POLL_SWEEP_MINUTES else None
+
+def restart_watcher():
+    """(Re)starts the filesystem watcher for the configured directories, if enabled."""
+    global library_watcher
+    if JOB_QUEUE:
+        # The watcher runs in the worker that handles watch jobs
+        jobs.request_watch(IMAGE_DIRS, WATCH_MODE, SCAN_WORKERS or 1, sweep_interval=poll_sweep_interval())
+        return
+    if library_watcher:
+        library_watcher.stop()
+        library_watcher = None
+    if WATCH_MODE and IMAGE_DIRS:
+        library_watcher = watcher.start_watcher(IMAGE_DIRS, mode=WATCH_MODE, workers=SCAN_WORKERS or 1,
+                                                sweep_interval=poll_sweep_interval())
 
 @app.route('/setup', methods=['GET', 'POST'])
 def setup():
@@ -65,40 +162,114 @@ def setup():
             save_config()
             flash('Configuration saved! Starting initial scan in the background...', 'success')
 
-            scan_thread = threading.Thread(target=scanner.scan_directories, args=(IMAGE_DIRS, scan_status), daemon=True)
-            scan_thread.start()
+            start_scan()
+            restart_watcher()
 
             return redirect(url_for('settings'))
         else:
             flash('The provided path is not a valid directory.', 'danger')
     return render_template('setup.html')
 
+def gallery_image(record):
+    """Converts an image row to the dict used by the gallery template and API."""
+    image_dict = dict(record)
+    image_dict['month_name'] = month_name_filter(image_dict.get('month'))
+    return image_dict
+
+def encode_cursor(record):
+    """Encodes the keyset position after an image as an opaque cursor string."""
+    return f"{record['date_taken']}~{record['id']}"
+
+def decode_cursor(cursor):
+    """Returns the (date_taken, id) position of a cursor, or None if it is missing or invalid."""
+    try:
+        date_taken, image_id = cursor.rsplit('~', 1)
+        return date_taken, int(image_id)
+    except (AttributeError, ValueError):
+        return None
+
+def image_version(record):
+    """
+    Returns the version tag of an image's file (its thumbnail fingerprint
+    key). It changes whenever the file does, so URLs carrying it can be
+    cached forever.
+    """
+    image = dict(record)
+    return thumbnails.key_for_fingerprint(image['filepath'], (image.get('mtime_ns'), image.get('filesize'), image.get('inode')),
+                                          image.get('content_hash'))
+
+def thumbnail_url(record, size=None):
+    """Returns the versioned (and so immutable) thumbnail URL of an image row."""
+    return url_for('thumbnail', image_id=record['id'], v=image_version(record), size=size)
+
+app.jinja_env.globals['thumbnail_url'] = thumbnail_url
+
+def next_page_cursor(records, limit):
+    """Returns the cursor for the page after records, or None on the last page."""
+    if len(records) < limit:
+        return None
+    return encode_cursor(records[-1])
+
 @app.route('/')
 def index():
     if not IMAGE_DIRS:
         return redirect(url_for('setup'))
 
     available_years = database.get_available_years()
-    selected_year = request.args.get('year', None)
+    selected_year = request.args.get('year', '')
 
-    if not selected_year and available_years:
-        selected_year = available_years[0]
+    # The newest year unless a (numeric) year was chosen
+    if not selected_year.isdigit():
+        selected_year = available_years[0] if available_years else None
 
     selected_month = request.args.get('month', type=int)
 
     images = []
+    year_month_counts = month_counts = {}
+    next_cursor = None
     if selected_year:
-        image_records = database.get_images_by_year_and_month(selected_year, selected_month)
-        for record in image_records:
-            image_dict = dict(record)
-            date_str = image_dict['date_taken'].split('.')[0]
-            dt_object = datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%S')
-            image_dict['month_name'] = dt_object.strftime('%B')
-            images.append(image_dict)
-
-    return render_template('index.html', images=images, available_years=available_years, selected_year=selected_year, selected_month=selected_month)
-
-THUMBNAIL_DIR = 'static/thumbnails'
+        # From the timeline summary: one row per month, not per image
+        year_month_counts = month_counts = database.get_month_counts(selected_year)
+        if selected_month:
+            month_counts = {month: count for month, count in month_counts.items() if month == selected_month}
+        # Only the first page is rendered; the rest is loaded by static/gallery.js
+        image_records = database.get_images_page(selected_year, selected_month)
+        images = [gallery_image(record) for record in image_records]
+        next_cursor = next_page_cursor(image_records, database.GALLERY_PAGE_SIZE)
+
+    return render_template('index.html', images=images, available_years=available_years, selected_year=selected_year,
+                           selected_month=selected_month, month_counts=month_counts, year_month_counts=year_month_counts,
+                           total_images=sum(month_counts.values()), next_cursor=next_cursor)
+
+@app.route('/api/timeline')
+def timeline_api():
+    """Returns every month with images, newest first, with its count and cover thumbnail."""
+    months = [{'year': row['year'], 'month': row['month'], 'month_name': month_name_filter(row['month']), 'count': row['count'],
+               'cover_image_id': row['id'], 'cover_thumbnail_url': thumbnail_url(row)}
+              for row in database.get_timeline()]
+    return jsonify({'months': months})
+
+# Upper bound for the limit parameter of /api/images.
+MAX_PAGE_SIZE = 1000
+
+@app.route('/api/images')
+def images_api():
+    """Returns one keyset-paginated page of a year or month as JSON."""
+    year = request.args.get('year', '')
+    if not year.isdigit():
+        return jsonify({'error': 'A numeric year is required'}), 400
+    month = request.args.get('month', type=int)
+    limit = min(max(request.args.get('limit', database.GALLERY_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    after = decode_cursor(request.args.get('cursor'))
+
+    image_records = database.get_images_page(year, month, after, limit)
+    images = []
+    for record in image_records:
+        image_dict = gallery_image(record)
+        image_dict['thumbnail_url'] = thumbnail_url(record)
+        image_dict['thumbnail_url_2x'] = thumbnail_url(record, 400)
+        images.append(image_dict)
+    return jsonify({'images': images, 'next_cursor': next_page_cursor(image_records, limit)})
 
 @app.route('/settings', methods=['GET', 'POST'])
 def settings():
@@ -112,21 +283,24 @@ def settings():
                 save_config()
                 flash(f"Added directory: {directory}. Scanning all directories for new files.", 'success')
                 # Always scan all directories to prevent deleting data from other folders
-                scan_thread = threading.Thread(target=scanner.scan_directories, args=(IMAGE_DIRS, scan_status), daemon=True)
-                scan_thread.start()
+                start_scan()
+                restart_watcher()
 
         elif action == 'remove_folder':
             folder_path = request.form.get('folder_path')
             if folder_path in IMAGE_DIRS:
                 IMAGE_DIRS.remove(folder_path)
                 save_config()
+                restart_watcher()
                 database.remove_images_by_path(folder_path)
+                threading.Thread(target=thumbnails.collect_garbage, daemon=True).start()
                 flash(f"Removed directory and its images: {folder_path}", 'success')
 
         elif action == 'rescan':
-            flash("Started full library rescan in the background.", 'info')
-            scan_thread = threading.Thread(target=scanner.scan_directories, args=(IMAGE_DIRS, scan_status), daemon=True)
-            scan_thread.start()
+            if start_scan():
+                flash("Started full library rescan in the background.", 'info')
+            else:
+                flash("A scan is already running; the library will be rescanned again when it finishes.", 'info')
 
         return redirect(url_for('settings'))
 
@@ -134,16 +308,69 @@ def settings():
 
 @app.route('/api/scan-status')
 def get_scan_status():
-    return jsonify(scan_status)
+    status = scan_status.snapshot()
+    status['recent_scans'] = list(scan_manager.history)
+    return jsonify(status)
+
+@app.route('/api/jobs')
+def get_jobs():
+    """Returns the number of queued, running, done and failed jobs of each kind."""
+    counts = {}
+    for (kind, status), count in jobs.queue_counts().items():
+        counts.setdefault(kind, {})[status] = count
+    return jsonify(counts)
+
+# Minimum seconds between two scan status events, and between keep-alive comments.
+STATUS_STREAM_INTERVAL = 0.5
+STATUS_STREAM_KEEPALIVE = 15
+
+@app.route('/api/scan-status/stream')
+def scan_status_stream():
+    """Pushes the scan status as Server-Sent Events whenever it changes, at most every STATUS_STREAM_INTERVAL."""
+    def events():
+        version = None
+        while True:
+            if scan_status.wait_for_change(version, STATUS_STREAM_KEEPALIVE) == version:
+                yield ": keep-alive\n\n"
+                continue
+            status = scan_status.snapshot()
+            version = status['version']
+            yield f"data: {json.dumps(status)}\n\n"
+            # Throttled, since a scan changes the status once per file
+            time.sleep(STATUS_STREAM_INTERVAL)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Exposes request, query, scan, thumbnail and tagging metrics in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/search')
 def search():
     search_query = request.args.get('query')
+    # 'tags' matches the query against tags; 'semantic' ranks by embedding similarity
+    mode = request.args.get('mode', 'tags')
     images = None
     if search_query:
-        images = database.search_images_by_tag(search_query)
+        if mode == 'semantic' and embeddings.ENABLED:
+            matches = embeddings.search(search_query)
+            # Embeddings of removed images are skipped here
+            images = database.get_images_by_ids([image_id for image_id, _ in matches])
+        else:
+            images = database.search_images_by_tag(search_query)
 
-    return render_template('search.html', images=images)
+    return render_template('search.html', images=images, mode=mode, semantic_search=embeddings.ENABLED)
+
+def viewer_image(record):
+    """Converts an image row to the dict the full-screen viewer uses."""
+    image_data = dict(record)
+    version = image_version(record)
+    image_data['thumbnail_url'] = thumbnail_url(record)
+    image_data['preview_url'] = url_for('preview_image', image_id=record['id'], v=version)
+    image_data['full_image_url'] = url_for('full_image', image_id=record['id'], v=version)
+    return image_data
 
 @app.route('/api/image/<int:image_id>')
 def image_api(image_id):
@@ -151,65 +378,237 @@ def image_api(image_id):
     if not image_record:
         return jsonify({'error': 'Image not found'}), 404
 
-    image_data = dict(image_record)
-
-    context_ids_str = request.args.get('context', '')
-    if context_ids_str:
-        context_ids = [int(id) for id in context_ids_str.split(',')]
-        if image_id in context_ids:
-            current_index = context_ids.index(image_id)
-            prev_id = context_ids[current_index - 1] if current_index > 0 else None
-            next_id = context_ids[current_index + 1] if current_index < len(context_ids) - 1 else None
-            image_data['prev_id'] = prev_id
-            image_data['next_id'] = next_id
+    # Neighbours come from the window API (or the viewer's own list of ids)
+    return jsonify(viewer_image(image_record))
+
+# Default and maximum number of images on each side returned by the viewer window API.
+VIEWER_RADIUS = 10
+MAX_VIEWER_RADIUS = 100
+
+@app.route('/api/image/<int:image_id>/window')
+def image_window_api(image_id):
+    """
+    Returns an image and its neighbours in gallery order (optionally within a
+    year or month), each with prev_id/next_id, so the viewer can navigate and
+    prefetch without a request per image.
+    """
+    radius = min(max(request.args.get('radius', VIEWER_RADIUS, type=int), 0), MAX_VIEWER_RADIUS)
+    year = request.args.get('year', '')
+    month = request.args.get('month', type=int)
+    # One extra row on each side gives the edge images their prev/next ids
+    records = database.get_timeline_window(image_id, radius + 1, year if year.isdigit() else None, month)
+    if not records:
+        return jsonify({'error': 'Image not found'}), 404
 
-    image_data['full_image_url'] = url_for('full_image', image_id=image_id)
-    return jsonify(image_data)
+    images = []
+    for index, record in enumerate(records):
+        image_data = viewer_image(record)
+        image_data['prev_id'] = records[index - 1]['id'] if index > 0 else None
+        image_data['next_id'] = records[index + 1]['id'] if index < len(records) - 1 else None
+        images.append(image_data)
+    position = next(index for index, record in enumerate(records) if record['id'] == image_id)
+    return jsonify({'images': images[max(position - radius, 0):position + radius + 1]})
+
+@app.route('/api/images/batch')
+def images_batch_api():
+    """Returns viewer metadata for a comma-separated list of ids (at most MAX_PAGE_SIZE), in that order."""
+    try:
+        image_ids = [int(image_id) for image_id in request.args.get('ids', '').split(',') if image_id]
+    except ValueError:
+        return jsonify({'error': 'ids must be a comma-separated list of integers'}), 400
+    records = database.get_images_by_ids(image_ids[:MAX_PAGE_SIZE])
+    return jsonify({'images': [viewer_image(record) for record in records]})
+
+def parse_bbox(value):
+    """Parses a 'west,south,east,north' bounding box in degrees. Returns (south, west, north, east), or None if invalid."""
+    try:
+        west, south, east, north = (float(part) for part in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        return None
+    return south, west, north, east
+
+@app.route('/api/images/bbox')
+def images_in_bbox_api():
+    """
+    Returns the newest images taken inside bbox=west,south,east,north (a box
+    with west > east crosses the antimeridian), optionally only from one
+    camera model and/or lens.
+    """
+    bbox = parse_bbox(request.args.get('bbox'))
+    if bbox is None:
+        return jsonify({'error': 'bbox must be west,south,east,north in degrees'}), 400
+    limit = min(max(request.args.get('limit', database.GALLERY_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    records = database.get_images_in_bbox(*bbox, camera_model=request.args.get('camera'), lens_model=request.args.get('lens'),
+                                          limit=limit)
+    return jsonify({'images': [viewer_image(record) for record in records]})
+
+@app.route('/api/images/camera')
+def images_by_camera_api():
+    """Returns the newest images from a camera model and/or lens."""
+    camera_model, lens_model = request.args.get('camera'), request.args.get('lens')
+    if not camera_model and not lens_model:
+        return jsonify({'error': 'camera or lens is required'}), 400
+    limit = min(max(request.args.get('limit', database.GALLERY_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    records = database.get_images_by_camera(camera_model, lens_model, limit)
+    return jsonify({'images': [viewer_image(record) for record in records]})
+
+@app.route('/api/cameras')
+def cameras_api():
+    """Returns the camera models and lenses in the library with their image counts."""
+    cameras, lenses = database.get_camera_counts()
+    return jsonify({'cameras': [{'camera_model': model, 'count': count} for model, count in cameras],
+                    'lenses': [{'lens_model': model, 'count': count} for model, count in lenses]})
+
+# Largest Hamming distance accepted by the duplicate APIs; beyond it unrelated images match.
+MAX_DUPLICATE_DISTANCE = 16
+
+@app.route('/api/duplicates')
+def duplicates_api():
+    """
+    Returns groups of exact duplicates (same content hash), or with near=1
+    groups of visually similar images within `distance` bits of each other.
+    """
+    if request.args.get('near') == '1':
+        distance = min(max(request.args.get('distance', dedupe.NEAR_DUPLICATE_DISTANCE, type=int), 0), MAX_DUPLICATE_DISTANCE)
+        id_groups = dedupe.find_near_duplicates(distance)
+        records = {record['id']: record for record in database.get_images_by_ids([i for group in id_groups for i in group])}
+        groups = [[records[image_id] for image_id in group if image_id in records] for group in id_groups]
+    else:
+        groups = database.get_exact_duplicate_groups()
+    return jsonify({'groups': [[viewer_image(record) for record in group] for group in groups]})
+
+@app.route('/api/image/<int:image_id>/similar')
+def similar_images_api(image_id):
+    """Returns the images within `distance` bits of an image's perceptual hash, closest first."""
+    distance = min(max(request.args.get('distance', dedupe.NEAR_DUPLICATE_DISTANCE, type=int), 0), MAX_DUPLICATE_DISTANCE)
+    matches = dedupe.find_similar(image_id, distance)
+    records = {record['id']: record for record in database.get_images_by_ids([match_id for _, match_id in matches])}
+    images = []
+    for match_distance, match_id in matches:
+        if match_id in records:
+            image_data = viewer_image(records[match_id])
+            image_data['distance'] = match_distance
+            images.append(image_data)
+    return jsonify({'images': images})
+
+# Cache-Control for URLs that carry an image version: their content never changes.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def holds_version(etag):
+    """
+    True if the browser's conditional request shows it already has `etag`.
+    Only used for versioned URLs, where any cached copy is the current one,
+    so an If-Modified-Since is as good as a matching If-None-Match.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    return request.if_modified_since is not None
+
+def not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+def cache_for_version(response, requested_version, current_version):
+    """Marks a response immutable if it was requested by its current version, else makes the browser revalidate."""
+    if requested_version == current_version:
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/thumbnail/<int:image_id>')
 def thumbnail(image_id):
+    size = thumbnails.normalize_size(request.args.get('size', thumbnails.DEFAULT_SIZE, type=int))
+    version = request.args.get('v')
+    # Revalidating a versioned URL needs neither the database nor the store
+    if version and holds_version(f"{version}-{size}"):
+        return not_modified(f"{version}-{size}")
+
     image_record = database.get_image_by_id(image_id)
     if not image_record:
         return "Image not found", 404
 
-    thumbnail_path = os.path.join(THUMBNAIL_DIR, f"{image_id}.jpg")
+    current_version = image_version(image_record)
+    last_modified = image_record['mtime_ns'] / 1e9 if image_record['mtime_ns'] else None
+    response = send_file(thumbnails.get_thumbnail(image_record, size), mimetype='image/jpeg', conditional=True,
+                         etag=f"{current_version}-{size}", last_modified=last_modified)
+    return cache_for_version(response, version, current_version)
 
-    if not os.path.exists(thumbnail_path):
-        os.makedirs(THUMBNAIL_DIR, exist_ok=True)
-        try:
-            with Image.open(image_record['filepath']) as img:
-                img.thumbnail((200, 200))
-                img.convert('RGB').save(thumbnail_path, 'JPEG')
-        except FileNotFoundError:
-            img = Image.new('RGB', (200, 200), color = 'gray')
-            img.save(thumbnail_path, 'JPEG')
+@app.route('/image/preview/<int:image_id>')
+def preview_image(image_id):
+    """Serves a screen-sized rendition of an image for the viewer; /image/full serves the original."""
+    version = request.args.get('v')
+    if version and holds_version(f"{version}-preview"):
+        return not_modified(f"{version}-preview")
+
+    image_record = database.get_image_by_id(image_id)
+    if not image_record:
+        return "Image not found", 404
 
-    return send_from_directory(THUMBNAIL_DIR, f"{image_id}.jpg")
+    preview = thumbnails.get_preview(image_record)
+    if preview is None:
+        return "Image not found", 404
+    current_version = image_version(image_record)
+    response = send_file(preview, mimetype=thumbnails.MIMETYPES[thumbnails.PREVIEW_FORMAT], conditional=True,
+                         etag=f"{current_version}-preview")
+    return cache_for_version(response, version, current_version)
 
 @app.route('/image/full/<int:image_id>')
 def full_image(image_id):
+    version = request.args.get('v')
+    if version and holds_version(version):
+        return not_modified(version)
+
     image_record = database.get_image_by_id(image_id)
     if not image_record:
         return "Image not found", 404
 
-    directory, filename = os.path.split(image_record['filepath'])
-    return send_from_directory(directory, filename)
+    current_version = image_version(image_record)
+    try:
+        # conditional also answers Range requests, so large originals can be resumed and streamed
+        response = send_file(image_record['filepath'], conditional=True, etag=current_version)
+    except FileNotFoundError:
+        return "Image not found", 404
+    return cache_for_version(response, version, current_version)
 
 def initial_setup():
     # Clean up old config file if it exists
     if os.path.exists('config.txt'):
         os.remove('config.txt')
 
+    config_loaded = load_config()
     database.create_table()
-    if load_config():
-        print(f"Loaded image directories: {IMAGE_DIRS}")
+    if config_loaded:
+        logger.info("Loaded image directories: %s", IMAGE_DIRS)
     else:
-        print("No config file found. Please set up via the web interface.")
+        logger.info("No config file found. Please set up via the web interface.")
+
+def start_background_work():
+    """
+    Starts the tagger and the watcher in this process, for the single-process
+    development server. With the job queue they are left to worker.py.
+    """
+    if JOB_QUEUE:
+        return
+    llm_thread = threading.Thread(target=llm_processor.start_llm_processing_loop, args=(TAGGER_WORKERS, TAGGER_BATCH_SIZE), daemon=True)
+    llm_thread.start()
+    restart_watcher()
 
-if __name__ == '__main__':
-    initial_setup()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the photo manager with the Flask development server.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=5000, help='port to listen on (default: %(default)s)')
+    parser.add_argument('--debug', action='store_true', help='enable the Flask debugger')
+    args = parser.parse_args(argv)
 
-    llm_thread = threading.Thread(target=llm_processor.start_llm_processing_loop, daemon=True)
-    llm_thread.start()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    initial_setup()
+    start_background_work()
+    app.run(host=args.host, port=args.port, debug=args.debug, use_reloader=False)
 
-    app.run(debug=True, use_reloader=False)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Standalone benchmark runner. Builds synthetic libraries and databases in a
+temporary directory, times scanning, browsing queries, search, thumbnail
+rendering and the gallery page, and writes the results as JSON.
+
+    python -m benchmarks.run --sizes 10000 100000 --output results.json
+    python -m benchmarks.run --compare baseline.json --output results.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import database
+import embeddings
+import scanner
+import thumbnails
+from benchmarks import synthetic
+
+# Slowdown relative to a baseline, as a ratio of medians, reported as a regression.
+REGRESSION_THRESHOLD = 1.2
+
+
+def measure(func, repeat):
+    """Calls func `repeat` times and returns timing statistics in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        'runs': repeat,
+        'min': timings[0],
+        'median': statistics.median(timings),
+        'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'mean': statistics.fmean(timings),
+    }
+
+def timed_once(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+def bench_scan(workdir, image_count, workers):
+    """Full scan of a fresh library, then incremental rescans with nothing and with 1% changed."""
+    library = os.path.join(workdir, 'library')
+    paths = synthetic.generate_library(library, image_count)
+    database.configure(os.path.join(workdir, 'scan.db'))
+
+    results = {}
+    seconds, _ = timed_once(lambda: scanner.scan_directories([library], workers=workers))
+    results['scan_full'] = {'seconds': seconds, 'images': image_count, 'images_per_sec': image_count / seconds}
+
+    seconds, _ = timed_once(lambda: scanner.scan_directories([library], workers=workers))
+    results['scan_incremental_unchanged'] = {'seconds': seconds, 'images': image_count, 'images_per_sec': image_count / seconds}
+
+    changed = paths[::100]
+    for path in changed:
+        os.utime(path, ns=(time.time_ns(), time.time_ns()))
+    seconds, _ = timed_once(lambda: scanner.scan_directories([library], workers=workers))
+    results['scan_incremental_1pct_changed'] = {'seconds': seconds, 'images': image_count, 'changed': len(changed)}
+    return results
+
+def bench_queries(workdir, rows, repeat):
+    """Browsing and search queries against a database of `rows` synthetic images."""
+    database.configure(os.path.join(workdir, f'queries_{rows}.db'))
+    seconds, _ = timed_once(lambda: synthetic.populate_database(rows))
+    year = str(synthetic.LAST_YEAR - 1)
+
+    results = {'populate': {'seconds': seconds}}
+    results['get_available_years'] = measure(database.get_available_years, repeat)
+    results['get_timeline'] = measure(database.get_timeline, repeat)
+    results['get_month_counts'] = measure(lambda: database.get_month_counts(year), repeat)
+    results['get_images_by_year_and_month_month'] = measure(lambda: database.get_images_by_year_and_month(year, 6), repeat)
+    results['get_images_by_year_and_month_year'] = measure(lambda: database.get_images_by_year_and_month(year), repeat)
+    results['get_images_page_first'] = measure(lambda: database.get_images_page(year), repeat)
+    # The cursor of the last full page of the year
+    year_images = database.get_images_by_year_and_month(year)
+    if year_images:
+        anchor = year_images[max(len(year_images) - database.GALLERY_PAGE_SIZE - 1, 0)]
+        results['get_images_page_deep'] = measure(
+            lambda: database.get_images_page(year, after=(anchor['date_taken'], anchor['id'])), repeat)
+    results['search_single_tag'] = measure(lambda: database.search_images_by_tag('cat'), repeat)
+    results['search_rare_tag'] = measure(lambda: database.search_images_by_tag('flower'), repeat)
+    results['search_and'] = measure(lambda: database.search_images_by_tag('cat dog'), repeat)
+    results['search_or'] = measure(lambda: database.search_images_by_tag('beach OR snow'), repeat)
+    results['search_prefix'] = measure(lambda: database.search_images_by_tag('b*'), repeat)
+    # A 0.2 degree box around one city, matching about 0.2% of the rows
+    lat, lon = synthetic.PLACES[0]
+    results['get_images_in_bbox'] = measure(lambda: database.get_images_in_bbox(lat - 0.1, lon - 0.1, lat + 0.1, lon + 0.1), repeat)
+    results['get_images_by_camera'] = measure(lambda: database.get_images_by_camera(synthetic.CAMERA_MODELS[0]), repeat)
+    results['get_camera_counts'] = measure(database.get_camera_counts, repeat)
+    results['index_page'] = bench_index_page(year, repeat)
+    return results
+
+def bench_index_page(year, repeat):
+    """Renders the gallery page for a year through the Flask test client."""
+    import app as main_app
+    main_app.IMAGE_DIRS = ['/synthetic']
+    main_app.app.config['TESTING'] = True
+    with main_app.app.test_client() as client:
+        def render():
+            response = client.get(f'/?year={year}')
+            assert response.status_code == 200
+        return measure(render, repeat)
+
+def bench_thumbnails(workdir, count, size):
+    """Renders every thumbnail size for `count` camera-sized JPEGs, serially."""
+    paths = synthetic.generate_library(os.path.join(workdir, 'thumbnail_sources'), count, size=size)
+    thumbnails.configure('directory', root=os.path.join(workdir, 'thumbnails'))
+    results = {}
+    seconds, _ = timed_once(lambda: [thumbnails.render_thumbnails(path, f"bench{i:06d}") for i, path in enumerate(paths)])
+    results['render_thumbnails'] = {'seconds': seconds, 'images': count, 'ms_per_image': seconds * 1000 / count,
+                                    'source_size': list(size)}
+    seconds, _ = timed_once(lambda: [thumbnails.render_thumbnails(path, f"bench{i:06d}", (thumbnails.PREVIEW_SIZE,))
+                                     for i, path in enumerate(paths)])
+    results['render_preview'] = {'seconds': seconds, 'images': count, 'ms_per_image': seconds * 1000 / count}
+    return results
+
+def bench_semantic(workdir, count, repeat, dim=128, clusters=1000, seed=0):
+    """Exhaustive and IVF searches over `count` clustered random embeddings, with the IVF recall of the top 10."""
+    if not embeddings.available():
+        return {}
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim), dtype=np.float32)
+    store = embeddings.EmbeddingStore(os.path.join(workdir, f'embeddings_{count}'), dim, 'bench')
+    for start in range(0, count, 100000):
+        size = min(100000, count - start)
+        vectors = centres[rng.integers(clusters, size=size)] + 0.5 * rng.standard_normal((size, dim), dtype=np.float32)
+        store.add(range(start, start + size), vectors)
+    queries = [centres[i] + 0.5 * rng.standard_normal(dim, dtype=np.float32) for i in range(repeat)]
+
+    results = {}
+    queue = iter(queries * 2)
+    results['search_exhaustive'] = measure(lambda: store.search(next(queue), 10, exhaustive=True), repeat)
+    seconds, _ = timed_once(store.build_index)
+    results['build_ivf'] = {'seconds': seconds, 'vectors': count}
+    queue = iter(queries * 2)
+    results['search_ivf'] = measure(lambda: store.search(next(queue), 10), repeat)
+    hits = sum(len({i for i, _ in store.search(query, 10)} & {i for i, _ in store.search(query, 10, exhaustive=True)})
+               for query in queries)
+    results['search_ivf']['recall_at_10'] = hits / (10 * len(queries))
+    return results
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def compare(results, baseline):
+    """Returns (name, baseline, current, ratio) for every benchmark present in both runs, comparing medians or totals."""
+    rows = []
+    for group, benchmarks in results['results'].items():
+        for name, current in benchmarks.items():
+            previous = baseline.get('results', {}).get(group, {}).get(name)
+            if not previous:
+                continue
+            key = 'median' if 'median' in current else 'seconds'
+            if previous.get(key):
+                rows.append((f"{group}.{name}", previous[key], current[key], current[key] / previous[key]))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='database sizes (rows) for the query benchmarks')
+    parser.add_argument('--scan-images', type=int, default=2000, help='images in the synthetic library that is scanned')
+    parser.add_argument('--thumbnail-images', type=int, default=50, help='images used for the thumbnail benchmark')
+    parser.add_argument('--thumbnail-source-size', type=int, nargs=2, default=[4000, 3000], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--workers', type=int, default=None, help='metadata extraction processes (default: one per CPU)')
+    parser.add_argument('--repeat', type=int, default=20, help='runs per query benchmark')
+    parser.add_argument('--only', choices=['scan', 'queries', 'thumbnails', 'semantic'], nargs='+', help='run only these groups')
+    parser.add_argument('--output', default='benchmark_results.json', help='where to write the JSON results')
+    parser.add_argument('--compare', metavar='BASELINE', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    # Background thumbnail warming would compete with the scan being measured
+    thumbnails.WARM_ON_SCAN = False
+    groups = args.only or ['scan', 'queries', 'thumbnails', 'semantic']
+    results = {'environment': environment(), 'results': {}}
+
+    with tempfile.TemporaryDirectory(prefix='photomanager-bench-') as workdir:
+        thumbnails.configure('directory', root=os.path.join(workdir, 'thumbnails'))
+        if 'scan' in groups:
+            print(f"Scanning a synthetic library of {args.scan_images} images...")
+            results['results']['scan'] = bench_scan(workdir, args.scan_images, args.workers)
+        if 'queries' in groups:
+            for rows in args.sizes:
+                print(f"Query benchmarks at {rows} rows...")
+                results['results'][f'queries_{rows}'] = bench_queries(workdir, rows, args.repeat)
+        if 'thumbnails' in groups:
+            print(f"Rendering thumbnails for {args.thumbnail_images} images...")
+            results['results']['thumbnails'] = bench_thumbnails(workdir, args.thumbnail_images, tuple(args.thumbnail_source_size))
+        if 'semantic' in groups:
+            for rows in args.sizes:
+                print(f"Semantic search over {rows} embeddings...")
+                results['results'][f'semantic_{rows}'] = bench_semantic(workdir, rows, args.repeat)
+        database.close_db_connection()
+
+    for group, benchmarks in results['results'].items():
+        for name, result in benchmarks.items():
+            seconds = result.get('median', result.get('seconds'))
+            print(f"{group + '.' + name:<55} {seconds * 1000:10.2f} ms")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = 0
+        print(f"\nCompared with {args.compare} (median or total time, current / baseline):")
+        for name, previous, current, ratio in compare(results, baseline):
+            flag = '  REGRESSION' if ratio > REGRESSION_THRESHOLD else ''
+            regressions += bool(flag)
+            print(f"{name:<55} {previous * 1000:10.2f} -> {current * 1000:10.2f} ms  x{ratio:.2f}{flag}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Generators for synthetic photo libraries and databases used by the benchmarks."""
+import os
+import random
+from datetime import datetime, timedelta
+from PIL import Image
+import database
+import scanner
+
+# Tags assigned to synthetic database rows; a few are common, most are rare.
+TAG_VOCABULARY = ['cat', 'dog', 'beach', 'mountain', 'city', 'car', 'food', 'portrait', 'sunset', 'snow',
+                  'forest', 'birthday', 'concert', 'bicycle', 'boat', 'garden', 'museum', 'bridge', 'train', 'flower']
+
+# Camera models of synthetic rows, and the (latitude, longitude) centres
+# that the geotagged half of them is scattered around.
+CAMERA_MODELS = ['EOS R5', 'X100V', 'iPhone 13', 'Pixel 7', 'D850', 'A7 IV']
+PLACES = [(48.86, 2.35), (40.71, -74.01), (35.68, 139.69), (-33.87, 151.21), (51.51, -0.13), (-22.91, -43.17)]
+
+FIRST_YEAR = 2005
+LAST_YEAR = 2024
+
+def random_date(rng):
+    start = datetime(FIRST_YEAR, 1, 1)
+    span = (datetime(LAST_YEAR + 1, 1, 1) - start).total_seconds()
+    return start + timedelta(seconds=rng.random() * span)
+
+def generate_library(root, count, size=(64, 48), albums_per_month=3, seed=0):
+    """
+    Writes `count` JPEGs with EXIF dates below root, nested as
+    year/month/album, and returns their paths. Small images keep generation
+    fast; pass a larger size for thumbnail benchmarks.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        taken = random_date(rng)
+        album = os.path.join(root, f"{taken:%Y}", f"{taken:%m}", f"album_{rng.randrange(albums_per_month)}")
+        os.makedirs(album, exist_ok=True)
+        path = os.path.join(album, f"IMG_{i:07d}.jpg")
+        img = Image.new('RGB', size, color=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+        exif = Image.Exif()
+        exif[scanner.EXIF_DATE_TAG] = f"{taken:%Y:%m:%d %H:%M:%S}"
+        img.save(path, 'JPEG', exif=exif, quality=80)
+        paths.append(path)
+    return paths
+
+def populate_database(count, seed=0, tags_per_image=3, chunk_size=10000):
+    """
+    Inserts `count` synthetic rows (no files behind them) into the configured
+    database and tags them, for query benchmarks at sizes where generating
+    real files would take too long.
+    """
+    rng = random.Random(seed)
+    # A separate generator, so dates and tags stay as in earlier benchmark runs
+    place_rng = random.Random(seed + 1)
+    # Skewed so some tags match many images and others few
+    weights = [1 / (rank + 1) for rank in range(len(TAG_VOCABULARY))]
+    database.create_table()
+    next_index = 0
+    while next_index < count:
+        batch = []
+        for i in range(next_index, min(next_index + chunk_size, count)):
+            taken = random_date(rng).isoformat()
+            batch.append({'filepath': f"/synthetic/{taken[:4]}/{taken[5:7]}/IMG_{i:08d}.jpg", 'filename': f"IMG_{i:08d}.jpg",
+                          'date_taken': taken, 'date_modified': taken, 'filesize': rng.randrange(10 ** 6, 10 ** 7),
+                          'width': 4000, 'height': 3000, 'mtime_ns': i, 'inode': i,
+                          'camera_model': place_rng.choice(CAMERA_MODELS), 'metadata_version': scanner.METADATA_VERSION})
+            if place_rng.random() < 0.5:
+                lat, lon = place_rng.choice(PLACES)
+                batch[-1].update(latitude=lat + place_rng.gauss(0, 0.5), longitude=lon + place_rng.gauss(0, 0.5))
+        database.insert_images_bulk(batch)
+        next_index += len(batch)
+
+    conn = database.get_db_connection()
+    image_ids = [row[0] for row in conn.execute("SELECT id FROM images WHERE llm_tags IS NULL")]
+    for start in range(0, len(image_ids), chunk_size):
+        database.update_llm_tags_bulk(
+            (image_id, set(rng.choices(TAG_VOCABULARY, weights, k=tags_per_image)))
+            for image_id in image_ids[start:start + chunk_size])
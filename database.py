@@ -1,15 +1,362 @@
+import json
+import logging
+import os
 import sqlite3
+import threading
+import time
+import metrics
 
-def get_db_connection():
-    """Establishes a connection to the database."""
-    conn = sqlite3.connect('photo_library.db')
+logger = logging.getLogger(__name__)
+
+QUERY_SECONDS = metrics.Histogram('photomanager_db_query_seconds', 'Duration of database.py query functions.', ['function'])
+
+# Number of rows written per transaction by the bulk helpers.
+BULK_CHUNK_SIZE = 1000
+
+# Number of images per gallery page.
+GALLERY_PAGE_SIZE = 200
+
+# Columns written when inserting an image record, in statement order.
+# EXIF fields read by exif.py, and the scanner.METADATA_VERSION that read them.
+METADATA_COLUMNS = ('date_offset', 'camera_make', 'camera_model', 'lens_model', 'orientation', 'latitude', 'longitude', 'metadata_version')
+IMAGE_COLUMNS = ('filepath', 'filename', 'date_taken', 'date_modified', 'filesize', 'width', 'height', 'mtime_ns', 'inode') + METADATA_COLUMNS
+
+# Path of the SQLite database file; change it with configure().
+DB_PATH = os.environ.get('PHOTO_LIBRARY_DB', 'photo_library.db')
+
+# Applied to every new connection. WAL lets readers (web requests) proceed
+# while a scan or the tagger is writing; synchronous=NORMAL is durable in WAL
+# mode except for the last transactions on power loss.
+PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 10000),
+    ('cache_size', -16000),  # in KiB, per connection
+    ('mmap_size', 256 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+]
+
+# Maximum number of idle connections kept for reuse.
+POOL_SIZE = 8
+
+# Each thread holds one connection while it works. Threads that finish a unit
+# of work (e.g. a web request) hand it back with release_db_connection so the
+# next thread reuses it instead of reconnecting and re-applying the pragmas.
+_local = threading.local()
+_idle_connections = []
+_pool_lock = threading.Lock()
+
+def configure(db_path):
+    """Points the module at a different database file. Pooled connections are dropped."""
+    global DB_PATH
+    DB_PATH = db_path
+    close_db_connection()
+    with _pool_lock:
+        while _idle_connections:
+            _idle_connections.pop()[0].close()
+
+def _connect(db_path):
+    # Connections move between threads through the pool, but are only ever
+    # used by one thread at a time.
+    conn = sqlite3.connect(db_path, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    for pragma, value in PRAGMAS:
+        conn.execute(f'PRAGMA {pragma} = {value}')
+    return conn
+
+def get_db_connection():
+    """Returns this thread's connection to the database, taking one from the pool on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.path == DB_PATH:
+        return conn
+    if conn is not None:
+        conn.close()
+
+    conn = None
+    with _pool_lock:
+        while _idle_connections and conn is None:
+            idle_conn, path = _idle_connections.pop()
+            if path == DB_PATH:
+                conn = idle_conn
+            else:
+                idle_conn.close()
+    if conn is None:
+        conn = _connect(DB_PATH)
+    _local.conn = conn
+    _local.path = DB_PATH
     return conn
 
+def release_db_connection():
+    """Returns this thread's connection to the pool, if it has one."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    if conn.in_transaction:
+        conn.rollback()
+    with _pool_lock:
+        if len(_idle_connections) < POOL_SIZE and _local.path == DB_PATH:
+            _idle_connections.append((conn, _local.path))
+            return
+    conn.close()
+
+def close_db_connection():
+    """Closes this thread's connection, if it has one."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+def _add_column(conn, table, column, column_type):
+    """Adds a column unless it already exists (databases upgraded before migrations were versioned)."""
+    existing_columns = {row['name'] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if column not in existing_columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+def _migrate_fingerprints(conn):
+    """Stat fingerprint used by incremental scans."""
+    _add_column(conn, 'images', 'mtime_ns', 'INTEGER')
+    _add_column(conn, 'images', 'inode', 'INTEGER')
+
+def _migrate_timeline(conn):
+    """Indexed year/month columns and indexes for the gallery queries."""
+    # Virtual generated columns are computed from date_taken on read, so every
+    # insert and update path keeps them in sync without extra code.
+    _add_column(conn, 'images', 'year', "INTEGER GENERATED ALWAYS AS (CAST(SUBSTR(date_taken, 1, 4) AS INTEGER)) VIRTUAL")
+    _add_column(conn, 'images', 'month', "INTEGER GENERATED ALWAYS AS (CAST(SUBSTR(date_taken, 6, 2) AS INTEGER)) VIRTUAL")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_date_taken ON images (date_taken, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_year_month ON images (year, month)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_filename ON images (filename)')
+
+def _migrate_tag_index(conn):
+    """Normalized image_tags table for indexed tag search."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_tags (
+            tag TEXT NOT NULL,
+            image_id INTEGER NOT NULL,
+            PRIMARY KEY (tag, image_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_image_tags_image_id ON image_tags (image_id)')
+    # Tags follow their image: removed with it, and cleared when a changed
+    # file has its llm_tags reset for re-tagging.
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS images_delete_tags AFTER DELETE ON images
+        BEGIN
+            DELETE FROM image_tags WHERE image_id = OLD.id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS images_clear_tags AFTER UPDATE OF llm_tags ON images WHEN NEW.llm_tags IS NULL
+        BEGIN
+            DELETE FROM image_tags WHERE image_id = OLD.id;
+        END
+    ''')
+    rows = conn.execute('SELECT id, llm_tags FROM images WHERE llm_tags IS NOT NULL').fetchall()
+    _write_tag_index(conn, [(row['id'], row['llm_tags'].split(',')) for row in rows])
+
+def _migrate_untagged_index(conn):
+    """Partial index over untagged images for the tagging queue."""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_untagged ON images (id) WHERE llm_tags IS NULL')
+
+def _migrate_duplicate_hashes(conn):
+    """Content and perceptual hashes for duplicate detection."""
+    _add_column(conn, 'images', 'content_hash', 'TEXT')
+    _add_column(conn, 'images', 'phash', 'INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images (content_hash) WHERE content_hash IS NOT NULL')
+    # Only files whose size collides with another file are content-hashed
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_filesize ON images (filesize)')
+
+def _migrate_tag_cache(conn):
+    """Model output by content hash, kept when images are removed so re-imported files are not re-tagged."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS tag_cache (
+            content_hash TEXT NOT NULL,
+            model_version TEXT NOT NULL,
+            tags TEXT NOT NULL,
+            PRIMARY KEY (content_hash, model_version)
+        ) WITHOUT ROWID
+    ''')
+
+# Trigger bodies that add an image (NEW) to, or remove one (OLD) from, its
+# month in timeline_counts. The cover is the month's first image in gallery
+# order; removing it promotes the next one with a single index seek. Images
+# without a date have no month and are skipped.
+_TIMELINE_ADD = """
+    INSERT INTO timeline_counts (year, month, count, cover_date_taken, cover_image_id)
+    SELECT NEW.year, NEW.month, 1, NEW.date_taken, NEW.id WHERE NEW.year IS NOT NULL
+    ON CONFLICT (year, month) DO UPDATE SET
+        count = count + 1,
+        cover_date_taken = CASE WHEN (NEW.date_taken, NEW.id) < (cover_date_taken, cover_image_id) THEN NEW.date_taken ELSE cover_date_taken END,
+        cover_image_id = CASE WHEN (NEW.date_taken, NEW.id) < (cover_date_taken, cover_image_id) THEN NEW.id ELSE cover_image_id END;
+"""
+_TIMELINE_REMOVE = """
+    UPDATE timeline_counts SET count = count - 1 WHERE year = OLD.year AND month = OLD.month;
+    DELETE FROM timeline_counts WHERE year = OLD.year AND month = OLD.month AND count <= 0;
+    UPDATE timeline_counts SET (cover_date_taken, cover_image_id) = (
+        SELECT date_taken, id FROM images
+        WHERE date_taken >= printf('%04d-%02d', OLD.year, OLD.month) AND date_taken < printf('%04d-%02d~', OLD.year, OLD.month)
+        ORDER BY date_taken, id LIMIT 1
+    ) WHERE year = OLD.year AND month = OLD.month AND cover_image_id = OLD.id;
+"""
+
+def _migrate_timeline_counts(conn):
+    """Per-month image counts and cover images, kept up to date by triggers, for the gallery navigation."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS timeline_counts (
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            cover_date_taken TEXT,
+            cover_image_id INTEGER,
+            PRIMARY KEY (year, month)
+        ) WITHOUT ROWID
+    ''')
+    # Every path that adds, removes or re-dates images (scans, watcher
+    # batches, folder removal) goes through these.
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS images_timeline_insert AFTER INSERT ON images BEGIN {_TIMELINE_ADD} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS images_timeline_delete AFTER DELETE ON images BEGIN {_TIMELINE_REMOVE} END")
+    # A re-dated image leaves its old month and joins its new one (which may be the same)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS images_timeline_update AFTER UPDATE OF date_taken ON images
+        WHEN NEW.date_taken IS NOT OLD.date_taken
+        BEGIN {_TIMELINE_REMOVE} {_TIMELINE_ADD} END
+    """)
+    conn.execute('''
+        INSERT OR REPLACE INTO timeline_counts (year, month, count, cover_date_taken, cover_image_id)
+        SELECT year, month, count, date_taken, id FROM (
+            SELECT year, month, date_taken, id, COUNT(*) OVER month AS count, ROW_NUMBER() OVER (month ORDER BY date_taken, id) AS position
+            FROM images WHERE year IS NOT NULL
+            WINDOW month AS (PARTITION BY year, month)
+        ) WHERE position = 1
+    ''')
+
+def _migrate_phash_version(conn):
+    """A counter bumped by triggers whenever a perceptual hash changes, so processes know when to rebuild their BK-tree."""
+    conn.execute('CREATE TABLE IF NOT EXISTS phash_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+    conn.execute('INSERT OR IGNORE INTO phash_version (id, version) VALUES (1, 0)')
+    bump = 'UPDATE phash_version SET version = version + 1 WHERE id = 1;'
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS images_phash_insert AFTER INSERT ON images WHEN NEW.phash IS NOT NULL BEGIN {bump} END")
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS images_phash_delete AFTER DELETE ON images WHEN OLD.phash IS NOT NULL BEGIN {bump} END")
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS images_phash_update AFTER UPDATE OF phash ON images
+        WHEN NEW.phash IS NOT OLD.phash
+        BEGIN {bump} END
+    """)
+
+def _migrate_jobs(conn):
+    """Durable job queue shared by the web and worker processes (see jobs.py)."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued',
+            unique_key TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after REAL NOT NULL,
+            lease_owner TEXT,
+            lease_expires REAL,
+            created REAL NOT NULL,
+            finished REAL,
+            error TEXT,
+            progress TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (priority DESC, id) WHERE status = 'queued'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_leases ON jobs (lease_expires) WHERE status = 'running'")
+    # At most one queued job per unique_key; a running one may have a successor queued
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_unique ON jobs (unique_key) WHERE status = 'queued'")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_kind ON jobs (kind, id)')
+
+def _migrate_imports(conn):
+    """Checkpoints of bulk imports (import_cli.py), so an interrupted import resumes."""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS imports (
+            id INTEGER PRIMARY KEY,
+            dirs TEXT NOT NULL,
+            started REAL NOT NULL,
+            updated REAL NOT NULL,
+            finished REAL,
+            files_imported INTEGER NOT NULL DEFAULT 0,
+            bytes_imported INTEGER NOT NULL DEFAULT 0,
+            seconds REAL NOT NULL DEFAULT 0,
+            runs INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_imports_unfinished ON imports (dirs) WHERE finished IS NULL')
+
+def _migrate_exif_metadata(conn):
+    """Camera, lens, orientation and GPS columns, with indexes for filtering and an R-tree over positions."""
+    for column, column_type in (('date_offset', 'TEXT'), ('camera_make', 'TEXT'), ('camera_model', 'TEXT'), ('lens_model', 'TEXT'),
+                                ('orientation', 'INTEGER'), ('latitude', 'REAL'), ('longitude', 'REAL'), ('metadata_version', 'INTEGER')):
+        _add_column(conn, 'images', column, column_type)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_camera ON images (camera_model, date_taken, id) WHERE camera_model IS NOT NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_lens ON images (lens_model, date_taken, id) WHERE lens_model IS NOT NULL')
+    # Finds images read by an older metadata extractor; existing rows are backfilled by the next scan
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_images_metadata_version ON images (metadata_version)')
+    try:
+        conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS image_locations USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+    except sqlite3.OperationalError as e:
+        # SQLite built without R-tree support: bounding boxes scan a plain index instead
+        logger.warning("R-tree index unavailable (%s); using a latitude index for location queries.", e)
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_images_location ON images (latitude, longitude) WHERE latitude IS NOT NULL')
+        return
+    add_location = """
+        INSERT INTO image_locations (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+        WHERE NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL;
+    """
+    conn.execute(f"CREATE TRIGGER IF NOT EXISTS images_location_insert AFTER INSERT ON images BEGIN {add_location} END")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS images_location_delete AFTER DELETE ON images WHEN OLD.latitude IS NOT NULL
+        BEGIN DELETE FROM image_locations WHERE id = OLD.id; END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS images_location_update AFTER UPDATE OF latitude, longitude ON images
+        WHEN NEW.latitude IS NOT OLD.latitude OR NEW.longitude IS NOT OLD.longitude
+        BEGIN DELETE FROM image_locations WHERE id = OLD.id; {add_location} END
+    """)
+
+# Schema migrations, applied in order. The number of migrations already
+# applied is stored in the database's user_version; append new ones, never
+# reorder or edit existing entries.
+MIGRATIONS = [
+    _migrate_fingerprints,
+    _migrate_timeline,
+    _migrate_tag_index,
+    _migrate_untagged_index,
+    _migrate_duplicate_hashes,
+    _migrate_tag_cache,
+    _migrate_timeline_counts,
+    _migrate_jobs,
+    _migrate_imports,
+    _migrate_exif_metadata,
+    _migrate_phash_version,
+]
+
+def migrate(conn):
+    """Applies any pending migrations, each in its own transaction."""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN')
+        try:
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info("Applied database migration %d: %s", number, migration.__doc__)
+
+@metrics.timed(QUERY_SECONDS)
 def create_table():
-    """Creates the images table if it doesn't exist."""
+    """Creates the images table if it doesn't exist and brings the schema up to date."""
     conn = get_db_connection()
-    conn.execute('''
+    with conn:
+        conn.execute('''
         CREATE TABLE IF NOT EXISTS images (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             filepath TEXT NOT NULL UNIQUE,
@@ -21,10 +368,10 @@ def create_table():
             height INTEGER,
             llm_tags TEXT
         )
-    ''')
-    conn.commit()
-    conn.close()
+        ''')
+    migrate(conn)
 
+@metrics.timed(QUERY_SECONDS)
 def get_all_images(sort_by='date_taken', order='desc'):
     """Fetches all images from the database, with sorting."""
     conn = get_db_connection()
@@ -34,98 +381,704 @@ def get_all_images(sort_by='date_taken', order='desc'):
         order = 'desc'
 
     images = conn.execute(f'SELECT * FROM images ORDER BY {sort_by} {order}').fetchall()
-    conn.close()
     return images
 
+@metrics.timed(QUERY_SECONDS)
 def get_image_by_id(image_id):
     """Fetches a single image from the database by its ID."""
     conn = get_db_connection()
     image = conn.execute('SELECT * FROM images WHERE id = ?', (image_id,)).fetchone()
-    conn.close()
     return image
 
+def normalize_tag(tag):
+    """Returns the form tags are indexed and searched by."""
+    return ' '.join(tag.lower().split())
+
+def _write_tag_index(conn, tagged_images):
+    """Replaces the image_tags rows for (image_id, tags) pairs. Runs inside the caller's transaction."""
+    tagged_images = list(tagged_images)
+    conn.executemany('DELETE FROM image_tags WHERE image_id = ?', [(image_id,) for image_id, _ in tagged_images])
+    conn.executemany('INSERT OR IGNORE INTO image_tags (tag, image_id) VALUES (?, ?)',
+                     [(normalize_tag(tag), image_id) for image_id, tags in tagged_images for tag in tags if tag.strip()])
+
+@metrics.timed(QUERY_SECONDS)
 def update_llm_tags(image_id, tags):
-    """Updates the llm_tags for a specific image."""
+    """Updates the llm_tags for a specific image and its entries in the tag index."""
     conn = get_db_connection()
-    # Tags are stored as a comma-separated string
+    # Tags are stored as a comma-separated string for display
     tags_str = ",".join(tags)
-    conn.execute('UPDATE images SET llm_tags = ? WHERE id = ?', (tags_str, image_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute('UPDATE images SET llm_tags = ? WHERE id = ?', (tags_str, image_id))
+        _write_tag_index(conn, [(image_id, tags)])
 
-def get_images_without_tags():
-    """Fetches all images that have not been tagged yet."""
+@metrics.timed(QUERY_SECONDS)
+def update_llm_tags_bulk(tagged_images, fingerprints=None):
+    """
+    Updates the llm_tags of many images in one transaction. Takes (image_id,
+    tags) pairs. With fingerprints, a dict of image_id to the (mtime_ns,
+    filesize) of the row the tags were computed from, images whose row has
+    since been rewritten by a scan are skipped. Returns the ids updated.
+    """
+    tagged_images = list(tagged_images)
     conn = get_db_connection()
-    images = conn.execute('SELECT * FROM images WHERE llm_tags IS NULL').fetchall()
-    conn.close()
+    with conn:
+        if fingerprints is None:
+            conn.executemany('UPDATE images SET llm_tags = ? WHERE id = ?',
+                             [(",".join(tags), image_id) for image_id, tags in tagged_images])
+        else:
+            tagged_images = [(image_id, tags) for image_id, tags in tagged_images
+                             if conn.execute('UPDATE images SET llm_tags = ? WHERE id = ? AND mtime_ns IS ? AND filesize IS ?',
+                                             (",".join(tags), image_id) + fingerprints[image_id]).rowcount]
+        _write_tag_index(conn, tagged_images)
+    return [image_id for image_id, _ in tagged_images]
+
+@metrics.timed(QUERY_SECONDS)
+def get_images_without_tags(after_id=0, limit=None):
+    """
+    Fetches images that have not been tagged yet, in id order. With a limit,
+    returns at most that many images with an id above after_id, so callers
+    can page through the queue without loading it all at once.
+    """
+    conn = get_db_connection()
+    if limit is None:
+        images = conn.execute('SELECT * FROM images WHERE llm_tags IS NULL AND id > ? ORDER BY id', (after_id,)).fetchall()
+    else:
+        images = conn.execute('SELECT * FROM images WHERE llm_tags IS NULL AND id > ? ORDER BY id LIMIT ?', (after_id, limit)).fetchall()
     return images
 
+@metrics.timed(QUERY_SECONDS)
+def get_tagged_images(after_id=0, limit=1000):
+    """Returns up to `limit` (id, filepath, llm_tags) rows of tagged images, in id order after after_id."""
+    conn = get_db_connection()
+    return conn.execute('SELECT id, filepath, llm_tags FROM images WHERE llm_tags IS NOT NULL AND id > ? ORDER BY id LIMIT ?',
+                        (after_id, limit)).fetchall()
+
+# Upper bound on search terms; each term takes one bit of the match mask.
+MAX_SEARCH_TERMS = 32
+
+def parse_tag_query(query):
+    """
+    Parses a tag search into groups of terms: the groups are alternatives
+    (separated by OR) and every term in a group must match. A term ending in
+    '*' is a prefix match. Returns a list of lists of (tag, is_prefix).
+    """
+    groups = [[]]
+    for token in query.replace(',', ' ').split():
+        if token.upper() == 'OR' or token == '|':
+            groups.append([])
+            continue
+        is_prefix = token.endswith('*')
+        tag = normalize_tag(token.rstrip('*'))
+        if tag:
+            groups[-1].append((tag, is_prefix))
+    return [group for group in groups if group]
+
+@metrics.timed(QUERY_SECONDS)
 def search_images_by_tag(query):
-    """Searches for images by a tag in the llm_tags column."""
+    """
+    Searches for images by tag using the image_tags index. Supports AND (all
+    terms), OR between groups of terms and 'prefix*' terms. Results are
+    ordered by the number of matching terms, then newest first.
+    """
+    groups = parse_tag_query(query)
+    terms = []
+    group_masks = []
+    for group in groups:
+        mask = 0
+        for term in group:
+            if term not in terms:
+                terms.append(term)
+            mask |= 1 << terms.index(term)
+        group_masks.append(mask)
+    if not terms or len(terms) > MAX_SEARCH_TERMS:
+        return []
+
+    # Each term is an index lookup on image_tags; UNION keeps one row per
+    # (image, term) so the bits add up to a mask of the matched terms.
+    selects = []
+    params = []
+    for bit, (tag, is_prefix) in enumerate(terms):
+        if is_prefix:
+            selects.append(f"SELECT image_id, {1 << bit} FROM image_tags WHERE tag >= ? AND tag < ?")
+            params.extend((tag, tag[:-1] + chr(ord(tag[-1]) + 1)))
+        else:
+            selects.append(f"SELECT image_id, {1 << bit} FROM image_tags WHERE tag = ?")
+            params.append(tag)
+    group_filter = ' OR '.join(f"(hits.mask & {mask}) = {mask}" for mask in group_masks)
+
     conn = get_db_connection()
-    # The '%' are wildcards for the LIKE query
-    search_term = f"%{query}%"
-    images = conn.execute('SELECT * FROM images WHERE llm_tags LIKE ? ORDER BY date_taken DESC', (search_term,)).fetchall()
-    conn.close()
+    images = conn.execute(f"""
+        WITH matches(image_id, bit) AS ({' UNION '.join(selects)}),
+        hits AS (SELECT image_id, SUM(bit) AS mask, COUNT(*) AS score FROM matches GROUP BY image_id)
+        SELECT images.*, hits.score AS score FROM hits JOIN images ON images.id = hits.image_id
+        WHERE {group_filter}
+        ORDER BY hits.score DESC, images.date_taken DESC
+    """, params).fetchall()
     return images
 
+@metrics.timed(QUERY_SECONDS)
 def get_available_years():
-    """Returns a sorted list of distinct years from the database."""
+    """Returns the years that have images, newest first, from the timeline summary."""
     conn = get_db_connection()
-    # SUBSTR(date_taken, 1, 4) extracts the year from 'YYYY-MM-DD...'
-    years = conn.execute("SELECT DISTINCT SUBSTR(date_taken, 1, 4) as year FROM images ORDER BY year DESC").fetchall()
-    conn.close()
-    return [row['year'] for row in years]
+    years = conn.execute("SELECT DISTINCT year FROM timeline_counts ORDER BY year DESC").fetchall()
+    return [f"{row['year']:04d}" for row in years]
+
+@metrics.timed(QUERY_SECONDS)
+def get_timeline():
+    """
+    Returns every month that has images, newest first, with its image
+    count and cover image (the month's first image in gallery order).
+    Reads one summary row per month instead of the images table.
+    """
+    conn = get_db_connection()
+    return conn.execute("""
+        SELECT timeline_counts.year, timeline_counts.month, timeline_counts.count, images.*
+        FROM timeline_counts JOIN images ON images.id = timeline_counts.cover_image_id
+        ORDER BY timeline_counts.year DESC, timeline_counts.month DESC
+    """).fetchall()
 
+@metrics.timed(QUERY_SECONDS)
 def remove_images_by_path(folder_path):
     """Removes all image records from the database that are in a specific folder."""
     conn = get_db_connection()
     # Use a wildcard to match all files in the folder and subfolders
     path_pattern = f"{folder_path}%"
-    cursor = conn.execute("DELETE FROM images WHERE filepath LIKE ?", (path_pattern,))
-    print(f"Deleted {cursor.rowcount} records from path: {folder_path}")
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.execute("DELETE FROM images WHERE filepath LIKE ?", (path_pattern,))
+    logger.info("Deleted %d records from path: %s", cursor.rowcount, folder_path)
 
+@metrics.timed(QUERY_SECONDS)
 def get_all_filepaths():
     """Returns a set of all filepaths currently in the database."""
     conn = get_db_connection()
     paths = conn.execute("SELECT filepath FROM images").fetchall()
-    conn.close()
     return {row['filepath'] for row in paths}
 
-def get_images_by_year_and_month(year, month=None):
-    """Fetches all images from the database for a specific year and optional month."""
+@metrics.timed(QUERY_SECONDS)
+def get_image_fingerprints():
+    """
+    Returns a dict mapping every filepath in the database to its stored
+    (mtime_ns, filesize, inode) fingerprint followed by its content hash,
+    which together locate its thumbnails. Rows scanned before fingerprints
+    were recorded have a mtime_ns of None.
+    """
+    conn = get_db_connection()
+    rows = conn.execute("SELECT filepath, mtime_ns, filesize, inode, content_hash FROM images").fetchall()
+    return {row['filepath']: (row['mtime_ns'], row['filesize'], row['inode'], row['content_hash']) for row in rows}
+
+@metrics.timed(QUERY_SECONDS)
+def get_fingerprints_for_paths(filepaths, chunk_size=500, include_children=False):
+    """
+    Like get_image_fingerprints, but only for the given filepaths. With
+    include_children, each path is also treated as a directory and every
+    record below it is included, as for delete_images_bulk.
+    """
+    conn = get_db_connection()
+    fingerprints = {}
+    for chunk in chunked(filepaths, chunk_size):
+        placeholders = ', '.join('?' for _ in chunk)
+        rows = conn.execute(f"SELECT filepath, mtime_ns, filesize, inode, content_hash FROM images WHERE filepath IN ({placeholders})",
+                            chunk).fetchall()
+        if include_children:
+            for path in chunk:
+                rows += conn.execute('SELECT filepath, mtime_ns, filesize, inode, content_hash FROM images '
+                                     'WHERE filepath >= ? AND filepath < ?', _prefix_range(path)).fetchall()
+        fingerprints.update((row['filepath'], (row['mtime_ns'], row['filesize'], row['inode'], row['content_hash'])) for row in rows)
+    return fingerprints
+
+@metrics.timed(QUERY_SECONDS)
+def move_images_under(old_directory, new_directory):
+    """Re-points all records below old_directory at new_directory after a directory move."""
     conn = get_db_connection()
+    low, high = _prefix_range(old_directory)
+    new_prefix = new_directory.rstrip(os.sep) + os.sep
+    with conn:
+        cursor = conn.execute("UPDATE OR IGNORE images SET filepath = ? || SUBSTR(filepath, ?) WHERE filepath >= ? AND filepath < ?",
+                              (new_prefix, len(low) + 1, low, high))
+    return cursor.rowcount
 
+def _date_range(year, month=None):
+    """Returns [start, end) date_taken bounds for a year or a month of a year."""
+    year = int(year)
     if month:
-        # Format month to two digits (e.g., 7 -> '07')
-        month_str = f"{month:02d}"
-        year_month_pattern = f"{year}-{month_str}%"
-        images = conn.execute("SELECT * FROM images WHERE date_taken LIKE ? ORDER BY date_taken ASC", (year_month_pattern,)).fetchall()
+        start = f"{year:04d}-{month:02d}"
+        end = f"{year + 1:04d}-01" if month == 12 else f"{year:04d}-{month + 1:02d}"
     else:
-        year_pattern = f"{year}%"
-        images = conn.execute("SELECT * FROM images WHERE date_taken LIKE ? ORDER BY date_taken ASC", (year_pattern,)).fetchall()
+        start, end = f"{year:04d}", f"{year + 1:04d}"
+    return start, end
 
-    conn.close()
+@metrics.timed(QUERY_SECONDS)
+def get_images_by_year_and_month(year, month=None):
+    """Fetches all images from the database for a specific year and optional month."""
+    conn = get_db_connection()
+    # A range on date_taken uses idx_images_date_taken for both the filter and the order
+    start, end = _date_range(year, month)
+    images = conn.execute("SELECT * FROM images WHERE date_taken >= ? AND date_taken < ? ORDER BY date_taken ASC, id ASC",
+                          (start, end)).fetchall()
     return images
 
+@metrics.timed(QUERY_SECONDS)
+def get_images_page(year, month=None, after=None, limit=GALLERY_PAGE_SIZE):
+    """
+    Fetches one page of a year (or month) in date order using keyset
+    pagination. `after` is the (date_taken, id) of the last image of the
+    previous page; each page is a single index range scan no matter how deep
+    into the year it is.
+    """
+    conn = get_db_connection()
+    start, end = _date_range(year, month)
+    if after:
+        images = conn.execute("""
+            SELECT * FROM images
+            WHERE date_taken < ? AND (date_taken, id) > (?, ?)
+            ORDER BY date_taken ASC, id ASC LIMIT ?
+        """, (end, after[0], after[1], limit)).fetchall()
+    else:
+        images = conn.execute("""
+            SELECT * FROM images
+            WHERE date_taken >= ? AND date_taken < ?
+            ORDER BY date_taken ASC, id ASC LIMIT ?
+        """, (start, end, limit)).fetchall()
+    return images
+
+@metrics.timed(QUERY_SECONDS)
+def get_month_counts(year):
+    """Returns {month: number of images} for a year, from the timeline summary."""
+    conn = get_db_connection()
+    rows = conn.execute("SELECT month, count FROM timeline_counts WHERE year = ? ORDER BY month", (int(year),)).fetchall()
+    return {row['month']: row['count'] for row in rows}
+
+@metrics.timed(QUERY_SECONDS)
+def get_timeline_window(image_id, radius=10, year=None, month=None):
+    """
+    Returns the image and up to `radius` images on each side of it in the
+    gallery's (date_taken, id) order, optionally limited to a year or month,
+    as a list in that order. Each side is one index range scan. Returns an
+    empty list if the image does not exist.
+    """
+    conn = get_db_connection()
+    image = conn.execute("SELECT * FROM images WHERE id = ?", (image_id,)).fetchone()
+    if image is None:
+        return []
+    # Every date_taken sorts between '' and '~', so these bounds mean "no limit"
+    start, end = _date_range(year, month) if year else ('', '~')
+    position = (image['date_taken'], image['id'])
+    before = conn.execute("""
+        SELECT * FROM images
+        WHERE date_taken >= ? AND (date_taken, id) < (?, ?)
+        ORDER BY date_taken DESC, id DESC LIMIT ?
+    """, (start,) + position + (radius,)).fetchall()
+    after = conn.execute("""
+        SELECT * FROM images
+        WHERE date_taken < ? AND (date_taken, id) > (?, ?)
+        ORDER BY date_taken ASC, id ASC LIMIT ?
+    """, (end,) + position + (radius,)).fetchall()
+    return before[::-1] + [image] + after
+
+@metrics.timed(QUERY_SECONDS)
+def get_images_by_ids(image_ids, chunk_size=500):
+    """Returns the image rows for the given ids, in the order of image_ids (missing ids are skipped)."""
+    conn = get_db_connection()
+    images = {}
+    for chunk in chunked(image_ids, chunk_size):
+        placeholders = ', '.join('?' for _ in chunk)
+        images.update((row['id'], row) for row in conn.execute(f"SELECT * FROM images WHERE id IN ({placeholders})", chunk))
+    return [images[image_id] for image_id in image_ids if image_id in images]
+
+def _image_values(image_data):
+    """Returns the insert parameters for an image dict; missing keys become NULL."""
+    return tuple(image_data.get(column) for column in IMAGE_COLUMNS)
+
+def chunked(iterable, size):
+    """Yields lists of up to `size` items from any iterable, without materializing it."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _prefix_range(directory):
+    """Returns (low, high) bounds matching every path below directory.
+    A range comparison can use the filepath index, unlike LIKE."""
+    prefix = directory.rstrip(os.sep) + os.sep
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+INSERT_IMAGE_SQL = f"""
+    INSERT OR IGNORE INTO images ({', '.join(IMAGE_COLUMNS)})
+    VALUES ({', '.join('?' for _ in IMAGE_COLUMNS)})
+"""
+
+@metrics.timed(QUERY_SECONDS)
 def insert_image(image_data):
     """Inserts a new image record into the database."""
     conn = get_db_connection()
     # Using INSERT OR IGNORE to avoid errors on duplicate filepaths
     # This might happen if we re-scan a directory
-    conn.execute('''
-        INSERT OR IGNORE INTO images (filepath, filename, date_taken, date_modified, filesize, width, height)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        image_data['filepath'],
-        image_data['filename'],
-        image_data['date_taken'],
-        image_data['date_modified'],
-        image_data['filesize'],
-        image_data['width'],
-        image_data['height']
-    ))
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(INSERT_IMAGE_SQL, _image_values(image_data))
+
+def insert_images_bulk(images, chunk_size=BULK_CHUNK_SIZE, checkpoint=None):
+    """
+    Inserts many image records, committing once per chunk of `chunk_size` rows.
+    `images` may be any iterable (including a generator), so records can be
+    written while they are still being produced. Returns the number of rows
+    inserted; duplicate filepaths are ignored as in insert_image.
+    checkpoint, if given, is called with the connection and each chunk
+    inside the chunk's transaction, so progress it records is committed
+    together with the rows.
+    """
+    conn = get_db_connection()
+    inserted = 0
+    for chunk in chunked(images, chunk_size):
+        before = conn.total_changes
+        # Timed per chunk: producing `images` (e.g. extracting metadata) is not a query
+        with QUERY_SECONDS.time(function='insert_images_bulk'), conn:
+            conn.executemany(INSERT_IMAGE_SQL, [_image_values(image_data) for image_data in chunk])
+            if checkpoint:
+                checkpoint(conn, chunk)
+        inserted += conn.total_changes - before
+    return inserted
+
+@metrics.timed(QUERY_SECONDS)
+def delete_images_bulk(filepaths, chunk_size=BULK_CHUNK_SIZE, include_children=False):
+    """
+    Deletes the image records for the given filepaths, committing once per chunk.
+    With include_children, each path is also treated as a directory and every
+    record below it is removed. Returns the number of rows deleted.
+    """
+    conn = get_db_connection()
+    deleted = 0
+    for chunk in chunked(filepaths, chunk_size):
+        before = conn.total_changes
+        with conn:
+            conn.executemany("DELETE FROM images WHERE filepath = ?", [(filepath,) for filepath in chunk])
+            if include_children:
+                conn.executemany("DELETE FROM images WHERE filepath >= ? AND filepath < ?", [_prefix_range(path) for path in chunk])
+        deleted += conn.total_changes - before
+    return deleted
+
+UPDATE_IMAGE_SQL = f"""
+    UPDATE images SET {', '.join(f'{column} = ?' for column in IMAGE_COLUMNS[1:])}, llm_tags = NULL, content_hash = NULL, phash = NULL
+    WHERE filepath = ?
+"""
+
+@metrics.timed(QUERY_SECONDS)
+def update_images_bulk(images, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Rewrites the metadata of existing image records whose files have changed,
+    matched by filepath. The LLM tags are cleared so the new content is
+    re-tagged and the duplicate hashes are cleared to be recomputed; the id
+    is kept.
+    """
+    conn = get_db_connection()
+    updated = 0
+    for chunk in chunked(images, chunk_size):
+        before = conn.total_changes
+        with conn:
+            conn.executemany(UPDATE_IMAGE_SQL, [_image_values(image_data)[1:] + (image_data['filepath'],) for image_data in chunk])
+        updated += conn.total_changes - before
+    return updated
+
+@metrics.timed(QUERY_SECONDS)
+def update_fingerprints_bulk(fingerprints, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Stores stat fingerprints for existing records without touching their
+    metadata. `fingerprints` is an iterable of (filepath, mtime_ns, filesize, inode).
+    """
+    conn = get_db_connection()
+    for chunk in chunked(fingerprints, chunk_size):
+        with conn:
+            conn.executemany("UPDATE images SET mtime_ns = ?, filesize = ?, inode = ? WHERE filepath = ?",
+                             [(mtime_ns, filesize, inode, filepath) for filepath, mtime_ns, filesize, inode in chunk])
+
+@metrics.timed(QUERY_SECONDS)
+def move_images_bulk(moves, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Points existing records at new paths after files were renamed or moved.
+    `moves` is an iterable of (old_filepath, new_filepath) pairs. Ids, tags and
+    all other metadata are preserved.
+    """
+    conn = get_db_connection()
+    moved = 0
+    for chunk in chunked(moves, chunk_size):
+        before = conn.total_changes
+        with conn:
+            conn.executemany("UPDATE OR IGNORE images SET filepath = ?, filename = ? WHERE filepath = ?",
+                             [(new_path, os.path.basename(new_path), old_path) for old_path, new_path in chunk])
+        moved += conn.total_changes - before
+    return moved
+
+@metrics.timed(QUERY_SECONDS)
+def get_thumbnail_sources():
+    """Returns the columns thumbnail keys are derived from, for every image."""
+    conn = get_db_connection()
+    return conn.execute("SELECT filepath, mtime_ns, filesize, inode, content_hash FROM images").fetchall()
+
+@metrics.timed(QUERY_SECONDS)
+def get_unhashed_size_collisions():
+    """
+    Returns images (id, filepath and fingerprint) without a content hash whose file size
+    is shared with another image. Files of a unique size cannot have an
+    exact duplicate, so they are never read in full.
+    """
+    conn = get_db_connection()
+    return conn.execute("""
+        SELECT id, filepath, mtime_ns, filesize, inode FROM images
+        WHERE content_hash IS NULL
+          AND filesize IN (SELECT filesize FROM images GROUP BY filesize HAVING COUNT(*) > 1)
+        ORDER BY id
+    """).fetchall()
+
+@metrics.timed(QUERY_SECONDS)
+def get_images_without_phash(after_id=0, limit=1000):
+    """Returns up to `limit` (id, filepath) rows without a perceptual hash, in id order after after_id."""
+    conn = get_db_connection()
+    return conn.execute('SELECT id, filepath FROM images WHERE phash IS NULL AND id > ? ORDER BY id LIMIT ?',
+                        (after_id, limit)).fetchall()
+
+@metrics.timed(QUERY_SECONDS)
+def update_hashes_bulk(column, hashes, chunk_size=BULK_CHUNK_SIZE, fingerprints=None):
+    """
+    Stores content_hash or phash values from (image_id, value) pairs. With
+    fingerprints, as for update_llm_tags_bulk, rows rewritten by a scan since
+    they were hashed are skipped. Returns the ids updated.
+    """
+    if column not in ('content_hash', 'phash'):
+        raise ValueError(f"Not a hash column: {column}")
+    conn = get_db_connection()
+    updated = []
+    for chunk in chunked(hashes, chunk_size):
+        with conn:
+            if fingerprints is None:
+                conn.executemany(f"UPDATE images SET {column} = ? WHERE id = ?", [(value, image_id) for image_id, value in chunk])
+                updated.extend(image_id for image_id, _ in chunk)
+                continue
+            for image_id, value in chunk:
+                if conn.execute(f"UPDATE images SET {column} = ? WHERE id = ? AND mtime_ns IS ? AND filesize IS ?",
+                                (value, image_id) + fingerprints[image_id]).rowcount:
+                    updated.append(image_id)
+    return updated
+
+@metrics.timed(QUERY_SECONDS)
+def get_used_content_hashes(content_hashes, chunk_size=500):
+    """Returns the subset of content_hashes that some image still has."""
+    conn = get_db_connection()
+    used = set()
+    for chunk in chunked(set(content_hashes), chunk_size):
+        placeholders = ', '.join('?' for _ in chunk)
+        rows = conn.execute(f"SELECT DISTINCT content_hash FROM images WHERE content_hash IN ({placeholders})", chunk)
+        used.update(row['content_hash'] for row in rows)
+    return used
+
+@metrics.timed(QUERY_SECONDS)
+def get_exact_duplicate_groups():
+    """Returns lists of image rows that share a content hash, each list in id order."""
+    conn = get_db_connection()
+    rows = conn.execute("""
+        SELECT * FROM images
+        WHERE content_hash IN (SELECT content_hash FROM images WHERE content_hash IS NOT NULL
+                               GROUP BY content_hash HAVING COUNT(*) > 1)
+        ORDER BY content_hash, id
+    """).fetchall()
+    groups = {}
+    for row in rows:
+        groups.setdefault(row['content_hash'], []).append(row)
+    return list(groups.values())
+
+@metrics.timed(QUERY_SECONDS)
+def get_perceptual_hashes():
+    """Returns (id, phash) for every image with a perceptual hash."""
+    conn = get_db_connection()
+    return conn.execute('SELECT id, phash FROM images WHERE phash IS NOT NULL').fetchall()
+
+def get_phash_version():
+    """Returns a number that changes whenever any perceptual hash is added, changed or removed."""
+    conn = get_db_connection()
+    return conn.execute('SELECT version FROM phash_version WHERE id = 1').fetchone()['version']
+
+@metrics.timed(QUERY_SECONDS)
+def copy_tags_to_duplicates():
+    """
+    Gives untagged images the tags of an already tagged exact duplicate, so
+    each unique image is sent to the model once. Returns the images tagged
+    this way as (id, filepath, tags) triples.
+    """
+    conn = get_db_connection()
+    rows = conn.execute("""
+        SELECT untagged.id, untagged.filepath, (SELECT tagged.llm_tags FROM images AS tagged
+                             WHERE tagged.content_hash = untagged.content_hash AND tagged.llm_tags IS NOT NULL
+                             LIMIT 1) AS llm_tags
+        FROM images AS untagged
+        WHERE untagged.llm_tags IS NULL AND untagged.content_hash IS NOT NULL
+    """).fetchall()
+    copied = [(row['id'], row['filepath'], row['llm_tags'].split(',')) for row in rows if row['llm_tags'] is not None]
+    if copied:
+        update_llm_tags_bulk((image_id, tags) for image_id, _, tags in copied)
+    return copied
+
+@metrics.timed(QUERY_SECONDS)
+def get_cached_tags(content_hashes, model_version, chunk_size=500):
+    """Returns a dict mapping those of content_hashes the model version has tagged before to their tags."""
+    conn = get_db_connection()
+    cached = {}
+    for chunk in chunked(set(content_hashes), chunk_size):
+        placeholders = ', '.join('?' for _ in chunk)
+        rows = conn.execute(f"SELECT content_hash, tags FROM tag_cache WHERE model_version = ? AND content_hash IN ({placeholders})",
+                            [model_version] + chunk)
+        cached.update((row['content_hash'], row['tags'].split(',') if row['tags'] else []) for row in rows)
+    return cached
+
+@metrics.timed(QUERY_SECONDS)
+def put_cached_tags(entries, model_version):
+    """Stores model output from (content_hash, tags) pairs."""
+    conn = get_db_connection()
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO tag_cache (content_hash, model_version, tags) VALUES (?, ?, ?)',
+                         [(content_hash, model_version, ",".join(tags)) for content_hash, tags in entries])
+
+@metrics.timed(QUERY_SECONDS)
+def delete_cached_tags(model_version=None, keep_version=None):
+    """
+    Invalidates cached model output: of one model version, or of every
+    version except keep_version. Returns the number of entries removed.
+    """
+    conn = get_db_connection()
+    with conn:
+        if model_version is not None:
+            cursor = conn.execute('DELETE FROM tag_cache WHERE model_version = ?', (model_version,))
+        else:
+            cursor = conn.execute('DELETE FROM tag_cache WHERE model_version IS NOT ?', (keep_version,))
+    return cursor.rowcount
+
+@metrics.timed(QUERY_SECONDS)
+def get_unfinished_import(dirs):
+    """Returns the latest unfinished import of the given directories, or None."""
+    conn = get_db_connection()
+    return conn.execute('SELECT * FROM imports WHERE dirs = ? AND finished IS NULL ORDER BY id DESC LIMIT 1',
+                        (json.dumps(sorted(dirs)),)).fetchone()
+
+@metrics.timed(QUERY_SECONDS)
+def start_import(dirs):
+    """Records a new import of the given directories and returns its id."""
+    now = time.time()
+    conn = get_db_connection()
+    with conn:
+        cursor = conn.execute('INSERT INTO imports (dirs, started, updated) VALUES (?, ?, ?)', (json.dumps(sorted(dirs)), now, now))
+    return cursor.lastrowid
+
+@metrics.timed(QUERY_SECONDS)
+def resume_import(import_id):
+    """Counts another run of an interrupted import."""
+    conn = get_db_connection()
+    with conn:
+        conn.execute('UPDATE imports SET runs = runs + 1, updated = ? WHERE id = ?', (time.time(), import_id))
+
+def checkpoint_import(conn, import_id, files, nbytes, seconds):
+    """
+    Adds imported files, bytes and active seconds to an import's totals.
+    Runs on the caller's connection, inside the transaction that inserted them.
+    """
+    conn.execute("""
+        UPDATE imports SET files_imported = files_imported + ?, bytes_imported = bytes_imported + ?,
+            seconds = seconds + ?, updated = ?
+        WHERE id = ?
+    """, (files, nbytes, seconds, time.time(), import_id))
+
+@metrics.timed(QUERY_SECONDS)
+def finish_import(import_id, seconds=0):
+    conn = get_db_connection()
+    with conn:
+        now = time.time()
+        conn.execute('UPDATE imports SET finished = ?, updated = ?, seconds = seconds + ? WHERE id = ?', (now, now, seconds, import_id))
+
+@metrics.timed(QUERY_SECONDS)
+def get_import(import_id):
+    conn = get_db_connection()
+    return conn.execute('SELECT * FROM imports WHERE id = ?', (import_id,)).fetchone()
+
+@metrics.timed(QUERY_SECONDS)
+def get_images_with_stale_metadata(metadata_version, limit=1000):
+    """Returns up to `limit` images whose EXIF fields were read by an older extractor (or never)."""
+    conn = get_db_connection()
+    return conn.execute('SELECT id, filepath FROM images WHERE metadata_version IS NULL OR metadata_version < ? LIMIT ?',
+                        (metadata_version, limit)).fetchall()
+
+@metrics.timed(QUERY_SECONDS)
+def update_metadata_bulk(images, chunk_size=BULK_CHUNK_SIZE):
+    """Rewrites only the EXIF fields (METADATA_COLUMNS) of image dicts, matched by filepath."""
+    conn = get_db_connection()
+    sql = f"UPDATE images SET {', '.join(f'{column} = ?' for column in METADATA_COLUMNS)} WHERE filepath = ?"
+    for chunk in chunked(images, chunk_size):
+        with conn:
+            conn.executemany(sql, [tuple(image.get(column) for column in METADATA_COLUMNS) + (image['filepath'],) for image in chunk])
+
+def _has_location_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'image_locations'").fetchone() is not None
+
+def _filter_clauses(camera_model=None, lens_model=None):
+    clauses, params = [], []
+    if camera_model:
+        clauses.append('images.camera_model = ?')
+        params.append(camera_model)
+    if lens_model:
+        clauses.append('images.lens_model = ?')
+        params.append(lens_model)
+    return clauses, params
+
+@metrics.timed(QUERY_SECONDS)
+def get_images_in_bbox(south, west, north, east, camera_model=None, lens_model=None, limit=GALLERY_PAGE_SIZE):
+    """
+    Returns up to `limit` images taken inside a bounding box, newest first,
+    optionally only from one camera or lens. A box with west > east crosses
+    the antimeridian. The R-tree narrows the box to candidate ids; its
+    coordinates are 32-bit, so matches are confirmed on the exact columns.
+    """
+    conn = get_db_connection()
+    lon_ranges = [(west, east)] if west <= east else [(west, 180.0), (-180.0, east)]
+    clauses, params = _filter_clauses(camera_model, lens_model)
+    boxes = ' OR '.join('(images.longitude BETWEEN ? AND ?)' for _ in lon_ranges)
+    clauses.append(f'images.latitude BETWEEN ? AND ? AND ({boxes})')
+    params += [south, north] + [bound for lon_range in lon_ranges for bound in lon_range]
+    if _has_location_index(conn):
+        candidates = ' UNION ALL '.join(
+            'SELECT id FROM image_locations WHERE min_lat >= ? AND max_lat <= ? AND min_lon >= ? AND max_lon <= ?' for _ in lon_ranges)
+        source = f'images JOIN ({candidates}) AS located ON located.id = images.id'
+        # Widened by the R-tree's rounding so no exact match is dropped
+        params = [bound for low, high in lon_ranges
+                  for bound in (south - 1e-4, north + 1e-4, low - 1e-4, high + 1e-4)] + params
+    else:
+        source = 'images'
+    return conn.execute(f"""
+        SELECT images.* FROM {source}
+        WHERE {' AND '.join(clauses)}
+        ORDER BY images.date_taken DESC, images.id DESC LIMIT ?
+    """, params + [limit]).fetchall()
+
+@metrics.timed(QUERY_SECONDS)
+def get_images_by_camera(camera_model=None, lens_model=None, limit=GALLERY_PAGE_SIZE):
+    """Returns up to `limit` images from a camera and/or lens, newest first."""
+    clauses, params = _filter_clauses(camera_model, lens_model)
+    if not clauses:
+        return []
+    conn = get_db_connection()
+    return conn.execute(f"""
+        SELECT * FROM images WHERE {' AND '.join(clauses)}
+        ORDER BY date_taken DESC, id DESC LIMIT ?
+    """, params + [limit]).fetchall()
+
+@metrics.timed(QUERY_SECONDS)
+def get_camera_counts():
+    """Returns ([(camera_model, count)], [(lens_model, count)]), each by descending count, from their indexes."""
+    conn = get_db_connection()
+    cameras = conn.execute("""
+        SELECT camera_model, COUNT(*) AS count FROM images WHERE camera_model IS NOT NULL
+        GROUP BY camera_model ORDER BY count DESC, camera_model
+    """).fetchall()
+    lenses = conn.execute("""
+        SELECT lens_model, COUNT(*) AS count FROM images WHERE lens_model IS NOT NULL
+        GROUP BY lens_model ORDER BY count DESC, lens_model
+    """).fetchall()
+    return [tuple(row) for row in cameras], [tuple(row) for row in lenses]
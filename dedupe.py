@@ -0,0 +1,275 @@
+"""
+Duplicate detection. Exact duplicates are found by content hash, computed
+only for files whose size collides with another file's (a file of unique
+size cannot have an exact twin). Near duplicates (resized or re-encoded
+copies, bursts) are found by the Hamming distance between 64-bit
+difference hashes (dHash), looked up in a BK-tree.
+"""
+import hashlib
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image, ImageOps
+import database
+import embeddings
+import metrics
+import thumbnails
+
+logger = logging.getLogger(__name__)
+
+DEDUPE_SECONDS = metrics.Histogram('photomanager_dedupe_seconds', 'Duration of duplicate detection steps.', ['step'],
+                                   buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+
+# Threads reading files for content hashes. Hashing is I/O bound and
+# hashlib releases the GIL on large buffers.
+HASH_WORKERS = 4
+
+# Bytes read per call while hashing a file.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Images whose perceptual hash is computed per database query and worker task.
+PHASH_FETCH_SIZE = 1000
+PHASH_CHUNK_SIZE = 32
+
+# Images at most this many differing bits apart are near duplicates.
+NEAR_DUPLICATE_DISTANCE = 6
+
+# dHash compares each pixel with its right neighbour on a 9x8 grayscale grid,
+# giving 64 bits.
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+
+# Perceptual hashes and their BKTree, with the database and phash version they were read at (see _cached_index)
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+def hash_file(filepath):
+    """Returns the BLAKE2b digest of a file's contents, read in chunks."""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def dhash(filepath):
+    """
+    Returns the 64-bit difference hash of an image as an unsigned int. The
+    image is decoded at reduced size (draft mode) and oriented first, so a
+    rotated or resized copy hashes alike.
+    """
+    with Image.open(filepath) as img:
+        img.draft('L', (HASH_WIDTH * 8, HASH_HEIGHT * 8))
+        img = ImageOps.exif_transpose(img).convert('L').resize((HASH_WIDTH, HASH_HEIGHT), Image.Resampling.LANCZOS)
+        pixels = img.tobytes()
+    value = 0
+    for row in range(HASH_HEIGHT):
+        for col in range(HASH_WIDTH - 1):
+            left = pixels[row * HASH_WIDTH + col]
+            right = pixels[row * HASH_WIDTH + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+def to_signed(value):
+    """Maps an unsigned 64-bit hash to the signed range SQLite integers hold."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    """
+    A Burkhard-Keller tree over 64-bit hashes with the Hamming distance.
+    Each child edge is labelled with its distance from the parent, so by the
+    triangle inequality a search only descends into edges within
+    max_distance of the query's distance to the node.
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value, item):
+        # Nodes are [value, items, {distance: child}]
+        self._size += 1
+        if self._root is None:
+            self._root = [value, [item], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Returns (distance, item) for every item within max_distance of value."""
+        results = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, item) for item in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+
+def hash_file_or_none(filepath):
+    """Like hash_file, but logs unreadable files and returns None for them."""
+    try:
+        return hash_file(filepath)
+    except OSError as e:
+        logger.warning("Error hashing %s: %s", filepath, e)
+        return None
+
+def _dhash_chunk(items):
+    """Pool entry point: returns (image_id, signed dHash) for the readable images among (image_id, filepath) pairs."""
+    hashes = []
+    for image_id, filepath in items:
+        try:
+            hashes.append((image_id, to_signed(dhash(filepath))))
+        except Exception as e:
+            logger.warning("Error computing the perceptual hash of %s: %s", filepath, e)
+    return hashes
+
+def record_content_hashes(hashed):
+    """
+    Stores content hashes from (image row, digest) pairs and moves the
+    images' thumbnails to the content-hash key they now share with any
+    duplicate. The rows must carry id, filepath and the fingerprint columns;
+    rows a scan has rewritten since they were read are left alone.
+    """
+    hashed = list(hashed)
+    stored = set(database.update_hashes_bulk('content_hash', [(row['id'], digest) for row, digest in hashed],
+                                             fingerprints={row['id']: (row['mtime_ns'], row['filesize']) for row, _ in hashed}))
+    thumbnails.rekey_to_content_hashes((row['filepath'], (row['mtime_ns'], row['filesize'], row['inode']), digest)
+                                       for row, digest in hashed if row['id'] in stored)
+
+def update_content_hashes(hash_workers=HASH_WORKERS):
+    """
+    Hashes the files whose size collides with another file's and have no
+    content hash yet. Returns the number of files hashed.
+    """
+    rows = database.get_unhashed_size_collisions()
+    if not rows:
+        return 0
+    with DEDUPE_SECONDS.time(step='content_hash'), ThreadPoolExecutor(max_workers=hash_workers) as executor:
+        digests = list(executor.map(hash_file_or_none, [row['filepath'] for row in rows]))
+    hashed = [(row, digest) for row, digest in zip(rows, digests) if digest is not None]
+    record_content_hashes(hashed)
+    return len(hashed)
+
+def update_perceptual_hashes(workers=None):
+    """Computes the dHash of every image that has none yet, in worker processes. Returns the number computed."""
+    rows = database.get_images_without_phash(limit=PHASH_FETCH_SIZE)
+    if not rows:
+        # Skip starting the pool when there is nothing to do, as after most scans
+        return 0
+    computed = 0
+    with DEDUPE_SECONDS.time(step='phash'), ProcessPoolExecutor(max_workers=workers) as executor:
+        while rows:
+            items = [(row['id'], row['filepath']) for row in rows]
+            chunks = [items[start:start + PHASH_CHUNK_SIZE] for start in range(0, len(items), PHASH_CHUNK_SIZE)]
+            for hashes in executor.map(_dhash_chunk, chunks):
+                database.update_hashes_bulk('phash', hashes)
+                computed += len(hashes)
+            rows = database.get_images_without_phash(after_id=rows[-1]['id'], limit=PHASH_FETCH_SIZE)
+    return computed
+
+def update_hashes(workers=None):
+    """
+    Brings duplicate detection up to date after a scan: content hashes for
+    size collisions, perceptual hashes for new and changed images, and tags
+    copied (with their embeddings) from tagged exact duplicates. Returns
+    (hashed, phashed, copied).
+    """
+    hashed = update_content_hashes()
+    phashed = update_perceptual_hashes(workers)
+    copied = database.copy_tags_to_duplicates()
+    embeddings.add_tagged(copied)
+    logger.info("Duplicate detection: %d files content-hashed, %d perceptual hashes, tags copied to %d duplicates.",
+                hashed, phashed, len(copied))
+    return hashed, phashed, len(copied)
+
+def build_index(rows=None):
+    """Returns a BKTree of image ids by perceptual hash, from (id, phash) rows or the database."""
+    tree = BKTree()
+    for row in database.get_perceptual_hashes() if rows is None else rows:
+        tree.add(to_unsigned(row['phash']), row['id'])
+    return tree
+
+def _cached_index():
+    """
+    Returns the (id, phash) rows and their BKTree, rebuilt only when the
+    database or its perceptual hash version changed (in any process) since
+    the last build.
+    """
+    global _index, _index_version
+    version = (database.DB_PATH, database.get_phash_version())
+    with _index_lock:
+        if _index is None or _index_version != version:
+            # The version is read first: a change during the build only causes another rebuild
+            with DEDUPE_SECONDS.time(step='build_index'):
+                rows = database.get_perceptual_hashes()
+                _index = (rows, build_index(rows))
+            _index_version = version
+        return _index
+
+def get_index():
+    """Returns the BKTree of every image's perceptual hash, shared between requests."""
+    return _cached_index()[1]
+
+def find_similar(image_id, max_distance=NEAR_DUPLICATE_DISTANCE, index=None):
+    """Returns (distance, image_id) for the images near image_id, closest first, excluding itself."""
+    image = database.get_image_by_id(image_id)
+    if image is None or image['phash'] is None:
+        return []
+    if index is None:
+        index = get_index()
+    return sorted(match for match in index.search(to_unsigned(image['phash']), max_distance) if match[1] != image_id)
+
+def find_near_duplicates(max_distance=NEAR_DUPLICATE_DISTANCE):
+    """
+    Groups images whose perceptual hashes are within max_distance of each
+    other, transitively. Returns lists of image ids, each in id order, for
+    groups of two or more.
+    """
+    rows, index = _cached_index()
+    parents = {}
+
+    def find(item):
+        root = item
+        while parents.get(root, root) != root:
+            root = parents[root]
+        # Path compression
+        while item != root:
+            parents[item], item = root, parents[item]
+        return root
+
+    with DEDUPE_SECONDS.time(step='near_duplicates'):
+        for row in rows:
+            for _, other in index.search(to_unsigned(row['phash']), max_distance):
+                a, b = find(row['id']), find(other)
+                if a != b:
+                    parents[max(a, b)] = min(a, b)
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(find(row['id']), []).append(row['id'])
+    return [sorted(group) for group in groups.values() if len(group) > 1]
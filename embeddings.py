@@ -0,0 +1,403 @@
+"""
+Semantic search. When enabled, the tagger stores a fixed-size embedding
+per image in an append-only, memory-mapped float32 matrix, and queries are
+ranked by cosine similarity with chunked NumPy matrix products. Above
+IVF_MIN_VECTORS an inverted-file (IVF) index, built with spherical k-means,
+narrows each query to the vectors of the closest few clusters.
+
+NumPy is optional: without it semantic search is unavailable and tag
+search works as before.
+"""
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import threading
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SEARCH_SECONDS = metrics.Histogram('photomanager_semantic_search_seconds', 'Duration of semantic searches, by strategy.', ['index'])
+
+# Whether the tagger computes embeddings; set from the semantic_search setting.
+ENABLED = False
+
+# Base path of the store; '.f32', '.ids', '.json' and '.lock' are appended.
+STORE_PATH = 'photo_library_embeddings'
+
+# Results returned by a search unless the caller asks for another number.
+DEFAULT_LIMIT = 100
+
+# Rows scored per matrix product in exhaustive search, which bounds the
+# temporary memory a query needs however large the store grows.
+SEARCH_CHUNK_ROWS = 65536
+
+# Below this many vectors an exhaustive scan takes a few milliseconds and
+# no IVF index is built.
+IVF_MIN_VECTORS = 50000
+
+# Clusters searched per query. More probes find more of the true nearest
+# neighbours at a proportional cost.
+IVF_PROBES = 8
+
+# The index is rebuilt in the background once this fraction of vectors was
+# added after it was built; until then they are scanned exhaustively.
+IVF_REBUILD_FRACTION = 0.1
+
+# Vectors sampled to train the cluster centroids, and k-means iterations.
+IVF_TRAIN_SAMPLE = 50000
+IVF_ITERATIONS = 10
+
+# Rows assigned to centroids per matrix product while building the index.
+ASSIGN_CHUNK_ROWS = 8192
+
+# Tagged images embedded per batch when back-filling the store.
+BACKFILL_BATCH_SIZE = 256
+
+_store = None
+_embedder = None
+_store_lock = threading.Lock()
+
+
+def available():
+    """Returns whether semantic search can be used (NumPy is installed)."""
+    return np is not None
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+@functools.lru_cache(maxsize=65536)
+def _feature(token, dim):
+    seed = int.from_bytes(hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+    return np.random.default_rng(seed).standard_normal(dim, dtype=np.float32)
+
+
+class HashingEmbedder:
+    """
+    Deterministic, dependency-free stand-in for an embedding model. Text is
+    embedded as the sum of pseudo-random vectors seeded by its words and
+    their character trigrams, so related spellings ("cat", "cats") land
+    close together, and an image as the text of its tags. A real model
+    (e.g. CLIP) would embed pixels and queries into a shared space and
+    ignore the tags; it needs the same dim, version, embed_text and
+    embed_images.
+    """
+
+    version = 'hashing-1'
+
+    def __init__(self, dim=128):
+        self.dim = dim
+
+    def embed_text(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()):
+            vector += _feature(f"w:{word}", self.dim)
+            padded = f" {word} "
+            for start in range(len(padded) - 2):
+                vector += 0.5 * _feature(f"t:{padded[start:start + 3]}", self.dim)
+        return _normalize(vector)
+
+    def embed_images(self, image_paths, tags):
+        """Returns one embedding per image as an (n, dim) array; tags holds each image's tag list."""
+        if not image_paths:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack([self.embed_text(' '.join(image_tags)) for image_tags in tags])
+
+
+class IVFIndex:
+    """
+    Inverted-file index over the first `size` rows of a vector matrix: rows
+    are grouped by their closest centroid, and a query only scores the rows
+    of its closest clusters.
+    """
+
+    def __init__(self, centroids, order, offsets, size):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.size = size
+
+    @classmethod
+    def build(cls, vectors, nlist=None, iterations=IVF_ITERATIONS, sample_size=IVF_TRAIN_SAMPLE, seed=0):
+        size = len(vectors)
+        nlist = min(nlist or max(1, int(math.sqrt(size))), size)
+        rng = np.random.default_rng(seed)
+        # Sorted, so sampling reads the memory map front to back
+        sample = np.asarray(vectors[np.sort(rng.choice(size, min(size, sample_size), replace=False))])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = _assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            # Spherical k-means: centroids are renormalized means; empty clusters keep theirs
+            filled = np.bincount(assignments, minlength=nlist) > 0
+            centroids[filled] = _normalize(sums[filled])
+        assignments = _assign(vectors, centroids)
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.searchsorted(assignments[order], np.arange(nlist + 1))
+        return cls(centroids, order, offsets, size)
+
+    def candidates(self, query, probes=IVF_PROBES):
+        """Returns the sorted row numbers in the `probes` clusters closest to the query."""
+        probes = min(probes, len(self.centroids))
+        closest = np.argpartition(-(self.centroids @ query), probes - 1)[:probes]
+        return np.sort(np.concatenate([self.order[self.offsets[cluster]:self.offsets[cluster + 1]] for cluster in closest]))
+
+def _assign(vectors, centroids):
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_CHUNK_ROWS):
+        chunk = np.asarray(vectors[start:start + ASSIGN_CHUNK_ROWS])
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+class EmbeddingStore:
+    """
+    Normalized float32 vectors in an append-only file, memory mapped for
+    search, with the image id of each row in a parallel int64 file. A
+    re-embedded image gets a new row that supersedes its old one. The
+    files are reset when the model (its version or dimension) changes, as
+    vectors of different models cannot be compared. Writers in different
+    processes take turns under a lock file (on systems with fcntl), and
+    each write first cuts off any partial rows a crashed writer left.
+    """
+
+    def __init__(self, path, dim, model_version):
+        self.path = path
+        self.dim = dim
+        self.model_version = model_version
+        self._lock = threading.Lock()
+        self._count = 0
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._live = np.zeros(0, dtype=bool)
+        self._rows = {}
+        self._ivf = None
+        self._building = False
+        with self._file_lock():
+            self._check_model()
+            self._truncate_partial_rows()
+
+    def _check_model(self):
+        meta = {'dim': self.dim, 'model_version': self.model_version}
+        try:
+            with open(f"{self.path}.json") as f:
+                stored = json.load(f)
+        except (FileNotFoundError, ValueError):
+            stored = None
+        if stored != meta:
+            if stored is not None:
+                logger.info("Embedding model changed to %s; discarding stored embeddings.", self.model_version)
+            for extension in ('.f32', '.ids'):
+                try:
+                    os.remove(self.path + extension)
+                except FileNotFoundError:
+                    pass
+            with open(f"{self.path}.json", 'w') as f:
+                json.dump(meta, f)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Holds the store's lock file exclusively, so one process at a time writes."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _truncate_partial_rows(self):
+        """
+        Cuts both files back to the rows complete in both: a writer that
+        crashed after appending vectors but before their ids would otherwise
+        shift every later vector off its id. Called with the file lock held.
+        """
+        sizes = {}
+        for extension in ('.f32', '.ids'):
+            try:
+                sizes[extension] = os.path.getsize(self.path + extension)
+            except FileNotFoundError:
+                sizes[extension] = 0
+        rows = min(sizes['.f32'] // (self.dim * 4), sizes['.ids'] // 8)
+        for extension, row_size in (('.f32', self.dim * 4), ('.ids', 8)):
+            if sizes[extension] != rows * row_size:
+                logger.warning("Discarding %d bytes of an interrupted write to %s.",
+                               sizes[extension] - rows * row_size, self.path + extension)
+                os.truncate(self.path + extension, rows * row_size)
+
+    def _refresh(self):
+        """Maps rows appended since the last call, also by other processes. Called with the lock held."""
+        try:
+            count = os.path.getsize(f"{self.path}.ids") // 8
+        except FileNotFoundError:
+            count = 0
+        if count == self._count:
+            return
+        new_ids = np.fromfile(f"{self.path}.ids", dtype=np.int64, count=count - self._count, offset=self._count * 8)
+        live = np.concatenate([self._live, np.ones(len(new_ids), dtype=bool)])
+        for row, image_id in enumerate(new_ids.tolist(), start=self._count):
+            previous = self._rows.get(image_id)
+            if previous is not None:
+                live[previous] = False
+            self._rows[image_id] = row
+        self._vectors = np.memmap(f"{self.path}.f32", dtype=np.float32, mode='r', shape=(count, self.dim))
+        self._ids = np.concatenate([self._ids, new_ids])
+        self._live = live
+        self._count = count
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._rows)
+
+    def __contains__(self, image_id):
+        with self._lock:
+            self._refresh()
+            return image_id in self._rows
+
+    def add(self, image_ids, vectors):
+        """Stores one vector per image id, replacing any earlier vector of the same image."""
+        image_ids = np.asarray(list(image_ids), dtype=np.int64)
+        if not len(image_ids):
+            return
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32).reshape(len(image_ids), self.dim))
+        with self._lock, self._file_lock():
+            self._truncate_partial_rows()
+            # Vectors first: a row only exists once its id is written
+            with open(f"{self.path}.f32", 'ab') as f:
+                vectors.tofile(f)
+            with open(f"{self.path}.ids", 'ab') as f:
+                image_ids.tofile(f)
+            self._refresh()
+
+    def build_index(self):
+        """Builds the IVF index over every row stored so far, in the calling thread."""
+        with self._lock:
+            self._refresh()
+            vectors = self._vectors
+        index = IVFIndex.build(vectors)
+        with self._lock:
+            self._ivf = index
+            self._building = False
+        logger.info("Built an IVF index of %d clusters over %d embeddings.", len(index.centroids), index.size)
+
+    def _maybe_rebuild_index(self):
+        # Called with the lock held
+        stale = self._ivf is None or self._count - self._ivf.size > IVF_REBUILD_FRACTION * self._ivf.size
+        if self._count >= IVF_MIN_VECTORS and stale and not self._building:
+            self._building = True
+            threading.Thread(target=self.build_index, daemon=True).start()
+
+    def search(self, query, limit=DEFAULT_LIMIT, probes=IVF_PROBES, exhaustive=False):
+        """
+        Returns up to `limit` (image_id, score) pairs for the vectors most
+        similar to the query vector, best first. Uses the IVF index when one
+        is built (rows added since are scanned too) unless exhaustive.
+        """
+        query = _normalize(np.asarray(query, dtype=np.float32))
+        with self._lock:
+            self._refresh()
+            if not exhaustive:
+                self._maybe_rebuild_index()
+            vectors, ids, live, ivf, count = self._vectors, self._ids, self._live, self._ivf, self._count
+        if not count:
+            return []
+
+        if ivf is not None and not exhaustive:
+            with SEARCH_SECONDS.time(index='ivf'):
+                rows = np.concatenate([ivf.candidates(query, probes), np.arange(ivf.size, count)])
+                rows = rows[live[rows]]
+                scores = np.asarray(vectors[rows]) @ query
+                return _top(ids[rows], scores, limit)
+
+        with SEARCH_SECONDS.time(index='exhaustive'):
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, SEARCH_CHUNK_ROWS):
+                np.matmul(vectors[start:start + SEARCH_CHUNK_ROWS], query, out=scores[start:start + SEARCH_CHUNK_ROWS])
+            scores[~live] = -np.inf
+            return _top(ids, scores, limit)
+
+def _top(ids, scores, limit):
+    """Returns the (image_id, score) pairs of the `limit` highest finite scores, best first."""
+    if len(scores) > limit:
+        best = np.argpartition(-scores, limit - 1)[:limit]
+    else:
+        best = np.arange(len(scores))
+    best = best[np.argsort(-scores[best], kind='stable')]
+    return [(int(ids[i]), float(scores[i])) for i in best if np.isfinite(scores[i])]
+
+
+def configure(enabled=False, path=None, embedder=None):
+    """Enables or disables embeddings and sets the store location and model; the store is reopened on next use."""
+    global ENABLED, STORE_PATH, _embedder, _store
+    ENABLED = enabled and available()
+    if enabled and not available():
+        logger.warning("Semantic search needs NumPy (pip install numpy); it stays disabled.")
+    if path is not None:
+        STORE_PATH = path
+    if embedder is not None:
+        _embedder = embedder
+    with _store_lock:
+        _store = None
+
+def get_embedder():
+    global _embedder
+    if _embedder is None:
+        _embedder = HashingEmbedder()
+    return _embedder
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            embedder = get_embedder()
+            _store = EmbeddingStore(STORE_PATH, embedder.dim, embedder.version)
+        return _store
+
+def embed_images(image_paths, tags):
+    return get_embedder().embed_images(image_paths, tags)
+
+def search(text, limit=DEFAULT_LIMIT):
+    """Returns up to `limit` (image_id, score) pairs for the images closest to a text query, best first."""
+    return get_store().search(get_embedder().embed_text(text), limit)
+
+def add_tagged(images, batch_size=BACKFILL_BATCH_SIZE):
+    """
+    Embeds images that were tagged without a model request (copied from an
+    exact duplicate), given as (id, filepath, tags) triples, if enabled.
+    """
+    if not ENABLED:
+        return
+    store = get_store()
+    for batch in database.chunked(images, batch_size):
+        store.add([image_id for image_id, _, _ in batch],
+                  embed_images([filepath for _, filepath, _ in batch], [tags for _, _, tags in batch]))
+
+def backfill(batch_size=BACKFILL_BATCH_SIZE):
+    """Embeds tagged images that have no embedding yet, e.g. those tagged before embeddings were enabled. Returns the number added."""
+    store = get_store()
+    added = 0
+    last_id = 0
+    while True:
+        images = database.get_tagged_images(after_id=last_id, limit=batch_size)
+        if not images:
+            return added
+        last_id = images[-1]['id']
+        missing = [image for image in images if image['id'] not in store]
+        if missing:
+            store.add([image['id'] for image in missing],
+                      embed_images([image['filepath'] for image in missing], [image['llm_tags'].split(',') for image in missing]))
+            added += len(missing)
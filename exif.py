@@ -0,0 +1,220 @@
+"""
+Header-only image metadata. Reads the dimensions and the EXIF block of
+JPEG and PNG files by walking their segments or chunks up to the image
+data, so a scan never decodes pixels or loads the file into memory, and
+parses the TIFF structure of the EXIF block for the date taken (with its
+UTC offset), camera, lens, orientation and GPS position.
+"""
+import re
+import struct
+from datetime import datetime
+
+# TIFF tags, by IFD
+MAKE = 0x010F
+MODEL = 0x0110
+ORIENTATION = 0x0112
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+DATE_TIME_ORIGINAL = 0x9003
+OFFSET_TIME_ORIGINAL = 0x9011
+LENS_MODEL = 0xA434
+GPS_LATITUDE_REF = 0x0001
+GPS_LATITUDE = 0x0002
+GPS_LONGITUDE_REF = 0x0003
+GPS_LONGITUDE = 0x0004
+
+IFD0_TAGS = frozenset({MAKE, MODEL, ORIENTATION, EXIF_IFD_POINTER, GPS_IFD_POINTER, DATE_TIME_ORIGINAL})
+EXIF_TAGS = frozenset({DATE_TIME_ORIGINAL, OFFSET_TIME_ORIGINAL, LENS_MODEL})
+GPS_TAGS = frozenset({GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE})
+
+# Bytes per value of each TIFF field type
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+TYPE_FORMATS = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 11: 'f', 12: 'd'}
+
+# JPEG start-of-frame markers, which carry the dimensions (not DHT, JPG or DAC)
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+OFFSET_PATTERN = re.compile(r'^[+-]\d{2}:\d{2}$')
+
+# Fields returned by read_metadata besides the dimensions; None when absent.
+FIELDS = ('date_taken', 'date_offset', 'camera_make', 'camera_model', 'lens_model', 'orientation', 'latitude', 'longitude')
+
+
+def _read_ifd(data, offset, endian, wanted):
+    """Returns {tag: value} for the wanted tags of the IFD at offset; values of several items are tuples."""
+    values = {}
+    try:
+        (count,) = struct.unpack_from(endian + 'H', data, offset)
+    except struct.error:
+        return values
+    for entry in range(offset + 2, offset + 2 + count * 12, 12):
+        try:
+            tag, field_type, items = struct.unpack_from(endian + 'HHI', data, entry)
+            if tag not in wanted or field_type not in TYPE_SIZES:
+                continue
+            size = TYPE_SIZES[field_type] * items
+            # Values of up to four bytes are stored in the entry itself
+            start = entry + 8 if size <= 4 else struct.unpack_from(endian + 'I', data, entry + 8)[0]
+            if start + size > len(data):
+                continue
+            raw = data[start:start + size]
+        except struct.error:
+            break
+        if field_type in (2, 7):
+            values[tag] = raw.split(b'\0', 1)[0].decode('utf-8', 'replace').strip()
+            continue
+        if field_type in (5, 10):
+            pairs = struct.unpack(endian + ('I' if field_type == 5 else 'i') * (2 * items), raw)
+            value = tuple(num / den if den else None for num, den in zip(pairs[::2], pairs[1::2]))
+        else:
+            value = struct.unpack(endian + TYPE_FORMATS[field_type] * items, raw)
+        values[tag] = value[0] if items == 1 else value
+    return values
+
+def parse_tiff(data):
+    """
+    Parses an EXIF block (a TIFF header and IFDs). Returns the IFD0, Exif
+    and GPS tags this module uses, merged into one {tag: value} dict.
+    """
+    if data[:2] == b'II':
+        endian = '<'
+    elif data[:2] == b'MM':
+        endian = '>'
+    else:
+        return {}
+    try:
+        magic, offset = struct.unpack_from(endian + 'HI', data, 2)
+    except struct.error:
+        return {}
+    if magic != 42:
+        return {}
+    tags = _read_ifd(data, offset, endian, IFD0_TAGS)
+    if isinstance(tags.get(EXIF_IFD_POINTER), int):
+        tags.update(_read_ifd(data, tags[EXIF_IFD_POINTER], endian, EXIF_TAGS))
+    if isinstance(tags.get(GPS_IFD_POINTER), int):
+        tags.update(_read_ifd(data, tags[GPS_IFD_POINTER], endian, GPS_TAGS))
+    return tags
+
+def _read_jpeg(f):
+    """Returns (width, height, EXIF block or None), reading the segments before the image data."""
+    exif = None
+    while True:
+        byte = f.read(1)
+        if not byte:
+            break
+        if byte != b'\xff':
+            continue
+        marker = f.read(1)
+        while marker == b'\xff':
+            marker = f.read(1)
+        if not marker:
+            break
+        code = marker[0]
+        if code == 0x01 or code == 0xD8 or 0xD0 <= code <= 0xD7:
+            continue  # markers without a length
+        if code in (0xD9, 0xDA):
+            break  # end of image or start of scan: no dimensions before the image data
+        header = f.read(2)
+        if len(header) < 2:
+            break
+        length = struct.unpack('>H', header)[0] - 2
+        if code == 0xE1 and exif is None:
+            segment = f.read(length)
+            if segment.startswith(b'Exif\0\0'):
+                exif = segment[6:]
+        elif code in SOF_MARKERS:
+            frame = f.read(5)
+            if len(frame) < 5:
+                break
+            height, width = struct.unpack('>xHH', frame)
+            # The EXIF block precedes the frame header, so nothing else is needed
+            return width, height, exif
+        else:
+            f.seek(length, 1)
+    raise ValueError('No JPEG frame header found')
+
+def _read_png(f):
+    """Returns (width, height, EXIF block or None), reading the chunks before the image data."""
+    header = f.read(8)
+    if len(header) < 8:
+        raise ValueError('Truncated PNG')
+    length, chunk_type = struct.unpack('>I4s', header)
+    if chunk_type != b'IHDR':
+        raise ValueError('PNG without IHDR')
+    width, height = struct.unpack('>II', f.read(8))
+    f.seek(length - 8 + 4, 1)  # rest of IHDR, CRC
+    exif = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type in (b'IDAT', b'IEND'):
+            break
+        if chunk_type == b'eXIf':
+            exif = f.read(length)
+            break
+        f.seek(length + 4, 1)
+    return width, height, exif
+
+def _date(value):
+    try:
+        return datetime.strptime(value, '%Y:%m:%d %H:%M:%S').isoformat()
+    except (TypeError, ValueError):
+        return None
+
+def _coordinate(value, ref, limit):
+    """Converts degrees, minutes and seconds with an N/S or E/W reference to signed decimal degrees."""
+    if not isinstance(value, tuple) or len(value) != 3 or None in value:
+        return None
+    degrees = value[0] + value[1] / 60 + value[2] / 3600
+    if ref in ('S', 'W'):
+        degrees = -degrees
+    return round(degrees, 7) if abs(degrees) <= limit else None
+
+def _text(value):
+    return value if isinstance(value, str) and value else None
+
+def metadata_from_tags(tags):
+    """Maps parsed EXIF tags to the FIELDS stored for an image."""
+    orientation = tags.get(ORIENTATION)
+    offset = tags.get(OFFSET_TIME_ORIGINAL)
+    latitude = _coordinate(tags.get(GPS_LATITUDE), tags.get(GPS_LATITUDE_REF), 90)
+    longitude = _coordinate(tags.get(GPS_LONGITUDE), tags.get(GPS_LONGITUDE_REF), 180)
+    return {
+        'date_taken': _date(tags.get(DATE_TIME_ORIGINAL)),
+        'date_offset': offset if isinstance(offset, str) and OFFSET_PATTERN.match(offset) else None,
+        'camera_make': _text(tags.get(MAKE)),
+        'camera_model': _text(tags.get(MODEL)),
+        'lens_model': _text(tags.get(LENS_MODEL)),
+        'orientation': orientation if isinstance(orientation, int) and 1 <= orientation <= 8 else None,
+        # A position needs both coordinates
+        'latitude': latitude if longitude is not None else None,
+        'longitude': longitude if latitude is not None else None,
+    }
+
+def read_metadata(filepath):
+    """
+    Returns the width, height and FIELDS of a JPEG or PNG file, read from
+    its header. Raises ValueError for other formats and for truncated or
+    malformed headers (callers fall back to PIL) and OSError if the file
+    cannot be read.
+    """
+    with open(filepath, 'rb') as f:
+        signature = f.read(8)
+        try:
+            if signature[:2] == b'\xff\xd8':
+                f.seek(2)
+                width, height, block = _read_jpeg(f)
+            elif signature == PNG_SIGNATURE:
+                width, height, block = _read_png(f)
+            else:
+                raise ValueError('Not a JPEG or PNG file')
+            tags = parse_tiff(block) if block else {}
+        except struct.error as e:
+            raise ValueError(f"Malformed header: {e}") from e
+    metadata = metadata_from_tags(tags)
+    metadata['width'] = width
+    metadata['height'] = height
+    return metadata
@@ -0,0 +1,174 @@
+"""
+Headless bulk import for large libraries, without the web app. Adds the
+directories to the library (config.json), scans them with the regular
+scanner and prints throughput as it goes. A running web server or worker
+keeps the library it loaded at startup until it is restarted; its scans
+leave images outside that library alone. Progress is checkpointed in the
+database with every commit; if the import is interrupted, running the same
+command again resumes it, skipping every file already committed without
+opening it.
+
+    python import_cli.py /mnt/photos --workers 8 --checkpoint-every 2000
+    python import_cli.py /mnt/photos --no-thumbnails --report-interval 30
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+import database
+import scan_jobs
+import scanner
+import thumbnails
+
+logger = logging.getLogger(__name__)
+
+# Seconds between throughput reports.
+REPORT_INTERVAL = 10
+
+
+def format_bytes(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if nbytes < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes /= 1024
+    return f"{nbytes:.1f} TB"
+
+
+class ImportProgress:
+    """
+    Files and bytes committed by an import, across all of its runs, and the
+    throughput of the current run. checkpoint() is the scanner's commit
+    hook; it records the totals in the same transaction as the rows.
+    """
+
+    def __init__(self, import_record):
+        self.import_id = import_record['id']
+        self.files = import_record['files_imported']
+        self.bytes = import_record['bytes_imported']
+        self.previous_seconds = import_record['seconds']
+        self.run_files = 0
+        self.run_bytes = 0
+        self._started = time.monotonic()
+        self._last_checkpoint = self._started
+        self._lock = threading.Lock()
+
+    def checkpoint(self, conn, chunk):
+        now = time.monotonic()
+        nbytes = sum(image.get('filesize') or 0 for image in chunk)
+        database.checkpoint_import(conn, self.import_id, len(chunk), nbytes, now - self._last_checkpoint)
+        with self._lock:
+            self.files += len(chunk)
+            self.bytes += nbytes
+            self.run_files += len(chunk)
+            self.run_bytes += nbytes
+            self._last_checkpoint = now
+
+    def unrecorded_seconds(self):
+        """Seconds since the last checkpoint, added to the total when the import finishes."""
+        return time.monotonic() - self._last_checkpoint
+
+    def report(self, status=None):
+        """Returns a one-line summary with this run's files/sec and MB/sec."""
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            files_per_sec = self.run_files / elapsed if elapsed > 0 else 0
+            mb_per_sec = self.run_bytes / (1024 * 1024) / elapsed if elapsed > 0 else 0
+            line = (f"{self.files:,} files imported ({format_bytes(self.bytes)}) | "
+                    f"{files_per_sec:,.1f} files/s, {mb_per_sec:,.1f} MB/s")
+        if status is not None:
+            snapshot = status.snapshot()
+            line += f" | {snapshot['progress']:,} of {snapshot['total']:,} files read, phase {snapshot['phase'] or '-'}"
+            if snapshot['error_count']:
+                line += f", {snapshot['error_count']:,} errors"
+        return line
+
+
+def _report_until(stop, progress, status, interval, out):
+    while not stop.wait(interval):
+        print(progress.report(status), file=out, flush=True)
+
+def run_import(dir_list, workers=scanner.DEFAULT_WORKERS, traversal_workers=scanner.DEFAULT_TRAVERSAL_WORKERS,
+               checkpoint_every=database.BULK_CHUNK_SIZE, report_interval=REPORT_INTERVAL, restart=False, out=sys.stdout):
+    """
+    Scans dir_list, resuming the unfinished import of the same directories
+    unless restart is set. Returns the finished import's record.
+    """
+    record = None if restart else database.get_unfinished_import(dir_list)
+    if record is None:
+        record = database.get_import(database.start_import(dir_list))
+        print(f"Starting import {record['id']} of {', '.join(dir_list)}", file=out)
+    else:
+        database.resume_import(record['id'])
+        print(f"Resuming import {record['id']}: {record['files_imported']:,} files "
+              f"({format_bytes(record['bytes_imported'])}) already imported", file=out)
+
+    progress = ImportProgress(record)
+    status = scan_jobs.ScanStatus()
+    stop = threading.Event()
+    reporter = threading.Thread(target=_report_until, args=(stop, progress, status, report_interval, out), daemon=True)
+    reporter.start()
+    try:
+        scanner.scan_directories(dir_list, status, workers, traversal_workers,
+                                 checkpoint=progress.checkpoint, checkpoint_every=checkpoint_every)
+    finally:
+        stop.set()
+        reporter.join()
+
+    database.finish_import(record['id'], progress.unrecorded_seconds())
+    record = database.get_import(record['id'])
+    print(progress.report(status), file=out)
+    print(status['message'], file=out)
+    if record['seconds'] > 0:
+        print(f"Import {record['id']} finished in {record['runs']} run(s): {record['files_imported']:,} files, "
+              f"{format_bytes(record['bytes_imported'])} at {record['files_imported'] / record['seconds']:,.1f} files/s overall",
+              file=out)
+    return record
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Imports photo directories into the library without the web app.')
+    parser.add_argument('dirs', nargs='*', help='directories to add (default: rescan the configured library)')
+    parser.add_argument('--workers', type=int, help='metadata extraction processes (default: scan_workers from config.json, else one per CPU)')
+    parser.add_argument('--traversal-workers', type=int, default=scanner.DEFAULT_TRAVERSAL_WORKERS,
+                        help='threads listing directories (default: %(default)s)')
+    parser.add_argument('--checkpoint-every', type=int, default=database.BULK_CHUNK_SIZE,
+                        help='files per commit and checkpoint (default: %(default)s)')
+    parser.add_argument('--report-interval', type=float, default=REPORT_INTERVAL, help='seconds between throughput reports')
+    parser.add_argument('--restart', action='store_true', help='start over instead of resuming an interrupted import')
+    parser.add_argument('--no-thumbnails', action='store_true', help='skip background thumbnail rendering during the import')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # Shares config.json (library, database, thumbnail store) with the web server
+    import app
+    app.load_config()
+    database.create_table()
+
+    new_dirs = [os.path.abspath(directory) for directory in args.dirs]
+    for directory in new_dirs:
+        if not os.path.isdir(directory):
+            parser.error(f"not a directory: {directory}")
+    # Only the given directories are scanned (a scan leaves images elsewhere
+    # alone); they join the library for later scans.
+    library = list(dict.fromkeys(app.IMAGE_DIRS + new_dirs))
+    if not library:
+        parser.error('no directories given and none configured')
+    if library != app.IMAGE_DIRS:
+        app.IMAGE_DIRS = library
+        app.save_config()
+        print("Added to the library in config.json. Restart the web server and workers so they watch and rescan "
+              "the new directories, and so saving settings there does not drop them.", file=sys.stderr)
+    if args.no_thumbnails:
+        thumbnails.WARM_ON_SCAN = False
+
+    try:
+        run_import(new_dirs or library, args.workers or app.SCAN_WORKERS, args.traversal_workers, args.checkpoint_every,
+                   args.report_interval, args.restart)
+    except KeyboardInterrupt:
+        print("Interrupted. Run the same command again to resume.", file=sys.stderr)
+        return 130
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
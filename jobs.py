@@ -0,0 +1,360 @@
+"""
+Durable job queue in the library database, so scans, thumbnail rendering
+and tagging can run in worker processes (worker.py) separate from the web
+server. Workers claim the highest-priority due job under a lease that they
+extend while it runs; a job whose worker dies is picked up again once its
+lease expires. Failed jobs are retried with exponential backoff up to
+their max_attempts.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import database
+
+logger = logging.getLogger(__name__)
+
+# Seconds a claimed job stays leased without a heartbeat. Workers renew the
+# lease every LEASE_SECONDS / 4.
+LEASE_SECONDS = 60
+
+# Delay before the first retry of a failed job; doubled for every further attempt.
+RETRY_DELAY_SECONDS = 30
+
+# Finished jobs are kept this long for the status pages, then pruned.
+KEEP_FINISHED_SECONDS = 7 * 24 * 3600
+
+# Higher runs first. Thumbnails are what users wait for; tagging can lag.
+PRIORITY_THUMBNAILS = 20
+PRIORITY_SCAN = 10
+PRIORITY_TAG = 0
+
+# How often a worker persists a running job's progress, and how often
+# readers in other processes poll it.
+PROGRESS_INTERVAL = 1.0
+STATUS_POLL_INTERVAL = 0.5
+
+# Finished scans shown on the settings page.
+HISTORY_SIZE = 10
+
+# The watch job runs for as long as its worker does and is handed over when
+# a worker stops or crashes, so it is given many attempts.
+WATCH_MAX_ATTEMPTS = 1000
+
+
+class LeaseLost(Exception):
+    """Raised inside a job whose worker no longer holds its lease, to stop work that another worker may now be doing."""
+
+
+def _job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job['payload'] = json.loads(job['payload'])
+    job['progress'] = json.loads(job['progress']) if job['progress'] else None
+    return job
+
+def new_worker_id():
+    """Returns a lease owner id that identifies this process in the jobs table."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+def enqueue(kind, payload=None, priority=0, unique_key=None, delay=0, max_attempts=3):
+    """
+    Adds a job and returns its id. If a job with the same unique_key is
+    already queued (not yet running), it is updated instead: it takes the
+    new payload, the earlier due time and the higher priority, so repeated
+    requests coalesce into one job. Jobs sharing a unique_key also never
+    run at the same time, even in different worker processes.
+    """
+    now = time.time()
+    conn = database.get_db_connection()
+    with conn:
+        row = conn.execute("""
+            INSERT INTO jobs (kind, payload, priority, unique_key, max_attempts, run_after, created)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (unique_key) WHERE status = 'queued' DO UPDATE SET
+                payload = excluded.payload,
+                priority = MAX(priority, excluded.priority),
+                run_after = MIN(run_after, excluded.run_after)
+            RETURNING id
+        """, (kind, json.dumps(payload or {}), priority, unique_key, max_attempts, now + delay, now)).fetchone()
+    return row['id']
+
+def _expire_leases(conn, now):
+    """Requeues (or fails, when out of attempts) running jobs whose worker stopped renewing the lease."""
+    conn.execute("""
+        UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+            error = 'Lease expired (worker stopped)', lease_owner = NULL, lease_expires = NULL,
+            finished = CASE WHEN attempts >= max_attempts THEN ? END
+        WHERE status = 'running' AND lease_expires < ?
+          AND (unique_key IS NULL OR attempts >= max_attempts
+               OR NOT EXISTS (SELECT 1 FROM jobs AS queued WHERE queued.unique_key = jobs.unique_key AND queued.status = 'queued'))
+    """, (now, now))
+    # A job that cannot be requeued because a successor is already queued is superseded by it
+    conn.execute("""
+        UPDATE jobs SET status = 'failed', error = 'Lease expired (superseded)', finished = ?
+        WHERE status = 'running' AND lease_expires < ?
+    """, (now, now))
+
+def claim(worker_id, kinds, lease_seconds=LEASE_SECONDS):
+    """Leases the highest-priority due job of one of the given kinds to the worker. Returns the job, or None."""
+    now = time.time()
+    kinds = list(kinds)
+    placeholders = ', '.join('?' for _ in kinds)
+    conn = database.get_db_connection()
+    with conn:
+        _expire_leases(conn, now)
+        row = conn.execute(f"""
+            UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1
+            WHERE id = (SELECT id FROM jobs WHERE status = 'queued' AND run_after <= ? AND kind IN ({placeholders})
+                          AND (unique_key IS NULL OR NOT EXISTS (SELECT 1 FROM jobs AS running
+                                                                 WHERE running.unique_key = jobs.unique_key AND running.status = 'running'))
+                        ORDER BY priority DESC, id LIMIT 1)
+            RETURNING *
+        """, [worker_id, now + lease_seconds, now] + kinds).fetchone()
+    return _job(row)
+
+def heartbeat(job_id, worker_id, progress=None, lease_seconds=LEASE_SECONDS):
+    """Renews a job's lease and optionally stores its progress. Returns False if the worker no longer holds the lease."""
+    conn = database.get_db_connection()
+    with conn:
+        cursor = conn.execute("""
+            UPDATE jobs SET lease_expires = ?, progress = COALESCE(?, progress)
+            WHERE id = ? AND lease_owner = ? AND status = 'running'
+        """, (time.time() + lease_seconds, json.dumps(progress) if progress is not None else None, job_id, worker_id))
+    return cursor.rowcount == 1
+
+def complete(job_id, worker_id, progress=None):
+    """Marks a job done. Returns False, changing nothing, if the worker no longer holds its lease."""
+    conn = database.get_db_connection()
+    with conn:
+        cursor = conn.execute("""
+            UPDATE jobs SET status = 'done', finished = ?, lease_owner = NULL, lease_expires = NULL, error = NULL,
+                progress = COALESCE(?, progress)
+            WHERE id = ? AND lease_owner = ? AND status = 'running'
+        """, (time.time(), json.dumps(progress) if progress is not None else None, job_id, worker_id))
+    return cursor.rowcount == 1
+
+def release(job_id, worker_id):
+    """
+    Hands a running job back to the queue without counting the attempt,
+    e.g. when its worker shuts down. If a newer job with the same
+    unique_key is queued, that one supersedes it and it is marked done.
+    """
+    conn = database.get_db_connection()
+    with conn:
+        try:
+            conn.execute("""
+                UPDATE jobs SET status = 'queued', attempts = attempts - 1, run_after = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE id = ? AND lease_owner = ? AND status = 'running'
+            """, (time.time(), job_id, worker_id))
+        except sqlite3.IntegrityError:
+            conn.execute("""
+                UPDATE jobs SET status = 'done', finished = ?, lease_owner = NULL, lease_expires = NULL
+                WHERE id = ? AND lease_owner = ? AND status = 'running'
+            """, (time.time(), job_id, worker_id))
+
+def is_superseded(job_id, unique_key):
+    """True if a newer job with the same unique_key is waiting for this one to finish."""
+    conn = database.get_db_connection()
+    return conn.execute("SELECT 1 FROM jobs WHERE unique_key = ? AND status = 'queued' AND id != ?",
+                        (unique_key, job_id)).fetchone() is not None
+
+def fail(job_id, worker_id, error, progress=None):
+    """
+    Records a failed attempt. The job is queued again after an exponential
+    backoff, or marked failed once it has used up its attempts. Returns
+    True if it will be retried.
+    """
+    now = time.time()
+    conn = database.get_db_connection()
+    with conn:
+        job = conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                           (job_id, worker_id)).fetchone()
+        if job is None:
+            return False
+        retry = job['attempts'] < job['max_attempts']
+        if retry:
+            try:
+                conn.execute("""
+                    UPDATE jobs SET status = 'queued', run_after = ?, lease_owner = NULL, lease_expires = NULL, error = ?,
+                        progress = COALESCE(?, progress)
+                    WHERE id = ?
+                """, (now + RETRY_DELAY_SECONDS * 2 ** (job['attempts'] - 1), error,
+                      json.dumps(progress) if progress is not None else None, job_id))
+            except sqlite3.IntegrityError:
+                # A newer job with the same unique_key is queued and supersedes the retry
+                retry = False
+        if not retry:
+            conn.execute("""
+                UPDATE jobs SET status = 'failed', finished = ?, lease_owner = NULL, lease_expires = NULL, error = ?,
+                    progress = COALESCE(?, progress)
+                WHERE id = ?
+            """, (now, error, json.dumps(progress) if progress is not None else None, job_id))
+    return retry
+
+def get_job(job_id):
+    conn = database.get_db_connection()
+    return _job(conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+def latest_job(kind):
+    """Returns the most recently created job of a kind, or None."""
+    conn = database.get_db_connection()
+    return _job(conn.execute('SELECT * FROM jobs WHERE kind = ? ORDER BY id DESC LIMIT 1', (kind,)).fetchone())
+
+def recent_jobs(kind, statuses=('done', 'failed'), limit=HISTORY_SIZE):
+    """Returns the newest jobs of a kind in the given statuses, newest first."""
+    placeholders = ', '.join('?' for _ in statuses)
+    conn = database.get_db_connection()
+    rows = conn.execute(f"SELECT * FROM jobs WHERE kind = ? AND status IN ({placeholders}) ORDER BY id DESC LIMIT ?",
+                        [kind] + list(statuses) + [limit]).fetchall()
+    return [_job(row) for row in rows]
+
+def queue_counts():
+    """Returns {(kind, status): number of jobs}."""
+    conn = database.get_db_connection()
+    rows = conn.execute('SELECT kind, status, COUNT(*) AS count FROM jobs GROUP BY kind, status').fetchall()
+    return {(row['kind'], row['status']): row['count'] for row in rows}
+
+def prune(keep_seconds=KEEP_FINISHED_SECONDS):
+    """Deletes jobs that finished more than keep_seconds ago. Returns the number deleted."""
+    conn = database.get_db_connection()
+    with conn:
+        cursor = conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished < ?", (time.time() - keep_seconds,))
+    return cursor.rowcount
+
+
+class QueuedScanStatus:
+    """
+    Read-only view of the latest scan job's progress, as persisted by the
+    worker running it, with the interface of scan_jobs.ScanStatus that the
+    status API and stream use.
+    """
+
+    def snapshot(self):
+        job = latest_job('scan')
+        if job is None:
+            return {'job_id': None, 'is_scanning': False, 'progress': 0, 'total': 0, 'message': 'Idle', 'phase': None,
+                    'version': 'none', 'queue_status': None}
+        status = dict(job['progress'] or {'is_scanning': False, 'progress': 0, 'total': 0, 'phase': None})
+        status['job_id'] = job['id']
+        status['queue_status'] = job['status']
+        status['is_scanning'] = job['status'] in ('queued', 'running')
+        if job['status'] == 'queued':
+            status['message'] = f"Retrying: {job['error']}" if job['error'] else 'Waiting for a worker...'
+        elif job['status'] == 'failed':
+            status['message'] = f"Scan failed: {job['error']}"
+        status['version'] = f"{job['id']}:{job['status']}:{status.get('version')}"
+        return status
+
+    def __getitem__(self, key):
+        return self.snapshot()[key]
+
+    def wait_for_change(self, version, timeout=None):
+        """Polls the database until the status version differs from `version` or the timeout passes."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            current = self.snapshot()['version']
+            if current != version:
+                return current
+            if deadline is not None and time.monotonic() >= deadline:
+                return current
+            time.sleep(STATUS_POLL_INTERVAL)
+
+
+class QueuedScanManager:
+    """
+    Drop-in replacement for scan_jobs.ScanJobManager that queues scans for a
+    worker process instead of running them in a thread of this process.
+    """
+
+    def __init__(self):
+        self.status = QueuedScanStatus()
+
+    def request_scan(self, dir_list, workers=None):
+        """Queues a scan. Returns True if no scan was running, False if it will follow the running one."""
+        running = self.is_running()
+        enqueue('scan', {'dirs': list(dir_list), 'workers': workers}, priority=PRIORITY_SCAN, unique_key='scan')
+        return not running
+
+    def is_running(self):
+        job = latest_job('scan')
+        return job is not None and job['status'] == 'running'
+
+    @property
+    def history(self):
+        return [dict(job['progress'] or {}, job_id=job['id'], queue_status=job['status'], error=job['error'])
+                for job in recent_jobs('scan')]
+
+
+def request_watch(dir_list, mode, workers=1, replace=True, sweep_interval=None):
+    """
+    Queues the (single) watch job that runs the filesystem watcher in a
+    worker, replacing the running one; a falsy mode just stops watching.
+    Unless replace is set, nothing is queued while a watch job is queued or
+    running; the check and insert are one statement, so workers starting
+    together queue a single job between them.
+    """
+    payload = {'dirs': list(dir_list), 'mode': mode, 'workers': workers, 'sweep_interval': sweep_interval}
+    if replace:
+        enqueue('watch', payload, priority=PRIORITY_SCAN, unique_key='watch', max_attempts=WATCH_MAX_ATTEMPTS)
+        return
+    now = time.time()
+    conn = database.get_db_connection()
+    with conn:
+        conn.execute("""
+            INSERT INTO jobs (kind, payload, priority, unique_key, max_attempts, run_after, created)
+            SELECT 'watch', ?, ?, 'watch', ?, ?, ?
+            WHERE NOT EXISTS (SELECT 1 FROM jobs WHERE unique_key = 'watch' AND status IN ('queued', 'running'))
+        """, (json.dumps(payload), PRIORITY_SCAN, WATCH_MAX_ATTEMPTS, now, now))
+
+
+class Heartbeat:
+    """
+    Context manager that renews a job's lease from a background thread while
+    the job runs, storing progress() (if given) with every renewal. With
+    progress, renewals happen every PROGRESS_INTERVAL so other processes
+    can follow the job closely. Once a renewal finds the lease gone, `lost`
+    is set and check() raises LeaseLost; long-running work calls check()
+    regularly so it stops instead of running alongside the new owner.
+    """
+
+    def __init__(self, job_id, worker_id, progress=None, lease_seconds=LEASE_SECONDS):
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.progress = progress
+        self.lease_seconds = lease_seconds
+        self.interval = min(lease_seconds / 4, PROGRESS_INTERVAL) if progress else lease_seconds / 4
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def beat(self):
+        progress = self.progress() if self.progress else None
+        if not heartbeat(self.job_id, self.worker_id, progress, self.lease_seconds):
+            logger.warning("Lost the lease of job %d", self.job_id)
+            self.lost.set()
+
+    def check(self):
+        if self.lost.is_set():
+            raise LeaseLost(f"Lost the lease of job {self.job_id}")
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                self.beat()
+        finally:
+            database.release_db_connection()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
@@ -1,5 +1,38 @@
+import logging
 import database
+import dedupe
+import embeddings
+import metrics
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Concurrent model requests. Model calls are I/O bound, so threads are enough.
+WORKERS = 4
+
+# Images sent to the model in a single request.
+BATCH_SIZE = 8
+
+# Untagged rows fetched from the database per query.
+FETCH_SIZE = 256
+
+# Identifies the model (and prompt) producing the tags. Cached tags are
+# reused only for the same version, so bump it when either changes.
+MODEL_VERSION = 'mock-1'
+
+logger = logging.getLogger(__name__)
+
+REQUEST_SECONDS = metrics.Histogram('photomanager_tagger_request_seconds', 'Duration of model requests, each tagging one batch of images.')
+IMAGES_TAGGED = metrics.Counter('photomanager_tagged_images_total', 'Images tagged by the LLM processor.')
+TAGGING_ERRORS = metrics.Counter('photomanager_tagger_failed_batches_total', 'Model requests that failed.')
+TAG_CACHE_HITS = metrics.Counter('photomanager_tag_cache_hits_total', 'Images tagged from the tag cache without a model request.')
+
+def _mock_tags(image_path):
+    if '1' in image_path:
+        return ["cat", "indoor", "table"]
+    elif '2' in image_path:
+        return ["dog", "outdoor", "grass"]
+    else:
+        return ["car", "road", "city"]
 
 def process_image(image_path):
     """
@@ -7,33 +40,144 @@ def process_image(image_path):
     This is a placeholder function that returns dummy tags based on the filename.
     In a real implementation, this would involve a model or API call.
     """
-    print(f"LLM processing (mock): {image_path}")
+    logger.debug("LLM processing (mock): %s", image_path)
     time.sleep(2) # Simulate processing time
+    return _mock_tags(image_path)
 
-    if '1' in image_path:
-        return ["cat", "indoor", "table"]
-    elif '2' in image_path:
-        return ["dog", "outdoor", "grass"]
-    else:
-        return ["car", "road", "city"]
+def process_images_batch(image_paths):
+    """
+    Analyzes several images in a single model request and returns one list
+    of tags per image, in order. Like process_image this is a placeholder;
+    a real implementation would send all images in one API call.
+    """
+    logger.debug("LLM processing (mock): batch of %d images", len(image_paths))
+    time.sleep(2) # Simulate one request, however many images it carries
+    return [_mock_tags(image_path) for image_path in image_paths]
+
+def iter_untagged_images(fetch_size=FETCH_SIZE):
+    """Yields every untagged image once, fetching them in id order in chunks of fetch_size."""
+    last_id = 0
+    while True:
+        images = database.get_images_without_tags(after_id=last_id, limit=fetch_size)
+        if not images:
+            return
+        yield from images
+        last_id = images[-1]['id']
+
+def _timed_batch(image_paths):
+    with REQUEST_SECONDS.time():
+        return process_images_batch(image_paths)
 
-def start_llm_processing_loop():
+def _content_hash(image):
+    return image['content_hash'] if 'content_hash' in image.keys() else None
+
+def _tag_batch(images):
+    """
+    Executor entry point. Hashes the images that have no content hash yet,
+    takes the tags of those the current model has seen before from the tag
+    cache, and sends only the rest to the model. Returns one
+    (content_hash, tags, cached) triple per image, and the images'
+    embeddings when semantic search is enabled (otherwise None).
+    """
+    hashes = [_content_hash(image) or dedupe.hash_file_or_none(image['filepath']) for image in images]
+    cached = database.get_cached_tags([content_hash for content_hash in hashes if content_hash], MODEL_VERSION)
+    misses = [index for index, content_hash in enumerate(hashes) if content_hash not in cached]
+    model_tags = dict(zip(misses, _timed_batch([images[index]['filepath'] for index in misses]))) if misses else {}
+    results = [(content_hash, model_tags[index], False) if index in model_tags else (content_hash, cached[content_hash], True)
+               for index, content_hash in enumerate(hashes)]
+    vectors = None
+    if embeddings.ENABLED:
+        vectors = embeddings.embed_images([image['filepath'] for image in images], [tags for _, tags, _ in results])
+    return results, vectors
+
+def tag_images(images, executor, batch_size=BATCH_SIZE, max_pending=WORKERS * 2):
+    """
+    Tags images with batched model requests running on the executor's
+    threads. At most max_pending batches are in flight, so images may be a
+    lazy generator. Each finished batch is written in one transaction by the
+    calling thread. Only one image per content hash is sent to the model;
+    its exact duplicates get a copy of its tags, and images the model has
+    tagged before (e.g. re-imported after their folder was removed) are
+    tagged from the tag cache. Returns the number of images tagged.
+    """
+    pending = {}
+    tagged = 0
+    submitted_hashes = set()
+
+    def unique(images):
+        for image in images:
+            content_hash = _content_hash(image)
+            if content_hash:
+                if content_hash in submitted_hashes:
+                    continue
+                submitted_hashes.add(content_hash)
+            yield image
+
+    def write_results(done):
+        nonlocal tagged
+        for future in done:
+            batch = pending.pop(future)
+            try:
+                results, vectors = future.result()
+            except Exception as e:
+                TAGGING_ERRORS.inc()
+                logger.error("Error tagging batch starting at image ID %d: %s", batch[0]['id'], e)
+                continue
+            # Hashes computed for the lookup are kept: they move the thumbnails to the content key too
+            dedupe.record_content_hashes((image, content_hash) for image, (content_hash, _, _) in zip(batch, results)
+                                         if content_hash and not _content_hash(image))
+            # Images a scan re-read meanwhile (the file changed) are left for the next pass
+            written = set(database.update_llm_tags_bulk(((image['id'], tags) for image, (_, tags, _) in zip(batch, results)),
+                                                        {image['id']: (image['mtime_ns'], image['filesize']) for image in batch}))
+            database.put_cached_tags([(content_hash, tags) for content_hash, tags, cached in results if content_hash and not cached],
+                                     MODEL_VERSION)
+            if vectors is not None and written:
+                rows = [index for index, image in enumerate(batch) if image['id'] in written]
+                embeddings.get_store().add((batch[index]['id'] for index in rows), vectors[rows])
+            tagged += len(written)
+            IMAGES_TAGGED.inc(len(written))
+            TAG_CACHE_HITS.inc(sum(cached for _, _, cached in results))
+            logger.debug("Tagged image IDs %d..%d (%d images)", batch[0]['id'], batch[-1]['id'], len(batch))
+
+    for batch in database.chunked(unique(images), batch_size):
+        future = executor.submit(_tag_batch, batch)
+        pending[future] = batch
+        if len(pending) >= max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            write_results(done)
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        write_results(done)
+    copied = database.copy_tags_to_duplicates()
+    embeddings.add_tagged(copied)
+    return tagged + len(copied)
+
+def start_llm_processing_loop(workers=WORKERS, batch_size=BATCH_SIZE, fetch_size=FETCH_SIZE):
     """
     A loop that runs in the background to process images with the LLM.
+    Each pass walks the untagged images once; when a pass tags nothing
+    (nothing left, or only images that keep failing) the loop sleeps.
     """
-    print("Starting LLM background processing...")
-    while True:
-        images_to_process = database.get_images_without_tags()
-        if not images_to_process:
-            print("No more images to process. LLM processor sleeping.")
-            time.sleep(60) # Wait a minute before checking again
-            continue
-
-        for image in images_to_process:
-            print(f"Processing image ID: {image['id']}")
-            # The placeholder function just needs the path for a mock response
-            tags = process_image(image['filepath'])
-            database.update_llm_tags(image['id'], tags)
-            print(f"Tagged image ID {image['id']} with: {tags}")
-
-        print("Finished a batch of LLM processing.")
+    logger.info("Starting LLM background processing (%d workers, %d images per request)...", workers, batch_size)
+    if embeddings.ENABLED:
+        added = embeddings.backfill()
+        if added:
+            logger.info("Embedded %d images tagged before semantic search was enabled.", added)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            tagged = tag_images(iter_untagged_images(fetch_size), executor, batch_size, max_pending=workers * 2)
+            if not tagged:
+                logger.info("No more images to process. LLM processor sleeping.")
+                time.sleep(60) # Wait a minute before checking again
+                continue
+            logger.info("Finished a pass of LLM processing: %d images tagged.", tagged)
+
+def invalidate_tag_cache(model_version=None):
+    """
+    Drops cached tags of one model version, or by default of every version
+    but the current one (e.g. after upgrading the model). Returns the number
+    of entries removed.
+    """
+    if model_version is not None:
+        return database.delete_cached_tags(model_version)
+    return database.delete_cached_tags(keep_version=MODEL_VERSION)
@@ -0,0 +1,183 @@
+import collections
+import logging
+import threading
+import time
+import scanner
+
+logger = logging.getLogger(__name__)
+
+# Errors kept per scan; later ones are only counted.
+MAX_ERRORS = 100
+
+# Finished scans whose final status is kept for the status API.
+HISTORY_SIZE = 10
+
+
+class ScanStatus:
+    """
+    Progress of the current (or last) scan, shared between the scanning
+    thread and request threads. Every access holds a lock, and every change
+    bumps a version that stream readers can wait on with wait_for_change.
+    Fields can be read and set like a dict; throughput, ETA, phase timings
+    and errors are derived in snapshot().
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._version = 0
+        self.reset()
+
+    def reset(self, job_id=None):
+        with self._condition:
+            self._fields = {'job_id': job_id, 'is_scanning': False, 'progress': 0, 'total': 0, 'message': 'Idle', 'phase': None}
+            self._started = None
+            self._finished = None
+            self._phase_started = None
+            self._phases = {}
+            self._errors = []
+            self._error_count = 0
+            self._changed()
+
+    def _changed(self):
+        # Called with the lock held
+        self._version += 1
+        self._condition.notify_all()
+
+    def _end_phase(self, now):
+        phase = self._fields['phase']
+        if phase is not None:
+            self._phases[phase] = self._phases.get(phase, 0) + now - self._phase_started
+            self._fields['phase'] = None
+
+    def __getitem__(self, key):
+        with self._condition:
+            return self._fields[key]
+
+    def __setitem__(self, key, value):
+        self.update(**{key: value})
+
+    def update(self, **fields):
+        with self._condition:
+            now = time.monotonic()
+            if 'is_scanning' in fields and fields['is_scanning'] != self._fields['is_scanning']:
+                if fields['is_scanning']:
+                    self._started, self._finished = now, None
+                else:
+                    self._end_phase(now)
+                    self._finished = now
+            self._fields.update(fields)
+            self._changed()
+
+    def increment(self, **counts):
+        """Adds to counters, e.g. increment(progress=1), as one locked update."""
+        with self._condition:
+            for key, amount in counts.items():
+                self._fields[key] += amount
+            self._changed()
+
+    def start_phase(self, name, message=None):
+        """Ends the running phase (recording its duration) and starts the next one."""
+        with self._condition:
+            now = time.monotonic()
+            self._end_phase(now)
+            self._fields['phase'] = name
+            self._phase_started = now
+            if message:
+                self._fields['message'] = message
+            self._changed()
+
+    def add_error(self, message):
+        with self._condition:
+            self._error_count += 1
+            if len(self._errors) < MAX_ERRORS:
+                self._errors.append(message)
+            self._changed()
+
+    def snapshot(self):
+        """Returns a consistent copy of the status with derived throughput figures, safe to serialize."""
+        with self._condition:
+            now = time.monotonic()
+            status = dict(self._fields)
+            phases = dict(self._phases)
+            if status['phase'] is not None:
+                phases[status['phase']] = phases.get(status['phase'], 0) + now - self._phase_started
+            elapsed = ((self._finished or now) - self._started) if self._started is not None else 0
+            files_per_sec = status['progress'] / elapsed if elapsed > 0 else 0
+            remaining = status['total'] - status['progress']
+            status.update({
+                'version': self._version,
+                'elapsed_seconds': round(elapsed, 2),
+                'files_per_sec': round(files_per_sec, 1),
+                # Provisional while files are still being discovered, as the total keeps growing
+                'eta_seconds': round(remaining / files_per_sec, 1) if status['is_scanning'] and files_per_sec > 0 else None,
+                'phases': {phase: round(seconds, 3) for phase, seconds in phases.items()},
+                'error_count': self._error_count,
+                'errors': list(self._errors),
+            })
+            return status
+
+    def wait_for_change(self, version, timeout=None):
+        """Blocks until the status differs from `version` or the timeout passes; returns the current version."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._version != version, timeout)
+            return self._version
+
+
+class ScanJobManager:
+    """
+    Runs library scans one at a time in a background thread. A scan
+    requested while another is running is coalesced into a single follow-up
+    scan with the latest arguments, which picks up whatever changed in the
+    meantime, so repeated clicks on "Rescan" never run scans side by side.
+    """
+
+    def __init__(self, status=None):
+        self.status = status or ScanStatus()
+        self.history = collections.deque(maxlen=HISTORY_SIZE)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = None
+        self._job_id = 0
+
+    def request_scan(self, dir_list, workers=None):
+        """
+        Starts a scan of dir_list in the background. Returns True if it
+        started now, False if it was queued behind the running scan.
+        """
+        with self._lock:
+            self._pending = (list(dir_list), workers)
+            if self._thread is not None:
+                return False
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            return True
+
+    def is_running(self):
+        with self._lock:
+            return self._thread is not None
+
+    def wait(self, timeout=None):
+        """Waits for the running scan and any queued one to finish."""
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._pending is None:
+                    self._thread = None
+                    return
+                dir_list, workers = self._pending
+                self._pending = None
+                self._job_id += 1
+                job_id = self._job_id
+            self.status.reset(job_id)
+            try:
+                scanner.scan_directories(dir_list, self.status, workers)
+            except Exception as e:
+                logger.exception("Scan %d failed", job_id)
+                self.status.add_error(str(e))
+                self.status.update(is_scanning=False, message=f"Scan failed: {e}")
+            self.history.appendleft(self.status.snapshot())
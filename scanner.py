@@ -1,13 +1,88 @@
+import contextlib
+import itertools
+import logging
 import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from PIL import Image, UnidentifiedImageError
 from datetime import datetime
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import database
+import dedupe
+import exif
+import metrics
+import thumbnails
 import time
 
+logger = logging.getLogger(__name__)
+
+SCAN_PHASE_SECONDS = metrics.Histogram(
+    'photomanager_scan_phase_seconds',
+    'Duration of scan phases. walk, diff and extract break down discover_and_extract, which runs them interleaved.',
+    ['phase'], buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+FILES_SCANNED = metrics.Counter('photomanager_scanned_files_total', 'Files seen by scans and watcher batches, by outcome.', ['result'])
+
 # EXIF tag for date taken
-EXIF_DATE_TAG = 36867
+EXIF_DATE_TAG = exif.DATE_TIME_ORIGINAL
+
+# Version of the metadata extraction. Images read by an older version have
+# their EXIF fields re-read by the next scan; bump it when exif.py learns new fields.
+METADATA_VERSION = 1
+
+# Images whose EXIF fields are re-read per database query.
+METADATA_FETCH_SIZE = 1000
+
+SUPPORTED_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp'})
+
+# Number of worker processes used to extract metadata. None means one per CPU.
+DEFAULT_WORKERS = None
 
-SUPPORTED_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp']
+# Files handed to a worker process per task, to keep IPC overhead low.
+EXTRACT_CHUNK_SIZE = 32
+
+# Threads used to walk top-level subdirectories in parallel. Directory listing
+# is I/O bound, so this mostly helps on network mounts.
+DEFAULT_TRAVERSAL_WORKERS = 4
+
+# Discovered files are handed from traversal threads to the scan in batches.
+TRAVERSAL_BATCH_SIZE = 256
+
+# Held by full scans and watcher batches so only one of them writes at a time;
+# see scan_lock().
+_scan_thread_lock = threading.Lock()
+
+@contextlib.contextmanager
+def scan_lock():
+    """
+    Held by full scans and watcher batches so only one of them writes at a
+    time, across threads and, through a lock file next to the database,
+    across processes such as job queue workers. Without fcntl (Windows)
+    only threads are serialized, so run a single worker for scan and watch
+    jobs there.
+    """
+    with _scan_thread_lock, open(f"{database.DB_PATH}.scan-lock", 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def read_image_metadata(filepath):
+    """
+    Returns the dimensions and EXIF fields (exif.FIELDS) of an image. JPEG
+    and PNG headers are parsed directly; other formats only get their
+    dimensions, from PIL, which also reads just the header.
+    """
+    try:
+        return exif.read_metadata(filepath)
+    except ValueError:
+        with Image.open(filepath) as img:
+            width, height = img.size
+        metadata = dict.fromkeys(exif.FIELDS)
+        metadata.update(width=width, height=height)
+        return metadata
 
 def get_date_taken(image_path):
     """
@@ -15,107 +90,480 @@ def get_date_taken(image_path):
     Falls back to file modification time if EXIF data is not available.
     """
     try:
-        with Image.open(image_path) as img:
-            exif_data = img._getexif()
-            if exif_data and EXIF_DATE_TAG in exif_data:
-                date_str = exif_data[EXIF_DATE_TAG]
-                return datetime.strptime(date_str, '%Y:%m:%d %H:%M:%S').isoformat()
-    except (AttributeError, KeyError, IndexError, ValueError):
+        date_taken = read_image_metadata(image_path)['date_taken']
+        if date_taken:
+            return date_taken
+    except (UnidentifiedImageError, OSError):
         pass
 
     mod_time = os.path.getmtime(image_path)
     return datetime.fromtimestamp(mod_time).isoformat()
 
 def process_single_image(filepath):
-    """Processes a single image file and returns its metadata dictionary."""
+    """
+    Processes a single image file and returns its metadata dictionary.
+    The file is stat'ed once and only its header is read, which holds the
+    dimensions and the EXIF block.
+    """
     try:
-        with Image.open(filepath) as img:
-            width, height = img.size
-
-        date_taken = get_date_taken(filepath)
-        date_modified = datetime.fromtimestamp(os.path.getmtime(filepath)).isoformat()
-        filesize = os.path.getsize(filepath)
+        stat = os.stat(filepath)
+        metadata = read_image_metadata(filepath)
+        date_modified = datetime.fromtimestamp(stat.st_mtime).isoformat()
 
-        return {
+        metadata.update({
             'filepath': filepath,
             'filename': os.path.basename(filepath),
-            'date_taken': date_taken,
+            'date_taken': metadata['date_taken'] or date_modified,
             'date_modified': date_modified,
-            'filesize': filesize,
-            'width': width,
-            'height': height
-        }
+            'filesize': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'inode': stat.st_ino,
+            'metadata_version': METADATA_VERSION,
+        })
+        return metadata
     except UnidentifiedImageError:
-        print(f"Could not identify image file: {filepath}")
+        logger.warning("Could not identify image file: %s", filepath)
     except Exception as e:
-        print(f"Error processing {filepath}: {e}")
+        logger.warning("Error processing %s: %s", filepath, e)
     return None
 
-def scan_directories(dir_list, status_obj=None):
+def _process_chunk(filepaths):
+    """Worker entry point: processes a chunk of files in a pool process."""
+    return [(filepath, process_single_image(filepath)) for filepath in filepaths]
+
+def extract_metadata(filepaths, workers=DEFAULT_WORKERS, chunk_size=EXTRACT_CHUNK_SIZE):
     """
-    Performs a smart scan of all directories in the list.
-    Adds new images, and removes images that are no longer on disk.
-    Updates a status object with progress.
+    Extracts metadata for an iterable of filepaths using a process pool.
+    Yields (filepath, image_data) tuples in completion order as soon as they
+    are ready; image_data is None for files that could not be read.
+    Only a bounded number of chunks is in flight at once, so filepaths may be
+    a lazy generator.
     """
-    if status_obj:
-        status_obj['is_scanning'] = True
-        status_obj['message'] = 'Starting scan...'
-        status_obj['progress'] = 0
-        status_obj['total'] = 0
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for filepath in filepaths:
+            yield filepath, process_single_image(filepath)
+        return
 
-    print("Starting smart scan...")
-    database.create_table()
+    max_pending = workers * 2
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for chunk in database.chunked(filepaths, chunk_size):
+            pending.add(executor.submit(_process_chunk, chunk))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in as_completed(pending):
+            yield from future.result()
+
+def is_supported_image(filename):
+    """Returns True if the filename has one of the supported image extensions."""
+    return os.path.splitext(filename)[1].lower() in SUPPORTED_EXTENSIONS
+
+def _extract_and_write(filepaths, changed_set, workers, status_obj=None, checkpoint=None, chunk_size=database.BULK_CHUNK_SIZE):
+    """
+    Extracts metadata for files and writes it to the database. Files in
+    changed_set already have a row and are returned for update_images_bulk
+    instead of being inserted. filepaths may be a lazy generator, as long as
+    each changed path is added to changed_set before it is yielded.
+    New rows are committed every chunk_size images, together with whatever
+    checkpoint (see database.insert_images_bulk) records.
+    """
+    changed_images = []
+    # New and changed images get their thumbnails rendered in the background
+    to_warm = []
+
+    def extracted_images():
+        for filepath, image_data in extract_metadata(filepaths, workers):
+            if status_obj:
+                status_obj.update(message=f"Reading image: {os.path.basename(filepath)}")
+                status_obj.increment(progress=1)
+            if not image_data:
+                FILES_SCANNED.inc(result='unreadable')
+                if status_obj: status_obj.add_error(f"Could not read {filepath}")
+                continue
+            if thumbnails.WARM_ON_SCAN:
+                to_warm.append(image_data)
+                if len(to_warm) >= thumbnails.WARM_CHUNK_SIZE:
+                    thumbnails.warm_thumbnails(to_warm)
+                    to_warm.clear()
+            if filepath in changed_set:
+                logger.debug("Updated: %s", filepath)
+                changed_images.append(image_data)
+            else:
+                logger.debug("Added: %s", filepath)
+                yield image_data
+
+    database.insert_images_bulk(extracted_images(), chunk_size, checkpoint)
+    if to_warm:
+        thumbnails.warm_thumbnails(to_warm)
+    return changed_images
 
-    # 1. Get all filepaths from the database
-    if status_obj: status_obj['message'] = 'Fetching existing images from database...'
-    db_filepaths = database.get_all_filepaths()
+def file_fingerprint(stat):
+    """Returns the (mtime_ns, size, inode) fingerprint used to detect changed files."""
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
 
-    # 2. Find all image files on disk
-    if status_obj: status_obj['message'] = 'Searching for image files on disk...'
-    disk_filepaths = set()
+def _top_level_dirs(dir_list):
+    """
+    Drops directories that are nested inside (or the same as) another listed
+    directory. The rest are returned as listed, not made absolute, so walked
+    paths match the filepaths stored by earlier scans of a relative entry.
+    """
+    listed = {}
     for directory in dir_list:
-        if not os.path.isdir(directory):
-            continue
-        for root, _, files in os.walk(directory):
-            for file in files:
-                if any(file.lower().endswith(ext) for ext in SUPPORTED_EXTENSIONS):
-                    disk_filepaths.add(os.path.join(root, file))
+        listed.setdefault(os.path.join(os.path.abspath(directory), ''), directory)
+    top_level = []
+    for normalized in sorted(listed):
+        if not any(normalized.startswith(parent) for parent in top_level):
+            top_level.append(normalized)
+    return [listed[normalized] for normalized in top_level]
+
+def _under_any(filepaths, directories):
+    """Returns the filepaths that are inside one of the directories."""
+    prefixes = tuple(os.path.join(directory, '') for directory in directories)
+    return [filepath for filepath in filepaths if filepath.startswith(prefixes)]
+
+def _scan_entries(directory, subdirs):
+    """
+    Lists one directory, yielding (filepath, stat) for supported images and
+    appending subdirectories to subdirs. The DirEntry type check needs no
+    extra syscall on most filesystems.
+    """
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif is_supported_image(entry.name) and entry.is_file():
+                        yield entry.path, entry.stat()
+                except OSError:
+                    continue
+    except OSError as e:
+        logger.warning("Could not list %s: %s", directory, e)
 
-    # 3. Determine what's new and what's deleted
-    new_files = list(disk_filepaths - db_filepaths)
-    deleted_files = list(db_filepaths - disk_filepaths)
+def _timed(iterable, totals, key):
+    """Yields from iterable, adding the time spent producing items to totals[key]."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            totals[key] += time.perf_counter() - start
+        yield item
 
-    total_ops = len(new_files) + len(deleted_files)
+class _ScanPhases:
+    """Times the phases of a scan into SCAN_PHASE_SECONDS and reports them on the status object."""
+
+    def __init__(self, status_obj):
+        self.status_obj = status_obj
+        self._name = None
+        self._started = None
+
+    def start(self, name, message=None):
+        self.finish()
+        self._name, self._started = name, time.perf_counter()
+        if self.status_obj: self.status_obj.start_phase(name, message)
+
+    def finish(self):
+        if self._name is not None:
+            SCAN_PHASE_SECONDS.observe(time.perf_counter() - self._started, phase=self._name)
+            self._name = None
+
+def _walk_tree(directory):
+    """Yields (filepath, stat) for every supported image below directory."""
+    stack = [directory]
+    while stack:
+        subdirs = []
+        yield from _scan_entries(stack.pop(), subdirs)
+        stack.extend(reversed(subdirs))
+
+def _parallel_walk(subtrees, traversal_workers):
+    """Walks several subtrees in threads, yielding their files as they are found."""
+    results = queue.Queue(maxsize=traversal_workers * 4)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def walk(subtree):
+        try:
+            batch = []
+            for item in _walk_tree(subtree):
+                if stop.is_set():
+                    return
+                batch.append(item)
+                if len(batch) >= TRAVERSAL_BATCH_SIZE:
+                    put(batch)
+                    batch = []
+            if batch:
+                put(batch)
+        finally:
+            put(done)
+
+    with ThreadPoolExecutor(max_workers=traversal_workers) as executor:
+        for subtree in subtrees:
+            executor.submit(walk, subtree)
+        try:
+            remaining = len(subtrees)
+            while remaining:
+                batch = results.get()
+                if batch is done:
+                    remaining -= 1
+                else:
+                    yield from batch
+        finally:
+            stop.set()
+
+def iter_image_files(dir_list, traversal_workers=DEFAULT_TRAVERSAL_WORKERS):
+    """
+    Yields (filepath, stat) for every supported image in the directories, as
+    it is found, so callers can start working before the walk finishes and
+    without holding the whole file list in memory. With more than one
+    traversal worker, each top-level subdirectory is walked in its own thread
+    and files are yielded in no particular order.
+    """
+    roots = [directory for directory in _top_level_dirs(dir_list) if os.path.isdir(directory)]
+    if traversal_workers <= 1:
+        for root in roots:
+            yield from _walk_tree(root)
+        return
+
+    subtrees = []
+    for root in roots:
+        yield from _scan_entries(root, subtrees)
+    if subtrees:
+        yield from _parallel_walk(subtrees, traversal_workers)
+
+def scan_directories(dir_list, status_obj=None, workers=DEFAULT_WORKERS, traversal_workers=DEFAULT_TRAVERSAL_WORKERS,
+                     checkpoint=None, checkpoint_every=database.BULK_CHUNK_SIZE):
+    """
+    Performs an incremental scan of all directories in the list.
+    Files whose stat fingerprint (mtime, size, inode) matches the database are
+    skipped without being opened, changed files are re-read, renamed or moved
+    files are re-pointed at their new path (keeping their id and tags), new
+    images are added and images under the directories that are no longer
+    on disk are removed; images elsewhere in the library are left alone.
+    Updates status_obj, a scan_jobs.ScanStatus, with progress.
+    Discovery streams straight into metadata extraction, which runs in
+    `workers` processes; this thread remains the only database writer.
+    Scans and watcher batches hold scan_lock(), so they never interleave,
+    even when they run in different processes.
+    New images are committed every checkpoint_every files, calling
+    checkpoint inside each commit; an interrupted scan therefore only
+    re-reads the files of its last uncommitted chunk when run again.
+    """
+    with scan_lock():
+        _scan_directories(dir_list, status_obj, workers, traversal_workers, checkpoint, checkpoint_every)
+
+def _scan_directories(dir_list, status_obj, workers, traversal_workers, checkpoint=None, checkpoint_every=database.BULK_CHUNK_SIZE):
     if status_obj:
-        status_obj['total'] = total_ops
-        status_obj['progress'] = 0
+        status_obj.update(is_scanning=True, message='Starting scan...', progress=0, total=0)
 
-    # 4. Add new files to the database
-    if new_files:
-        print(f"Found {len(new_files)} new images to add.")
-        for i, filepath in enumerate(new_files):
-            if status_obj:
-                status_obj['message'] = f"Adding new image: {os.path.basename(filepath)}"
-                status_obj['progress'] += 1
-            image_data = process_single_image(filepath)
-            if image_data:
-                database.insert_image(image_data)
-                print(f"Added: {filepath}")
-
-    # 5. Remove deleted files from the database
+    logger.info("Starting smart scan...")
+    database.create_table()
+    phases = _ScanPhases(status_obj)
+
+    # 1. Get the stored fingerprints of all files in the database
+    phases.start('load_fingerprints', 'Fetching existing images from database...')
+    db_fingerprints = database.get_image_fingerprints()
+    # A new path with the inode and size of a known file that has disappeared
+    # from disk is the same file, moved.
+    known_identities = {(size, inode): filepath for filepath, (_, size, inode, _) in db_fingerprints.items() if inode is not None}
+
+    # 2. Walk the disk and compare each file with the database as it is found
+    phases.start('discover_and_extract', 'Searching for image files on disk...')
+    new_count = 0
+    unchanged_count = 0
+    # Time spent walking the disk, and walking plus comparing, within discover_and_extract
+    producer_seconds = {'walk': 0.0, 'discover': 0.0}
+    changed_set = set()
+    moved_files = []
+    legacy_fingerprints = []
+    # Fingerprints of changed files whose cached thumbnails are now stale
+    stale_fingerprints = []
+
+    def files_to_extract():
+        nonlocal new_count, unchanged_count
+        for filepath, stat in _timed(iter_image_files(dir_list, traversal_workers), producer_seconds, 'walk'):
+            fingerprint = file_fingerprint(stat)
+            stored = db_fingerprints.pop(filepath, None)
+            if stored is None:
+                old_path = known_identities.get(fingerprint[1:])
+                if old_path in db_fingerprints and not os.path.lexists(old_path):
+                    moved_files.append((old_path, filepath))
+                    if status_obj: status_obj.increment(total=1)
+                    old_fingerprint = db_fingerprints.pop(old_path)
+                    if old_fingerprint[0] == fingerprint[0]:
+                        if status_obj: status_obj.increment(progress=1)
+                        unchanged_count += 1
+                        continue
+                    stale_fingerprints.append((old_path, old_fingerprint))
+                    changed_set.add(filepath)
+                else:
+                    new_count += 1
+            elif stored[0] is None:
+                # Scanned before fingerprints existed; record it without re-reading.
+                legacy_fingerprints.append((filepath,) + fingerprint)
+                unchanged_count += 1
+                continue
+            elif stored[:3] != fingerprint:
+                stale_fingerprints.append((filepath, stored))
+                changed_set.add(filepath)
+            else:
+                unchanged_count += 1
+                continue
+            if status_obj: status_obj.increment(total=1)
+            yield filepath
+
+    # 3. Extract metadata for new and changed files; new ones are inserted as they arrive
+    stream_start = time.perf_counter()
+    changed_images = _extract_and_write(_timed(files_to_extract(), producer_seconds, 'discover'), changed_set, workers, status_obj,
+                                        checkpoint, checkpoint_every)
+    SCAN_PHASE_SECONDS.observe(producer_seconds['walk'], phase='walk')
+    SCAN_PHASE_SECONDS.observe(producer_seconds['discover'] - producer_seconds['walk'], phase='diff')
+    SCAN_PHASE_SECONDS.observe(time.perf_counter() - stream_start - producer_seconds['discover'], phase='extract')
+    phases.start('write', 'Writing changes...')
+    if legacy_fingerprints:
+        database.update_fingerprints_bulk(legacy_fingerprints)
+
+    # 4. Re-point moved files so they keep their tags and thumbnails, then
+    # update the rows of changed files
+    if moved_files:
+        logger.info("Found %d moved images.", len(moved_files))
+        database.move_images_bulk(moved_files)
+    database.update_images_bulk(changed_images)
+
+    # 5. Whatever is left in the database under the scanned directories is
+    # missing from disk; the rest belongs to directories this scan skipped
+    deleted_files = _under_any(db_fingerprints, _top_level_dirs(dir_list))
+    db_fingerprints = {filepath: db_fingerprints[filepath] for filepath in deleted_files}
     if deleted_files:
-        print(f"Found {len(deleted_files)} images to remove.")
-        conn = database.get_db_connection()
-        for filepath in deleted_files:
-            if status_obj:
-                status_obj['message'] = f"Removing missing image: {os.path.basename(filepath)}"
-                status_obj['progress'] += 1
-            conn.execute("DELETE FROM images WHERE filepath = ?", (filepath,))
-            print(f"Removed: {filepath}")
-        conn.commit()
-        conn.close()
+        logger.info("Found %d images to remove.", len(deleted_files))
+        if status_obj: status_obj.increment(total=len(deleted_files))
+        phases.start('remove', f"Removing {len(deleted_files)} missing images...")
+        database.delete_images_bulk(deleted_files)
+        if status_obj:
+            status_obj.increment(progress=len(deleted_files))
 
+    # 6. Read the EXIF fields of images scanned by an older version of the extractor
+    phases.start('metadata', 'Reading camera and location metadata...')
+    update_stale_metadata(workers)
+
+    # 7. Hash new and changed images for duplicate detection
+    phases.start('dedupe', 'Looking for duplicates...')
+    dedupe.update_hashes(workers)
+
+    # 8. Drop the thumbnails of removed and changed images (the disk budget
+    # is checked in the background after thumbnails are rendered)
+    phases.start('thumbnail_cleanup', 'Cleaning up thumbnails...')
+    stale_fingerprints.extend(db_fingerprints.items())
+    thumbnails.discard_fingerprints(stale_fingerprints)
+    phases.finish()
+
+    for result, count in (('new', new_count), ('changed', len(changed_set)), ('moved', len(moved_files)),
+                          ('unchanged', unchanged_count), ('removed', len(deleted_files))):
+        FILES_SCANNED.inc(count, result=result)
     if status_obj:
-        status_obj['is_scanning'] = False
-        status_obj['message'] = f"Scan complete. Found {len(new_files)} new images, removed {len(deleted_files)}."
-    print("Smart scan complete.")
+        status_obj.update(is_scanning=False,
+                          message=(f"Scan complete. Found {new_count} new images, updated {len(changed_set)}, "
+                                   f"moved {len(moved_files)}, removed {len(deleted_files)}."))
+    logger.info("Smart scan complete: %d new, %d changed, %d moved, %d unchanged, %d removed.",
+                new_count, len(changed_set), len(moved_files), unchanged_count, len(deleted_files))
+
+def update_stale_metadata(workers=DEFAULT_WORKERS):
+    """
+    Re-reads the EXIF fields of images extracted before METADATA_VERSION,
+    leaving the rest of their rows (tags, hashes) alone. Returns the number
+    of images updated.
+    """
+    updated = 0
+    rows = database.get_images_with_stale_metadata(METADATA_VERSION, METADATA_FETCH_SIZE)
+    while rows:
+        images = []
+        for filepath, image_data in extract_metadata([row['filepath'] for row in rows], workers):
+            # Unreadable files are marked as read too, so they are not retried on every scan
+            images.append(image_data or {'filepath': filepath, 'metadata_version': METADATA_VERSION})
+        database.update_metadata_bulk(images)
+        updated += len(images)
+        rows = database.get_images_with_stale_metadata(METADATA_VERSION, METADATA_FETCH_SIZE)
+    if updated:
+        logger.info("Read camera and location metadata of %d previously scanned images.", updated)
+    return updated
+
+def apply_changes(updated=(), deleted=(), moved=(), workers=1):
+    """
+    Applies a batch of filesystem events without walking the library.
+    `updated` holds paths that were created or modified, `deleted` paths that
+    no longer exist and `moved` (old_path, new_path) pairs. Any of these may be
+    directories; only directories that appeared under `updated` are walked.
+    """
+    with scan_lock(), SCAN_PHASE_SECONDS.time(phase='watcher_batch'):
+        _apply_changes(updated, deleted, moved, workers)
+
+def _apply_changes(updated, deleted, moved, workers):
+    updated = set(updated)
+    deleted = list(deleted)
+    file_moves = []
+    for old_path, new_path in moved:
+        if os.path.isdir(new_path):
+            database.move_images_under(old_path, new_path)
+        elif is_supported_image(new_path):
+            file_moves.append((old_path, new_path))
+            # Verify the fingerprint too, in case the file was also edited.
+            updated.add(new_path)
+        else:
+            deleted.append(old_path)
+    if file_moves:
+        database.move_images_bulk(file_moves)
+
+    # Read before deleting: the thumbnails of removed rows are dropped at the end
+    stale_fingerprints = database.get_fingerprints_for_paths(deleted, include_children=True)
+    removed = database.delete_images_bulk(deleted, include_children=True)
+
+    candidates = {}
+    for path in updated:
+        if os.path.isdir(path):
+            candidates.update(_walk_tree(path))
+        elif is_supported_image(path):
+            try:
+                candidates[path] = os.stat(path)
+            except OSError:
+                candidates[path] = None
+
+    stored_fingerprints = database.get_fingerprints_for_paths(list(candidates))
+    new_files = []
+    changed_set = set()
+    vanished_files = []
+    for filepath, stat in candidates.items():
+        if stat is None:
+            vanished_files.append(filepath)
+            continue
+        stored = stored_fingerprints.get(filepath)
+        if stored is None:
+            new_files.append(filepath)
+        elif stored[:3] != file_fingerprint(stat):
+            changed_set.add(filepath)
+    removed += database.delete_images_bulk(vanished_files)
+    stale_fingerprints.update((filepath, stored_fingerprints[filepath]) for filepath in vanished_files if filepath in stored_fingerprints)
+    stale_fingerprints.update((filepath, stored_fingerprints[filepath]) for filepath in changed_set)
+
+    if new_files or changed_set:
+        changed_images = _extract_and_write(itertools.chain(changed_set, new_files), changed_set, workers)
+        database.update_images_bulk(changed_images)
+    # After the deletes and the update, which clears the changed rows' content hashes
+    thumbnails.discard_fingerprints(stale_fingerprints.items())
+    for result, count in (('new', len(new_files)), ('changed', len(changed_set)), ('moved', len(file_moves)), ('removed', removed)):
+        FILES_SCANNED.inc(count, result=result)
+    logger.info("Applied filesystem changes: %d new, %d changed, %d moved, %d removed.",
+                len(new_files), len(changed_set), len(file_moves), removed)
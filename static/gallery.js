@@ -0,0 +1,83 @@
+// Infinite scroll for the gallery: the server renders the first page and this
+// script fetches the following pages from /api/images as the user scrolls.
+document.addEventListener('DOMContentLoaded', () => {
+    const pages = document.getElementById('gallery-pages');
+    const sentinel = document.getElementById('gallery-sentinel');
+    if (!pages || !sentinel) return;
+
+    const apiUrl = pages.dataset.apiUrl;
+    const monthCounts = JSON.parse(pages.dataset.monthCounts || '{}');
+    let nextCursor = pages.dataset.nextCursor;
+    let loading = false;
+
+    function escapeHtml(text) {
+        const div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML;
+    }
+
+    function cardHtml(image) {
+        const filename = escapeHtml(image.filename);
+        return `
+            <div class="thumbnail">
+                <div class="card">
+                    <a href="/api/image/${image.id}" class="photo-thumbnail-link" data-image-id="${image.id}">
+                        <img src="${image.thumbnail_url}" srcset="${image.thumbnail_url_2x} 2x" class="card-img-top" alt="${filename}" loading="lazy">
+                    </a>
+                    <div class="card-body">
+                        <p class="card-text text-truncate" title="${filename}">${filename}</p>
+                        <p class="card-text"><small class="text-muted">Taken: ${image.date_taken.split('T')[0]}</small></p>
+                    </div>
+                </div>
+            </div>`;
+    }
+
+    function monthGallery(image) {
+        const sections = pages.querySelectorAll('.month-section');
+        const last = sections[sections.length - 1];
+        if (last && last.dataset.month === String(image.month)) {
+            return last.querySelector('.gallery');
+        }
+        const count = monthCounts[image.month] || 0;
+        pages.insertAdjacentHTML('beforeend', `
+            <section class="month-section" data-month="${image.month}">
+                <h2 class="mt-5">${escapeHtml(image.month_name)} (${count} photos)</h2>
+                <hr>
+                <div class="gallery"></div>
+            </section>`);
+        return pages.lastElementChild.querySelector('.gallery');
+    }
+
+    function loadNextPage() {
+        if (loading || !nextCursor) return;
+        loading = true;
+        sentinel.textContent = 'Loading more photos...';
+
+        const separator = apiUrl.includes('?') ? '&' : '?';
+        fetch(`${apiUrl}${separator}cursor=${encodeURIComponent(nextCursor)}`)
+            .then(response => response.json())
+            .then(data => {
+                data.images.forEach(image => {
+                    monthGallery(image).insertAdjacentHTML('beforeend', cardHtml(image));
+                });
+                nextCursor = data.next_cursor;
+                sentinel.textContent = '';
+                loading = false;
+                // Re-observe so a sentinel that is still in view triggers the next page
+                observer.unobserve(sentinel);
+                observer.observe(sentinel);
+            })
+            .catch(error => {
+                console.error('Error loading more photos:', error);
+                sentinel.textContent = 'Could not load more photos.';
+                loading = false;
+            });
+    }
+
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadNextPage();
+        }
+    }, { rootMargin: '800px' });
+    observer.observe(sentinel);
+});
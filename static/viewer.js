@@ -1,21 +1,62 @@
+// Images on each side of the current one fetched per metadata request.
+const VIEWER_RADIUS = 10;
+
+// Viewer metadata by image id, kept for the lifetime of the page so paging
+// back and forth (or reopening the viewer) needs no further requests.
+const viewerCache = new Map();
+
 document.addEventListener('DOMContentLoaded', () => {
     const gallery = document.querySelector('.gallery');
     if (!gallery) return;
 
-    // Get the context of all visible image IDs
-    const imageLinks = gallery.querySelectorAll('.photo-thumbnail-link');
-    const contextIds = Array.from(imageLinks).map(link => link.dataset.imageId);
-
-    imageLinks.forEach(link => {
-        link.addEventListener('click', (event) => {
-            event.preventDefault();
-            const imageId = link.dataset.imageId;
-            openViewer(imageId, contextIds);
-        });
+    // Delegated so thumbnails appended by infinite scroll open the viewer too
+    document.addEventListener('click', (event) => {
+        const link = event.target.closest('.photo-thumbnail-link');
+        if (!link) return;
+        event.preventDefault();
+        openViewer(link.dataset.imageId, viewerScope());
     });
 });
 
-function openViewer(imageId, contextIds) {
+function viewerScope() {
+    // The gallery is ordered on the server, which pages through it by date.
+    // Other pages (search results) navigate in the order shown on the page.
+    const pages = document.getElementById('gallery-pages');
+    if (pages) {
+        return { year: pages.dataset.year, month: pages.dataset.month };
+    }
+    const imageLinks = document.querySelectorAll('.photo-thumbnail-link');
+    return { contextIds: Array.from(imageLinks).map(imageLink => imageLink.dataset.imageId) };
+}
+
+function fetchWindow(imageId, scope) {
+    let url;
+    if (scope.contextIds) {
+        // Only the ids around the current image are sent, not the whole page
+        const index = scope.contextIds.indexOf(String(imageId));
+        const ids = scope.contextIds.slice(Math.max(index - VIEWER_RADIUS, 0), index + VIEWER_RADIUS + 1);
+        url = `/api/images/batch?ids=${ids.join(',')}`;
+    } else {
+        const params = new URLSearchParams({ radius: VIEWER_RADIUS });
+        if (scope.year) params.set('year', scope.year);
+        if (scope.month) params.set('month', scope.month);
+        url = `/api/image/${imageId}/window?${params}`;
+    }
+    return fetch(url)
+        .then(response => response.json())
+        .then(data => {
+            (data.images || []).forEach(image => {
+                if (scope.contextIds) {
+                    const index = scope.contextIds.indexOf(String(image.id));
+                    image.prev_id = index > 0 ? scope.contextIds[index - 1] : null;
+                    image.next_id = index < scope.contextIds.length - 1 ? scope.contextIds[index + 1] : null;
+                }
+                viewerCache.set(String(image.id), image);
+            });
+        });
+}
+
+function openViewer(imageId, scope) {
     // Create viewer modal
     const viewerHtml = `
         <div class="photo-viewer" id="photo-viewer">
@@ -27,6 +68,7 @@ function openViewer(imageId, contextIds) {
                 <div class="viewer-info">
                     <p id="viewer-filename"></p>
                     <p id="viewer-date"></p>
+                    <p><a href="#" id="viewer-download" download>Download original</a></p>
                 </div>
             </div>
         </div>
@@ -40,67 +82,78 @@ function openViewer(imageId, contextIds) {
 
     closeBtn.addEventListener('click', () => viewer.remove());
     prevBtn.addEventListener('click', () => {
-        const currentId = document.getElementById('viewer-img').dataset.currentId;
-        const currentIndex = contextIds.indexOf(currentId);
-        if (currentIndex > 0) {
-            const prevId = contextIds[currentIndex - 1];
-            load_image_data(prevId, contextIds);
-        }
+        const current = viewerCache.get(viewer.dataset.currentId);
+        if (current && current.prev_id) showImage(current.prev_id, scope);
     });
     nextBtn.addEventListener('click', () => {
-        const currentId = document.getElementById('viewer-img').dataset.currentId;
-        const currentIndex = contextIds.indexOf(currentId);
-        if (currentIndex < contextIds.length - 1) {
-            const nextId = contextIds[currentIndex + 1];
-            load_image_data(nextId, contextIds);
-        }
+        const current = viewerCache.get(viewer.dataset.currentId);
+        if (current && current.next_id) showImage(current.next_id, scope);
     });
 
-    load_image_data(imageId, contextIds);
+    showImage(imageId, scope);
 }
 
-function load_image_data(imageId, contextIds) {
+function showImage(imageId, scope) {
+    const viewer = document.getElementById('photo-viewer');
+    if (!viewer) return;
     const viewerImg = document.getElementById('viewer-img');
     const filenameEl = document.getElementById('viewer-filename');
     const dateEl = document.getElementById('viewer-date');
-    const prevBtn = document.querySelector('.viewer-prev');
-    const nextBtn = document.querySelector('.viewer-next');
+    const downloadLink = document.getElementById('viewer-download');
+    const prevBtn = viewer.querySelector('.viewer-prev');
+    const nextBtn = viewer.querySelector('.viewer-next');
+    viewer.dataset.currentId = String(imageId);
 
-    // Show loading state
-    viewerImg.src = ''; // Or a loading spinner URL
-    filenameEl.textContent = 'Loading...';
-    dateEl.textContent = '';
+    const image = viewerCache.get(String(imageId));
+    if (!image) {
+        // Show loading state
+        viewerImg.src = '';
+        filenameEl.textContent = 'Loading...';
+        dateEl.textContent = '';
+        fetchWindow(imageId, scope)
+            .then(() => {
+                // Ignore the response if the user has moved on meanwhile
+                if (viewer.dataset.currentId !== String(imageId)) return;
+                if (viewerCache.has(String(imageId))) {
+                    showImage(imageId, scope);
+                } else {
+                    filenameEl.textContent = 'Image not found';
+                }
+            })
+            .catch(error => {
+                console.error('Error fetching image data:', error);
+                filenameEl.textContent = 'Error loading image.';
+            });
+        return;
+    }
 
-    const contextParam = contextIds.join(',');
-    fetch(`/api/image/${imageId}?context=${contextParam}`)
-        .then(response => response.json())
-        .then(data => {
-            if (data.error) {
-                filenameEl.textContent = data.error;
-                return;
-            }
+    // The screen-sized preview; the original is only fetched through the download link
+    viewerImg.src = image.preview_url;
+    downloadLink.href = image.full_image_url;
+    downloadLink.setAttribute('download', image.filename);
+    filenameEl.textContent = image.filename;
+    dateEl.textContent = `Taken: ${image.date_taken.split('T')[0]}`;
 
-            viewerImg.src = data.full_image_url;
-            viewerImg.dataset.currentId = data.id;
-            filenameEl.textContent = data.filename;
-            dateEl.textContent = `Taken: ${data.date_taken.split('T')[0]}`;
+    // Update nav buttons
+    prevBtn.style.display = image.prev_id ? 'block' : 'none';
+    nextBtn.style.display = image.next_id ? 'block' : 'none';
 
-            // Update nav buttons
-            prevBtn.style.display = data.prev_id ? 'block' : 'none';
-            nextBtn.style.display = data.next_id ? 'block' : 'none';
+    // Fetch the next window before the user reaches its edge, then warm the
+    // browser cache with the neighbours' previews
+    const missing = [image.prev_id, image.next_id].some(id => id && !viewerCache.has(String(id)));
+    if (missing) {
+        fetchWindow(imageId, scope).then(() => prefetchNeighbours(image)).catch(() => {});
+    } else {
+        prefetchNeighbours(image);
+    }
+}
 
-            // Preload next and previous images
-            if (data.next_id) {
-                const nextImg = new Image();
-                nextImg.src = `/api/image/${data.next_id}`;
-            }
-            if (data.prev_id) {
-                const prevImg = new Image();
-                prevImg.src = `/api/image/${data.prev_id}`;
-            }
-        })
-        .catch(error => {
-            console.error('Error fetching image data:', error);
-            filenameEl.textContent = 'Error loading image.';
-        });
+function prefetchNeighbours(image) {
+    [image.prev_id, image.next_id].forEach(id => {
+        const neighbour = id && viewerCache.get(String(id));
+        if (neighbour) {
+            const img = new Image();
+            img.src = neighbour.preview_url;
+        }
+    });
 }
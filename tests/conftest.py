@@ -0,0 +1,26 @@
+import pytest
+import database
+import thumbnails
+
+@pytest.fixture
+def file_db(tmp_path):
+    """Fixture that points the database module at a temporary database file."""
+    db_path = str(tmp_path / 'test.db')
+    original_path = database.DB_PATH
+    database.configure(db_path)
+    database.create_table()
+    yield db_path
+    database.configure(original_path)
+
+@pytest.fixture(autouse=True)
+def no_thumbnail_warming(monkeypatch):
+    """Keeps scans in tests from starting the background thumbnail pool."""
+    monkeypatch.setattr(thumbnails, 'WARM_ON_SCAN', False)
+
+@pytest.fixture
+def thumbnail_dir(tmp_path, monkeypatch):
+    """Fixture that points the thumbnail store at a temporary directory."""
+    path = str(tmp_path / 'thumbnails')
+    monkeypatch.setattr(thumbnails, 'THUMBNAIL_DIR', path)
+    monkeypatch.setattr(thumbnails, '_store', thumbnails.DirectoryStore(path))
+    return path
@@ -1,5 +1,8 @@
+import os
 import pytest
+from PIL import Image
 import app as main_app
+import database
 import json
 from unittest.mock import patch
 
@@ -19,16 +22,50 @@ def test_index_route(client):
     """Test the main gallery page."""
     # Mock the database calls made by the index route
     with patch('database.get_available_years') as mock_get_years, \
-         patch('database.get_images_by_year_and_month') as mock_get_images:
+         patch('database.get_month_counts') as mock_get_counts, \
+         patch('database.get_images_page') as mock_get_page:
 
         mock_get_years.return_value = ['2023']
-        mock_get_images.return_value = [
-            {'id': 1, 'filepath': '/fake/dir/img1.jpg', 'filename': 'img1.jpg', 'date_taken': '2023-01-01T12:00:00'}
+        mock_get_counts.return_value = {1: 1}
+        mock_get_page.return_value = [
+            {'id': 1, 'filepath': '/fake/dir/img1.jpg', 'filename': 'img1.jpg', 'date_taken': '2023-01-01T12:00:00', 'month': 1}
         ]
 
         response = client.get('/')
         assert response.status_code == 200
         assert b"Photo Gallery" in response.data
+        assert b"January (1 photos)" in response.data
+        mock_get_page.assert_called_once_with('2023', None)
+
+def test_index_route_invalid_year(client, file_db):
+    """Test that a non-numeric year shows the newest year instead of failing."""
+    database.insert_images_bulk([{'filepath': '/fake/dir/a.jpg', 'filename': 'a.jpg', 'date_taken': '2021-03-04T05:06:07'}])
+    response = client.get('/?year=abc')
+    assert response.status_code == 200
+    assert b"March (1 photos)" in response.data
+
+def test_images_api_pagination(client):
+    """Test that the gallery API returns a page and a cursor for the next one."""
+    page = [
+        {'id': i, 'filepath': f'/fake/dir/img{i}.jpg', 'filename': f'img{i}.jpg', 'date_taken': f'2023-01-0{i}T12:00:00', 'month': 1}
+        for i in (1, 2)
+    ]
+    with patch('database.get_images_page') as mock_get_page:
+        mock_get_page.return_value = page
+        response = client.get('/api/images?year=2023&limit=2')
+        data = json.loads(response.data)
+        assert [image['id'] for image in data['images']] == [1, 2]
+        assert data['images'][0]['month_name'] == 'January'
+        assert data['next_cursor'] == '2023-01-02T12:00:00~2'
+
+        response = client.get('/api/images?year=2023&limit=2&cursor=' + data['next_cursor'])
+        mock_get_page.assert_called_with('2023', None, ('2023-01-02T12:00:00', 2), 2)
+
+        mock_get_page.return_value = page[:1]
+        data = json.loads(client.get('/api/images?year=2023&limit=2').data)
+        assert data['next_cursor'] is None
+
+    assert client.get('/api/images').status_code == 400
 
 def test_settings_page_get(client):
     """Test GET request to the settings page."""
@@ -56,6 +93,9 @@ def test_image_api_endpoint(client):
         assert data['filename'] == 'img1.jpg'
         assert 'full_image_url' in data
 
+        # The old context parameter is ignored, whatever it holds
+        assert client.get('/api/image/1?context=a').status_code == 200
+
 def test_scan_status_api(client):
     """Test the scan status API."""
     # Set a mock status
@@ -70,3 +110,192 @@ def test_scan_status_api(client):
 
     # Reset for other tests
     main_app.scan_status['is_scanning'] = False
+
+def _add_image(tmp_path):
+    path = tmp_path / 'img1.jpg'
+    Image.new('RGB', (800, 600), color='blue').save(path, 'JPEG')
+    stat = os.stat(path)
+    database.insert_image({'filepath': str(path), 'filename': 'img1.jpg', 'date_taken': '2023-01-01T12:00:00',
+                           'date_modified': '2023-01-01T12:00:00', 'filesize': stat.st_size, 'width': 800, 'height': 600,
+                           'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino})
+    return database.get_all_images()[0]
+
+def test_thumbnail_http_caching(client, tmp_path, file_db, thumbnail_dir):
+    """Test that versioned thumbnail URLs are immutable and revalidate without a database lookup."""
+    record = _add_image(tmp_path)
+    with main_app.app.test_request_context():
+        url = main_app.thumbnail_url(record)
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert 'immutable' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+
+    with patch('database.get_image_by_id') as mock_get_image:
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        response = client.get(url, headers={'If-Modified-Since': 'Sun, 01 Jan 2023 00:00:00 GMT'})
+        assert response.status_code == 304
+        mock_get_image.assert_not_called()
+
+    # Unversioned URLs are revalidated against the current fingerprint
+    response = client.get(f"/thumbnail/{record['id']}", headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+def test_full_image_range(client, tmp_path, file_db):
+    """Test that originals are served with an ETag and honour Range requests."""
+    record = _add_image(tmp_path)
+    response = client.get(f"/image/full/{record['id']}", headers={'Range': 'bytes=0-99'})
+    assert response.status_code == 206
+    assert len(response.data) == 100
+    assert response.headers['ETag'] == f'"{main_app.image_version(record)}"'
+    assert client.get('/image/full/999').status_code == 404
+
+def test_preview_image(client, tmp_path, file_db, thumbnail_dir):
+    """Test that the viewer API points at a cached, screen-sized preview."""
+    record = _add_image(tmp_path)
+    data = json.loads(client.get(f"/api/image/{record['id']}").data)
+    assert data['preview_url'].startswith(f"/image/preview/{record['id']}?v=")
+
+    response = client.get(data['preview_url'])
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert 'immutable' in response.headers['Cache-Control']
+    response = client.get(data['preview_url'], headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+
+def test_image_window_api(client, file_db):
+    """Test that the viewer window carries prev/next ids, including at its edges."""
+    database.insert_images_bulk({'filepath': f'/p/{i}.jpg', 'filename': f'{i}.jpg', 'date_taken': f'2023-01-0{i + 1}T00:00:00'}
+                                for i in range(5))
+    ids = [row['id'] for row in database.get_images_page('2023')]
+
+    data = json.loads(client.get(f'/api/image/{ids[2]}/window?radius=1&year=2023').data)
+    assert [image['id'] for image in data['images']] == ids[1:4]
+    assert data['images'][0]['prev_id'] == ids[0]
+    assert data['images'][-1]['next_id'] == ids[4]
+    assert data['images'][1]['preview_url'].startswith(f'/image/preview/{ids[2]}?v=')
+    assert client.get('/api/image/9999/window').status_code == 404
+
+    data = json.loads(client.get(f'/api/images/batch?ids={ids[3]},{ids[0]}').data)
+    assert [image['id'] for image in data['images']] == [ids[3], ids[0]]
+    assert client.get('/api/images/batch?ids=a').status_code == 400
+
+def test_metrics_endpoint(client):
+    """Test that request timings are exposed in the Prometheus text format."""
+    client.get('/settings')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert '# TYPE photomanager_http_request_seconds histogram' in text
+    assert 'photomanager_http_request_seconds_count{route="/settings",method="GET",status="200"}' in text
+    assert '# TYPE photomanager_db_query_seconds histogram' in text
+
+def test_duplicates_api(client, file_db):
+    """Test that exact and near duplicate groups are returned with viewer metadata."""
+    database.insert_images_bulk({'filepath': f'/p/{i}.jpg', 'filename': f'{i}.jpg', 'date_taken': '2023-01-01T00:00:00'}
+                                for i in range(4))
+    database.update_hashes_bulk('content_hash', [(1, 'abc'), (2, 'abc')])
+    database.update_hashes_bulk('phash', [(1, 0), (2, 0), (3, 0b111), (4, -1)])
+
+    data = json.loads(client.get('/api/duplicates').data)
+    assert [[image['id'] for image in group] for group in data['groups']] == [[1, 2]]
+    assert data['groups'][0][0]['preview_url'].startswith('/image/preview/1?v=')
+
+    data = json.loads(client.get('/api/duplicates?near=1').data)
+    assert [[image['id'] for image in group] for group in data['groups']] == [[1, 2, 3]]
+
+    data = json.loads(client.get('/api/image/3/similar?distance=2').data)
+    assert data['images'] == []
+    data = json.loads(client.get('/api/image/3/similar').data)
+    assert [(image['id'], image['distance']) for image in data['images']] == [(1, 3), (2, 3)]
+
+def test_semantic_search_mode(client, file_db, tmp_path):
+    """Test that the semantic mode ranks by embedding and is offered only when enabled."""
+    import embeddings
+    database.insert_images_bulk({'filepath': f'/p/{i}.jpg', 'filename': f'{i}.jpg', 'date_taken': '2023-01-01T00:00:00'}
+                                for i in range(2))
+    database.update_llm_tags(1, ['beach', 'sea'])
+    database.update_llm_tags(2, ['snow', 'mountain'])
+    assert b'mode-semantic' not in client.get('/search').data
+
+    embeddings.configure(True, path=str(tmp_path / 'embeddings'))
+    try:
+        embeddings.backfill()
+        response = client.get('/search?query=mountains&mode=semantic')
+        assert b'mode-semantic' in response.data
+        assert response.data.index(b'1.jpg') < response.data.index(b'0.jpg')
+    finally:
+        embeddings.configure(False)
+
+def test_timeline_api(client, file_db):
+    """Test that the timeline lists months newest first with counts and cover thumbnails."""
+    database.insert_images_bulk({'filepath': f'/p/{i}.jpg', 'filename': f'{i}.jpg', 'date_taken': date}
+                                for i, date in enumerate(['2023-01-05T00:00:00', '2023-01-02T00:00:00', '2022-07-01T00:00:00']))
+    data = json.loads(client.get('/api/timeline').data)
+    assert [(month['year'], month['month'], month['count'], month['cover_image_id']) for month in data['months']] \
+        == [(2023, 1, 2, 2), (2022, 7, 1, 3)]
+    assert data['months'][0]['cover_thumbnail_url'].startswith('/thumbnail/2?v=')
+
+def test_job_queue_mode(client, file_db, monkeypatch):
+    """Test that with the job queue scans and watcher restarts are queued for workers and reported by the status APIs."""
+    import jobs
+    manager = jobs.QueuedScanManager()
+    monkeypatch.setattr(main_app, 'JOB_QUEUE', True)
+    monkeypatch.setattr(main_app, 'WATCH_MODE', 'poll')
+    monkeypatch.setattr(main_app, 'POLL_SWEEP_MINUTES', 30)
+    monkeypatch.setattr(main_app, 'scan_manager', manager)
+    monkeypatch.setattr(main_app, 'scan_status', manager.status)
+
+    assert main_app.start_scan()
+    main_app.restart_watcher()
+    assert main_app.library_watcher is None
+    payload = database.get_db_connection().execute("SELECT payload FROM jobs WHERE kind = 'watch'").fetchone()[0]
+    assert json.loads(payload)['sweep_interval'] == 1800
+
+    data = json.loads(client.get('/api/scan-status').data)
+    assert data['is_scanning'] is True
+    assert data['message'] == 'Waiting for a worker...'
+    assert json.loads(client.get('/api/jobs').data) == {'scan': {'queued': 1}, 'watch': {'queued': 1}}
+
+def test_location_and_camera_apis(client, file_db):
+    """Test the bounding box, camera filter and camera list APIs."""
+    database.insert_images_bulk([
+        {'filepath': '/p/a.jpg', 'filename': 'a.jpg', 'date_taken': '2023-01-01T00:00:00', 'latitude': 48.86, 'longitude': 2.35,
+         'camera_model': 'X100', 'lens_model': '23mm'},
+        {'filepath': '/p/b.jpg', 'filename': 'b.jpg', 'date_taken': '2023-01-02T00:00:00', 'latitude': 51.5, 'longitude': -0.12,
+         'camera_model': 'EOS R5'},
+    ])
+    data = json.loads(client.get('/api/images/bbox?bbox=-1,48,3,52').data)
+    assert [image['filename'] for image in data['images']] == ['b.jpg', 'a.jpg']
+    assert data['images'][0]['thumbnail_url'].startswith('/thumbnail/2?v=')
+    data = json.loads(client.get('/api/images/bbox?bbox=-1,48,3,52&camera=X100').data)
+    assert [image['filename'] for image in data['images']] == ['a.jpg']
+    assert client.get('/api/images/bbox?bbox=1,2,3').status_code == 400
+
+    data = json.loads(client.get('/api/images/camera?lens=23mm').data)
+    assert [image['filename'] for image in data['images']] == ['a.jpg']
+    assert client.get('/api/images/camera').status_code == 400
+    assert json.loads(client.get('/api/cameras').data) == {
+        'cameras': [{'camera_model': 'EOS R5', 'count': 1}, {'camera_model': 'X100', 'count': 1}],
+        'lenses': [{'lens_model': '23mm', 'count': 1}]}
+
+def test_wsgi_entry_point_loads_config(tmp_path, monkeypatch):
+    """Test that importing the WSGI module loads config.json, as each server process does."""
+    import importlib
+    import sys
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'config.json').write_text(json.dumps({'image_dirs': [str(tmp_path)], 'database': str(tmp_path / 'w.db')}))
+    original_path = database.DB_PATH
+    monkeypatch.setattr(main_app, 'IMAGE_DIRS', [])
+    monkeypatch.delitem(sys.modules, 'wsgi', raising=False)
+    try:
+        wsgi = importlib.import_module('wsgi')
+        assert wsgi.app is main_app.app
+        assert main_app.IMAGE_DIRS == [str(tmp_path)]
+        assert os.path.exists(tmp_path / 'w.db')
+    finally:
+        database.configure(original_path)
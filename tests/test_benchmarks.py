@@ -0,0 +1,37 @@
+import json
+import os
+from PIL import Image
+import app as main_app
+import database
+import scanner
+import thumbnails
+from benchmarks import run, synthetic
+
+def test_generate_library(tmp_path):
+    """Test that synthetic images are nested by date and carry their EXIF date."""
+    paths = synthetic.generate_library(str(tmp_path), 5)
+    assert len(paths) == 5
+    for path in paths:
+        year, month = os.path.relpath(path, tmp_path).split(os.sep)[:2]
+        assert scanner.get_date_taken(path).startswith(f"{year}-{month}")
+        with Image.open(path) as img:
+            assert img.size == (64, 48)
+
+def test_runner_smoke(tmp_path, monkeypatch):
+    """Test that a tiny run of every group writes comparable JSON results."""
+    original_path = database.DB_PATH
+    # The runner reconfigures these module settings; restore them afterwards
+    for name in ('_store', 'THUMBNAIL_DIR', 'STORE_KIND', 'BUDGET_BYTES', 'PREVIEW_SIZE', 'PREVIEW_FORMAT'):
+        monkeypatch.setattr(thumbnails, name, getattr(thumbnails, name))
+    monkeypatch.setattr(main_app, 'IMAGE_DIRS', main_app.IMAGE_DIRS)
+    output = tmp_path / 'results.json'
+    args = ['--sizes', '300', '--scan-images', '20', '--thumbnail-images', '1', '--thumbnail-source-size', '800', '600',
+            '--repeat', '2', '--workers', '1', '--output', str(output)]
+    try:
+        assert run.main(args) == 0
+        results = json.loads(output.read_text())
+        assert results['results']['scan']['scan_full']['images'] == 20
+        assert results['results']['queries_300']['search_and']['runs'] == 2
+        assert run.compare(results, results)
+    finally:
+        database.configure(original_path)
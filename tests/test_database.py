@@ -1,5 +1,6 @@
 import pytest
 import sqlite3
+import threading
 from unittest.mock import patch
 import database
 
@@ -74,3 +75,218 @@ def test_remove_images_by_path(memory_db):
     remaining_images = database.get_all_images()
     assert len(remaining_images) == 1
     assert remaining_images[0]['filename'] == 'img3.jpg'
+
+def test_insert_images_bulk(file_db):
+    """Test that bulk inserts commit in chunks and ignore duplicate paths."""
+    images = ({'filepath': f'/bulk/img{i}.jpg', 'filename': f'img{i}.jpg'} for i in range(25))
+    assert database.insert_images_bulk(images, chunk_size=10) == 25
+
+    duplicates = [{'filepath': '/bulk/img0.jpg', 'filename': 'img0.jpg'}, {'filepath': '/bulk/new.jpg', 'filename': 'new.jpg'}]
+    assert database.insert_images_bulk(duplicates) == 1
+    assert len(database.get_all_filepaths()) == 26
+
+def test_delete_images_bulk(file_db):
+    """Test deleting a set of filepaths in chunks."""
+    database.insert_images_bulk({'filepath': f'/bulk/img{i}.jpg', 'filename': f'img{i}.jpg'} for i in range(5))
+
+    deleted = database.delete_images_bulk(['/bulk/img0.jpg', '/bulk/img3.jpg', '/bulk/missing.jpg'], chunk_size=2)
+    assert deleted == 2
+    assert database.get_all_filepaths() == {'/bulk/img1.jpg', '/bulk/img2.jpg', '/bulk/img4.jpg'}
+
+def test_create_table_upgrades_old_schema(file_db):
+    """Test that columns added after the original schema are added in place."""
+    conn = sqlite3.connect(file_db)
+    conn.execute('PRAGMA user_version = 0')
+    conn.execute('DROP TABLE images')
+    conn.execute('CREATE TABLE images (id INTEGER PRIMARY KEY AUTOINCREMENT, filepath TEXT NOT NULL UNIQUE, filename TEXT NOT NULL, '
+                 'date_taken TEXT, date_modified TEXT, filesize INTEGER, width INTEGER, height INTEGER, llm_tags TEXT)')
+    conn.execute("INSERT INTO images (filepath, filename, filesize) VALUES ('/old/img.jpg', 'img.jpg', 10)")
+    conn.commit()
+    conn.close()
+
+    database.create_table()
+    assert database.get_image_fingerprints() == {'/old/img.jpg': (None, 10, None, None)}
+
+def test_connection_pool(file_db):
+    """Test that connections are per thread, use WAL and are reused after release."""
+    conn = database.get_db_connection()
+    assert database.get_db_connection() is conn
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    other = {}
+    thread = threading.Thread(target=lambda: other.update(conn=database.get_db_connection()))
+    thread.start()
+    thread.join()
+    assert other['conn'] is not conn
+
+    database.release_db_connection()
+    thread = threading.Thread(target=lambda: other.update(conn=database.get_db_connection()))
+    thread.start()
+    thread.join()
+    assert other['conn'] is conn
+
+def test_migrations_are_recorded(file_db):
+    """Test that migrations bump user_version and are not re-applied."""
+    conn = database.get_db_connection()
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(database.MIGRATIONS)
+    database.create_table()
+    indexes = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'idx_images_date_taken', 'idx_images_year_month', 'idx_images_filename'} <= indexes
+
+def test_year_and_month_ranges(file_db):
+    """Test the indexed year list and month ranges, including December."""
+    database.insert_images_bulk([
+        {'filepath': 'a.jpg', 'filename': 'a.jpg', 'date_taken': '2022-12-31T23:59:59'},
+        {'filepath': 'b.jpg', 'filename': 'b.jpg', 'date_taken': '2023-01-01T00:00:00'},
+        {'filepath': 'c.jpg', 'filename': 'c.jpg', 'date_taken': '2020-06-01T00:00:00'},
+    ])
+    assert database.get_available_years() == ['2023', '2022', '2020']
+    assert [row['filename'] for row in database.get_images_by_year_and_month('2022', 12)] == ['a.jpg']
+    assert database.get_image_by_id(1)['month'] == 12
+
+def _tagged(filename, date_taken, tags):
+    database.insert_image({'filepath': f'/tags/{filename}', 'filename': filename, 'date_taken': date_taken})
+    image_id = database.get_db_connection().execute('SELECT id FROM images WHERE filename = ?', (filename,)).fetchone()['id']
+    database.update_llm_tags(image_id, tags)
+    return image_id
+
+def test_search_images_by_tag(file_db):
+    """Test exact, AND, OR and prefix tag searches."""
+    _tagged('cat.jpg', '2023-01-01T00:00:00', ['cat', 'indoor'])
+    _tagged('category.jpg', '2023-02-01T00:00:00', ['Category', 'chart'])
+    _tagged('dog.jpg', '2023-03-01T00:00:00', ['dog', 'outdoor'])
+
+    def names(query):
+        return [row['filename'] for row in database.search_images_by_tag(query)]
+
+    assert names('cat') == ['cat.jpg']
+    assert names('cat*') == ['category.jpg', 'cat.jpg']
+    assert names('cat indoor') == ['cat.jpg']
+    assert names('cat outdoor') == []
+    assert names('cat OR dog') == ['dog.jpg', 'cat.jpg']
+    # Images matching more terms rank first
+    assert names('dog outdoor OR cat') == ['dog.jpg', 'cat.jpg']
+    assert names('') == []
+
+def test_tag_index_follows_images(file_db):
+    """Test that tag rows are replaced on re-tagging and removed with their image."""
+    image_id = _tagged('cat.jpg', '2023-01-01T00:00:00', ['cat'])
+    database.update_llm_tags(image_id, ['lion'])
+    assert database.search_images_by_tag('cat') == []
+    assert len(database.search_images_by_tag('lion')) == 1
+
+    database.delete_images_bulk(['/tags/cat.jpg'])
+    conn = database.get_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM image_tags').fetchone()[0] == 0
+
+def test_get_images_page(file_db):
+    """Test keyset pagination through a year, including images sharing a timestamp."""
+    database.insert_images_bulk({'filepath': f'/p/{i}.jpg', 'filename': f'{i}.jpg', 'date_taken': f'2023-0{1 + i // 4}-01T00:00:00'}
+                                for i in range(10))
+    database.insert_image({'filepath': '/p/other.jpg', 'filename': 'other.jpg', 'date_taken': '2024-01-01T00:00:00'})
+
+    seen = []
+    after = None
+    while True:
+        page = database.get_images_page('2023', after=after, limit=3)
+        seen.extend(row['filename'] for row in page)
+        if len(page) < 3:
+            break
+        after = (page[-1]['date_taken'], page[-1]['id'])
+    assert seen == [f'{i}.jpg' for i in range(10)]
+    assert database.get_month_counts('2023') == {1: 4, 2: 4, 3: 2}
+    assert len(database.get_images_page('2023', month=2)) == 4
+
+def test_get_timeline_window(file_db):
+    """Test that the viewer window follows gallery order and respects the year scope."""
+    database.insert_images_bulk({'filepath': f'/p/{i}.jpg', 'filename': f'{i}.jpg', 'date_taken': f'2023-0{1 + i // 4}-01T00:00:00'}
+                                for i in range(10))
+    database.insert_image({'filepath': '/p/other.jpg', 'filename': 'other.jpg', 'date_taken': '2024-01-01T00:00:00'})
+    ids = {row['filename']: row['id'] for row in database.get_all_images()}
+
+    window = database.get_timeline_window(ids['4.jpg'], radius=2)
+    assert [row['filename'] for row in window] == ['2.jpg', '3.jpg', '4.jpg', '5.jpg', '6.jpg']
+    window = database.get_timeline_window(ids['9.jpg'], radius=2)
+    assert [row['filename'] for row in window] == ['7.jpg', '8.jpg', '9.jpg', 'other.jpg']
+    window = database.get_timeline_window(ids['9.jpg'], radius=2, year='2023')
+    assert [row['filename'] for row in window] == ['7.jpg', '8.jpg', '9.jpg']
+    assert database.get_timeline_window(9999) == []
+
+    rows = database.get_images_by_ids([ids['3.jpg'], 9999, ids['1.jpg']])
+    assert [row['filename'] for row in rows] == ['3.jpg', '1.jpg']
+
+def _timeline_from_images():
+    conn = database.get_db_connection()
+    rows = conn.execute("""
+        SELECT year, month, COUNT(*) AS count,
+               (SELECT id FROM images AS first WHERE first.year = images.year AND first.month = images.month
+                ORDER BY date_taken, id LIMIT 1) AS cover
+        FROM images WHERE year IS NOT NULL GROUP BY year, month
+    """).fetchall()
+    return {(row['year'], row['month']): (row['count'], row['cover']) for row in rows}
+
+def _timeline_summary():
+    return {(row['year'], row['month']): (row['count'], row['id']) for row in database.get_timeline()}
+
+def test_timeline_counts_follow_images(file_db):
+    """Test that the timeline summary matches the images table through inserts, re-dating, deletes and folder removal."""
+    import random
+    rng = random.Random(3)
+    database.insert_images_bulk({'filepath': f'/{folder}/{i}.jpg', 'filename': f'{i}.jpg',
+                                 'date_taken': f'202{rng.randint(0, 2)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T00:00:00'}
+                                for folder in ('a', 'b') for i in range(200))
+    database.insert_image({'filepath': '/a/undated.jpg', 'filename': 'undated.jpg'})
+    assert _timeline_summary() == _timeline_from_images()
+    assert sum(database.get_month_counts('2021').values()) == len(database.get_images_by_year_and_month('2021'))
+
+    # Covers move when the first image of a month is re-dated or deleted
+    covers = [cover for _, cover in _timeline_summary().values()]
+    database.update_images_bulk({'filepath': image['filepath'], 'filename': image['filename'], 'date_taken': '2019-01-01T00:00:00'}
+                                for image in database.get_images_by_ids(covers[:5]))
+    database.delete_images_bulk(image['filepath'] for image in database.get_images_by_ids(covers[5:10]))
+    assert _timeline_summary() == _timeline_from_images()
+    assert database.get_available_years()[-1] == '2019'
+
+    database.remove_images_by_path('/a/')
+    assert _timeline_summary() == _timeline_from_images()
+    database.remove_images_by_path('/b/')
+    assert _timeline_summary() == {}
+    assert database.get_available_years() == []
+
+def test_timeline_counts_migration(file_db):
+    """Test that the summary is built from existing images when the migration runs."""
+    database.insert_images_bulk({'filepath': f'/p/{i}.jpg', 'filename': f'{i}.jpg', 'date_taken': f'2023-0{i % 3 + 1}-01T00:00:00'}
+                                for i in range(9))
+    conn = database.get_db_connection()
+    with conn:
+        conn.execute('DELETE FROM timeline_counts')
+    conn.execute(f'PRAGMA user_version = {database.MIGRATIONS.index(database._migrate_timeline_counts)}')
+    database.create_table()
+    assert _timeline_summary() == _timeline_from_images()
+    assert database.get_month_counts('2023') == {1: 3, 2: 3, 3: 3}
+
+def test_images_in_bbox(file_db):
+    """Test that the location index follows inserts, moves and deletes, and answers bounding boxes and camera filters."""
+    places = {'sydney': (-33.86, 151.21), 'auckland': (-36.85, 174.76), 'fiji': (-17.71, 178.07),
+              'samoa': (-13.76, -172.10), 'paris': (48.86, 2.35)}
+    database.insert_images_bulk({'filepath': f'/p/{name}.jpg', 'filename': f'{name}.jpg', 'date_taken': f'2023-01-0{i + 1}T00:00:00',
+                                 'latitude': lat, 'longitude': lon, 'camera_model': 'X100' if i % 2 else 'EOS R5'}
+                                for i, (name, (lat, lon)) in enumerate(places.items()))
+    database.insert_image({'filepath': '/p/nowhere.jpg', 'filename': 'nowhere.jpg', 'date_taken': '2023-01-09T00:00:00'})
+
+    def names(*bbox, **filters):
+        return [row['filename'] for row in database.get_images_in_bbox(*bbox, **filters)]
+
+    assert names(-40, 150, -30, 180) == ['auckland.jpg', 'sydney.jpg']
+    # Across the antimeridian, and exactly on the box's edge
+    assert names(-20, 178, -10, -172.10) == ['samoa.jpg', 'fiji.jpg']
+    assert names(-90, -180, 90, 180, camera_model='X100') == ['samoa.jpg', 'auckland.jpg']
+
+    database.update_metadata_bulk([{'filepath': '/p/paris.jpg', 'latitude': -33.9, 'longitude': 151.3}])
+    database.delete_images_bulk(['/p/sydney.jpg'])
+    assert names(-40, 150, -30, 152) == ['paris.jpg']
+    conn = database.get_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM image_locations').fetchone()[0] == 4
+
+    assert database.get_camera_counts() == ([('X100', 2), ('EOS R5', 1)], [])
+    assert [row['filename'] for row in database.get_images_by_camera('X100')] == ['samoa.jpg', 'auckland.jpg']
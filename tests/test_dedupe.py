@@ -0,0 +1,132 @@
+import random
+import shutil
+from PIL import Image
+import database
+import dedupe
+import thumbnails
+
+def _gradient(path, size=(320, 240), flip=False):
+    img = Image.linear_gradient('L').rotate(90).resize(size).convert('RGB')
+    if flip:
+        img = img.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    img.save(path, 'JPEG', quality=90)
+    return str(path)
+
+def test_bktree_search():
+    """Test that the BK-tree finds exactly the hashes within the distance."""
+    rng = random.Random(1)
+    values = [rng.getrandbits(64) for _ in range(500)]
+    tree = dedupe.BKTree()
+    for i, value in enumerate(values):
+        tree.add(value, i)
+    assert len(tree) == 500
+    query = values[0] ^ 0b1011
+    for max_distance in (0, 3, 20):
+        expected = {i for i, value in enumerate(values) if dedupe.hamming_distance(query, value) <= max_distance}
+        assert {item for _, item in tree.search(query, max_distance)} == expected
+
+def test_signed_round_trip():
+    for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        assert -(1 << 63) <= dedupe.to_signed(value) < (1 << 63)
+        assert dedupe.to_unsigned(dedupe.to_signed(value)) == value
+
+def test_dhash_near_duplicates(tmp_path):
+    """Test that a resized re-encode hashes close to the original and a flipped image does not."""
+    original = dedupe.dhash(_gradient(tmp_path / 'a.jpg'))
+    resized = dedupe.dhash(_gradient(tmp_path / 'b.jpg', size=(160, 120)))
+    flipped = dedupe.dhash(_gradient(tmp_path / 'c.jpg', flip=True))
+    assert dedupe.hamming_distance(original, resized) <= dedupe.NEAR_DUPLICATE_DISTANCE
+    assert dedupe.hamming_distance(original, flipped) > dedupe.NEAR_DUPLICATE_DISTANCE
+
+def test_update_hashes(tmp_path, file_db, thumbnail_dir):
+    """Test that only size collisions are content-hashed and duplicates share tags and thumbnails."""
+    import scanner
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    _gradient(photos / 'a.jpg')
+    shutil.copy(photos / 'a.jpg', photos / 'copy.jpg')
+    _gradient(photos / 'small.jpg', size=(160, 120))
+    scanner.scan_directories([str(photos)], workers=1)
+
+    images = {image['filename']: image for image in database.get_all_images()}
+    assert images['a.jpg']['content_hash'] == images['copy.jpg']['content_hash'] is not None
+    assert images['small.jpg']['content_hash'] is None
+    assert all(image['phash'] is not None for image in images.values())
+    assert thumbnails.fingerprint_key(images['a.jpg']) == thumbnails.fingerprint_key(images['copy.jpg'])
+
+    groups = database.get_exact_duplicate_groups()
+    assert [sorted(image['filename'] for image in group) for group in groups] == [['a.jpg', 'copy.jpg']]
+    near = dedupe.find_near_duplicates()
+    assert near == [sorted(image['id'] for image in images.values())]
+    assert [image_id for _, image_id in dedupe.find_similar(images['small.jpg']['id'])] \
+        == sorted([images['a.jpg']['id'], images['copy.jpg']['id']])
+
+    database.update_llm_tags(images['a.jpg']['id'], ['sky'])
+    assert [image_id for image_id, _, _ in database.copy_tags_to_duplicates()] == [images['copy.jpg']['id']]
+    assert database.get_image_by_id(images['copy.jpg']['id'])['llm_tags'] == 'sky'
+
+    # Nothing is re-hashed on the next scan
+    assert dedupe.update_hashes(workers=1) == (0, 0, 0)
+
+def test_shared_thumbnails_outlive_one_duplicate(tmp_path, file_db, thumbnail_dir):
+    """Test that thumbnails under a content key are discarded with the last image that has that content."""
+    import scanner
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    _gradient(photos / 'a.jpg')
+    shutil.copy(photos / 'a.jpg', photos / 'copy.jpg')
+    scanner.scan_directories([str(photos)], workers=1)
+    image = database.get_all_images()[0]
+    assert image['content_hash'] is not None
+    key = thumbnails.fingerprint_key(image)
+    thumbnails.get_thumbnail(image)
+    assert thumbnails.get_store().get(key, thumbnails.DEFAULT_SIZE) is not None
+
+    (photos / 'copy.jpg').unlink()
+    scanner.scan_directories([str(photos)], workers=1)
+    assert thumbnails.get_store().get(key, thumbnails.DEFAULT_SIZE) is not None
+
+    (photos / 'a.jpg').unlink()
+    scanner.scan_directories([str(photos)], workers=1)
+    assert thumbnails.get_store().get(key, thumbnails.DEFAULT_SIZE) is None
+
+def test_warming_after_hash_uses_content_key(tmp_path, file_db, thumbnail_dir):
+    """Test that thumbnails warmed after an image's content hash was recorded land under its content key."""
+    import scanner
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    for name in ('a.jpg', 'b.jpg'):
+        _gradient(photos / name)
+    scanner.apply_changes(updated=[str(photos)], workers=1)
+    images = {image['filename']: image for image in database.get_all_images()}
+    # Queued at scan time, before the images were hashed
+    items = [(image['filepath'], thumbnails.fingerprint_key(image)) for image in images.values()]
+    dedupe.record_content_hashes((image, 'f' * 16) for image in images.values())
+    content_key = thumbnails.fingerprint_key(database.get_image_by_id(images['a.jpg']['id']))
+
+    # A thumbnail job resolves the current key before rendering ...
+    thumbnails.warm_now(items[:1])
+    # ... and pool renders are moved once they are done
+    thumbnails._finish_warm(thumbnails._warm_chunk(items[1:]))
+    store = thumbnails.get_store()
+    assert store.get(content_key, thumbnails.DEFAULT_SIZE) is not None
+    assert all(store.get(key, thumbnails.DEFAULT_SIZE) is None for _, key in items)
+
+def test_index_is_cached_until_hashes_change(file_db, monkeypatch):
+    """Test that the BK-tree is reused between lookups and rebuilt after a perceptual hash is written."""
+    database.insert_images_bulk({'filepath': f'/photos/{i}.jpg', 'filename': f'{i}.jpg'} for i in range(3))
+    database.update_hashes_bulk('phash', [(1, 0), (2, 0b111)])
+    builds = []
+    build_index = dedupe.build_index
+    monkeypatch.setattr(dedupe, 'build_index', lambda rows=None: builds.append(1) or build_index(rows))
+
+    assert dedupe.find_similar(1) == [(3, 2)]
+    assert dedupe.find_near_duplicates() == [[1, 2]]
+    assert len(builds) == 1
+
+    database.update_hashes_bulk('phash', [(3, 0b1)])
+    assert dedupe.find_similar(1) == [(1, 3), (3, 2)]
+    assert len(builds) == 2
+    database.delete_images_bulk(['/photos/1.jpg'])
+    assert dedupe.find_similar(1) == [(1, 3)]
+    assert len(builds) == 3
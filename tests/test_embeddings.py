@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import numpy as np
+import pytest
+import database
+import embeddings
+import llm_processor
+
+@pytest.fixture
+def semantic_search(tmp_path):
+    """Fixture that enables embeddings with a store in a temporary directory."""
+    embeddings.configure(True, path=str(tmp_path / 'embeddings'))
+    yield
+    embeddings.configure(False)
+
+def test_store_add_and_search(tmp_path):
+    """Test cosine ranking, replacement of re-embedded images and persistence across reopening."""
+    path = str(tmp_path / 'store')
+    store = embeddings.EmbeddingStore(path, 3, 'test')
+    store.add([1, 2, 3], [[1, 0, 0], [0, 1, 0], [1, 1, 0]])
+    assert [image_id for image_id, _ in store.search([1, 0.1, 0], 2)] == [1, 3]
+
+    store.add([1], [[0, 0, 1]])
+    assert len(store) == 3
+    assert [image_id for image_id, _ in store.search([1, 0.1, 0], 2)] == [3, 2]
+
+    reopened = embeddings.EmbeddingStore(path, 3, 'test')
+    assert reopened.search([0, 0, 1], 1)[0][0] == 1
+    assert len(embeddings.EmbeddingStore(path, 3, 'other model')) == 0
+
+def test_store_drops_partial_writes(tmp_path):
+    """Test that vectors (and id bytes) left by a writer that crashed mid-append are cut off, not misaligned."""
+    path = str(tmp_path / 'store')
+    store = embeddings.EmbeddingStore(path, 3, 'test')
+    store.add([1], [[1, 0, 0]])
+    # Crashed between writing the vectors and the ids of the next add
+    with open(f"{path}.f32", 'ab') as f:
+        np.array([[0, 0, 1], [0, 0, 1]], dtype=np.float32).tofile(f)
+
+    store.add([2], [[0, 1, 0]])
+    assert store.search([0, 1, 0], 1) == [(2, pytest.approx(1))]
+
+    with open(f"{path}.ids", 'ab') as f:
+        f.write(b'\0\0\0')
+    reopened = embeddings.EmbeddingStore(path, 3, 'test')
+    assert len(reopened) == 2
+    assert (tmp_path / 'store.ids').stat().st_size == 16
+    assert (tmp_path / 'store.f32').stat().st_size == 2 * 3 * 4
+
+def test_ivf_index_matches_exhaustive(tmp_path):
+    """Test that IVF search finds the exhaustive top results on clustered vectors, including rows added after the build."""
+    rng = np.random.default_rng(0)
+    centres = rng.standard_normal((20, 16), dtype=np.float32)
+    store = embeddings.EmbeddingStore(str(tmp_path / 'store'), 16, 'test')
+    store.add(range(2000), centres[rng.integers(20, size=2000)] + 0.1 * rng.standard_normal((2000, 16), dtype=np.float32))
+    store.build_index()
+    store.add([5000], [centres[3]])
+
+    for centre in centres[:5]:
+        exhaustive = store.search(centre, 10, exhaustive=True)
+        assert [image_id for image_id, _ in store.search(centre, 10)] == [image_id for image_id, _ in exhaustive]
+    assert store.search(centres[3], 1)[0][0] == 5000
+
+def test_hashing_embedder():
+    """Test that the stand-in model is deterministic and places related words close together."""
+    embedder = embeddings.HashingEmbedder()
+    cat = embedder.embed_text('cat')
+    assert np.array_equal(cat, embeddings.HashingEmbedder().embed_text('cat'))
+    assert cat @ embedder.embed_text('cats') > cat @ embedder.embed_text('road')
+
+def test_tagger_stores_embeddings(file_db, semantic_search):
+    """Test that tagging embeds images and that images tagged before are back-filled."""
+    database.insert_images_bulk({'filepath': f'/photos/img{i}.jpg', 'filename': f'img{i}.jpg'} for i in range(4))
+    database.update_llm_tags(4, ['car', 'road'])
+
+    with patch('llm_processor.process_images_batch', side_effect=lambda paths: [['cat', 'sofa']] * len(paths)), \
+         ThreadPoolExecutor(max_workers=2) as executor:
+        llm_processor.tag_images(llm_processor.iter_untagged_images(), executor, batch_size=2)
+    assert len(embeddings.get_store()) == 3
+
+    assert embeddings.backfill() == 1
+    assert embeddings.backfill() == 0
+    assert embeddings.search('cars', limit=1)[0][0] == 4
+
+def test_tag_copies_are_embedded(file_db, semantic_search):
+    """Test that exact duplicates tagged with a copy of their original's tags get embeddings without a backfill."""
+    database.insert_images_bulk({'filepath': f'/photos/{name}.jpg', 'filename': f'{name}.jpg', 'content_hash': 'same'}
+                                for name in ('a', 'b', 'c'))
+
+    with patch('llm_processor.process_images_batch', side_effect=lambda paths: [['cat', 'sofa']] * len(paths)) as model, \
+         ThreadPoolExecutor(max_workers=2) as executor:
+        assert llm_processor.tag_images(llm_processor.iter_untagged_images(), executor) == 3
+    assert model.call_count == 1
+    assert len(embeddings.get_store()) == 3
+    assert embeddings.backfill() == 0
@@ -0,0 +1,78 @@
+import struct
+import pytest
+from PIL import Image
+import exif
+
+def _camera_exif():
+    tags = Image.Exif()
+    tags[exif.MAKE] = 'Canon'
+    tags[exif.MODEL] = 'EOS R5'
+    tags[exif.ORIENTATION] = 6
+    exif_ifd = tags.get_ifd(exif.EXIF_IFD_POINTER)
+    exif_ifd[exif.DATE_TIME_ORIGINAL] = '2023:05:06 07:08:09'
+    exif_ifd[exif.OFFSET_TIME_ORIGINAL] = '+10:00'
+    exif_ifd[exif.LENS_MODEL] = 'RF24-70mm F2.8 L'
+    gps = tags.get_ifd(exif.GPS_IFD_POINTER)
+    gps[exif.GPS_LATITUDE_REF] = 'S'
+    gps[exif.GPS_LATITUDE] = (33.0, 51.0, 30.6)
+    gps[exif.GPS_LONGITUDE_REF] = 'E'
+    gps[exif.GPS_LONGITUDE] = (151.0, 12.0, 36.0)
+    return tags
+
+@pytest.mark.parametrize('fmt', ['JPEG', 'PNG'])
+def test_read_metadata(tmp_path, fmt):
+    """Test that the header parser reads the dimensions and every EXIF field of JPEG and PNG files."""
+    path = tmp_path / f'a.{fmt.lower()}'
+    Image.new('RGB', (640, 480)).save(path, fmt, exif=_camera_exif())
+
+    assert exif.read_metadata(path) == {
+        'width': 640, 'height': 480, 'date_taken': '2023-05-06T07:08:09', 'date_offset': '+10:00',
+        'camera_make': 'Canon', 'camera_model': 'EOS R5', 'lens_model': 'RF24-70mm F2.8 L', 'orientation': 6,
+        'latitude': -33.8585, 'longitude': 151.21,
+    }
+
+def test_read_metadata_without_exif(tmp_path):
+    """Test that files without EXIF get their dimensions only, and other formats are left to PIL."""
+    path = tmp_path / 'plain.jpg'
+    Image.new('RGB', (30, 20)).save(path)
+    metadata = exif.read_metadata(path)
+    assert (metadata['width'], metadata['height']) == (30, 20)
+    assert all(metadata[field] is None for field in exif.FIELDS)
+
+    gif = tmp_path / 'a.gif'
+    Image.new('P', (4, 4)).save(gif)
+    with pytest.raises(ValueError):
+        exif.read_metadata(gif)
+
+def test_truncated_header(tmp_path):
+    """Test that a file cut off inside its header raises ValueError, so the scanner falls back to PIL and the mtime."""
+    import scanner
+    path = tmp_path / 'cut.png'
+    Image.new('RGB', (30, 20)).save(path)
+    path.write_bytes(path.read_bytes()[:20])
+    with pytest.raises(ValueError):
+        exif.read_metadata(path)
+    assert scanner.get_date_taken(str(path))
+
+def test_parse_big_endian_tiff():
+    """Test a big-endian EXIF block with an IFD0 date, and that invalid values are dropped."""
+    entries = [
+        (exif.MODEL, 2, 6, b'X100\0\0'),       # ASCII stored after the IFD
+        (exif.ORIENTATION, 3, 1, struct.pack('>HH', 9, 0)),  # out of range
+        (exif.DATE_TIME_ORIGINAL, 2, 20, b'2001:02:03 04:05:06\0'),
+    ]
+    data_offset = 8 + 2 + 12 * len(entries) + 4
+    ifd, data = b'', b''
+    for tag, field_type, count, value in entries:
+        if len(value) <= 4:
+            ifd += struct.pack('>HHI', tag, field_type, count) + value.ljust(4, b'\0')
+        else:
+            ifd += struct.pack('>HHII', tag, field_type, count, data_offset + len(data))
+            data += value
+    block = b'MM' + struct.pack('>HI', 42, 8) + struct.pack('>H', len(entries)) + ifd + b'\0' * 4 + data
+
+    metadata = exif.metadata_from_tags(exif.parse_tiff(block))
+    assert metadata['camera_model'] == 'X100'
+    assert metadata['orientation'] is None
+    assert metadata['date_taken'] == '2001-02-03T04:05:06'
+    assert exif.parse_tiff(b'garbage') == {}
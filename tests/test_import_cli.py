@@ -0,0 +1,61 @@
+import io
+import pytest
+from PIL import Image
+import database
+import import_cli
+import scanner
+
+def _make_library(tmp_path, count):
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    for i in range(count):
+        Image.new('RGB', (16, 16), color=(i * 20, 0, 0)).save(photos / f'{i}.jpg')
+    return str(photos)
+
+def test_import_records_checkpoints(tmp_path, file_db):
+    """Test that an import commits and checkpoints every few files and reports throughput."""
+    photos = _make_library(tmp_path, 5)
+    out = io.StringIO()
+    record = import_cli.run_import([photos], workers=1, checkpoint_every=2, report_interval=60, out=out)
+
+    assert record['finished'] is not None
+    assert record['files_imported'] == 5
+    assert record['bytes_imported'] == sum(image['filesize'] for image in database.get_all_images())
+    assert record['runs'] == 1
+    assert 'files/s' in out.getvalue() and 'MB/s' in out.getvalue()
+    assert database.get_unfinished_import([photos]) is None
+
+def test_interrupted_import_resumes(tmp_path, file_db, monkeypatch):
+    """Test that a crashed import resumes from its last checkpoint without re-reading committed files."""
+    photos = _make_library(tmp_path, 5)
+    checkpoint_import = database.checkpoint_import
+    calls = []
+
+    def crash_on_second_checkpoint(conn, *args):
+        calls.append(args)
+        if len(calls) == 2:
+            raise RuntimeError('power cut')
+        checkpoint_import(conn, *args)
+
+    monkeypatch.setattr(database, 'checkpoint_import', crash_on_second_checkpoint)
+    with pytest.raises(RuntimeError):
+        import_cli.run_import([photos], workers=1, checkpoint_every=2, out=io.StringIO())
+    monkeypatch.setattr(database, 'checkpoint_import', checkpoint_import)
+
+    # Only the first chunk was committed, with its checkpoint
+    interrupted = database.get_unfinished_import([photos])
+    assert interrupted['files_imported'] == 2
+    assert len(database.get_all_images()) == 2
+
+    read = []
+    process_single_image = scanner.process_single_image
+    monkeypatch.setattr(scanner, 'process_single_image', lambda filepath: read.append(filepath) or process_single_image(filepath))
+    out = io.StringIO()
+    record = import_cli.run_import([photos], workers=1, checkpoint_every=2, out=out)
+
+    assert record['id'] == interrupted['id']
+    assert record['runs'] == 2
+    assert record['files_imported'] == 5
+    assert len(read) == 3
+    assert len(database.get_all_images()) == 5
+    assert 'Resuming import' in out.getvalue()
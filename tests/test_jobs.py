@@ -0,0 +1,210 @@
+import threading
+import time
+from PIL import Image
+import database
+import jobs
+import thumbnails
+import worker
+
+class FakeStoppable:
+    def stop(self):
+        pass
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+def test_enqueue_coalesces_queued_jobs(file_db):
+    """Test that a job with the unique_key of a queued job updates it instead of adding another."""
+    first = jobs.enqueue('scan', {'dirs': ['/a']}, priority=1, unique_key='scan', delay=60)
+    second = jobs.enqueue('scan', {'dirs': ['/b']}, priority=5, unique_key='scan')
+    assert first == second
+
+    job = jobs.get_job(first)
+    assert job['payload'] == {'dirs': ['/b']}
+    assert job['priority'] == 5
+    assert job['run_after'] <= time.time()
+
+def test_claim_order_and_exclusivity(file_db):
+    """Test that jobs are claimed by priority, and never while a job with the same unique_key runs."""
+    low = jobs.enqueue('tag', priority=jobs.PRIORITY_TAG, unique_key='tag')
+    high = jobs.enqueue('thumbnails', {'items': []}, priority=jobs.PRIORITY_THUMBNAILS)
+    jobs.enqueue('tag', priority=jobs.PRIORITY_TAG, delay=3600)
+
+    assert jobs.claim('w1', ['tag', 'thumbnails'])['id'] == high
+    assert jobs.claim('w1', ['tag', 'thumbnails'])['id'] == low
+    # Queued behind the running one, not alongside it
+    follow_up = jobs.enqueue('tag', priority=jobs.PRIORITY_TAG, unique_key='tag')
+    assert follow_up != low
+    assert jobs.claim('w2', ['tag']) is None
+
+    jobs.complete(low, 'w1')
+    assert jobs.claim('w2', ['tag'])['id'] == follow_up
+    assert jobs.queue_counts()[('tag', 'done')] == 1
+
+def test_expired_lease_is_reclaimed(file_db):
+    """Test that the job of a worker that stopped renewing its lease goes to another worker."""
+    job_id = jobs.enqueue('scan', {'dirs': []})
+    assert jobs.claim('dead', ['scan'], lease_seconds=-1)['id'] == job_id
+    assert not jobs.heartbeat(job_id, 'other')
+
+    job = jobs.claim('alive', ['scan'])
+    assert job['id'] == job_id
+    assert job['attempts'] == 2
+    assert not jobs.heartbeat(job_id, 'dead')
+    assert jobs.heartbeat(job_id, 'alive', {'progress': 3})
+    assert jobs.get_job(job_id)['progress'] == {'progress': 3}
+
+def test_failed_job_backs_off_then_fails(file_db, monkeypatch):
+    """Test that failures are retried after a growing delay until the attempts are used up."""
+    monkeypatch.setattr(jobs, 'RETRY_DELAY_SECONDS', 0)
+    job_id = jobs.enqueue('tag', max_attempts=2)
+    jobs.claim('w', ['tag'])
+    assert jobs.fail(job_id, 'w', 'model unavailable')
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'queued'
+    assert job['error'] == 'model unavailable'
+
+    jobs.claim('w', ['tag'])
+    assert not jobs.fail(job_id, 'w', 'model unavailable')
+    assert jobs.get_job(job_id)['status'] == 'failed'
+    assert jobs.claim('w', ['tag']) is None
+
+    assert jobs.prune(keep_seconds=-1) == 1
+    assert jobs.get_job(job_id) is None
+
+def test_worker_runs_queued_scan(tmp_path, file_db):
+    """Test that a scan queued by the web tier runs in a worker and its progress is visible to other processes."""
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    Image.new('RGB', (32, 32), color='red').save(photos / 'a.jpg')
+
+    manager = jobs.QueuedScanManager()
+    assert manager.request_scan([str(photos)], workers=1)
+    assert manager.status['is_scanning']
+    assert manager.status['message'] == 'Waiting for a worker...'
+
+    scan_worker = worker.Worker(['scan'], worker_id='w')
+    assert scan_worker.run_once()
+    assert not scan_worker.run_once()
+
+    status = manager.status.snapshot()
+    assert status['queue_status'] == 'done'
+    assert not status['is_scanning']
+    assert status['progress'] == 1
+    assert [row['filepath'] for row in database.get_all_images()] == [str(photos / 'a.jpg')]
+    assert manager.history[0]['job_id'] == status['job_id']
+    # The scan queues a tagging pass for the new images
+    assert jobs.latest_job('tag')['status'] == 'queued'
+
+def test_worker_records_failures(file_db, monkeypatch):
+    """Test that a handler's exception fails the attempt with its message and progress."""
+    def broken_scan(payload, status, lease):
+        raise RuntimeError('disk gone')
+
+    job_id = jobs.enqueue('scan', {'dirs': []})
+    scan_worker = worker.Worker(['scan'], worker_id='w')
+    monkeypatch.setitem(scan_worker.handlers, 'scan', broken_scan)
+    assert scan_worker.run_once()
+
+    job = jobs.get_job(job_id)
+    assert job['status'] == 'queued'
+    assert job['error'] == 'disk gone'
+    assert job['progress']['errors'] == ['disk gone']
+    assert jobs.QueuedScanStatus()['message'] == 'Retrying: disk gone'
+
+def test_thumbnail_warming_via_queue(tmp_path, file_db, thumbnail_dir, monkeypatch):
+    """Test that warming in queue mode enqueues jobs that a thumbnail worker renders."""
+    path = tmp_path / 'a.jpg'
+    Image.new('RGB', (64, 48), color='blue').save(path)
+    image = {'filepath': str(path), 'mtime_ns': 1, 'filesize': path.stat().st_size, 'inode': 1}
+    monkeypatch.setattr(thumbnails, 'WARM_VIA_QUEUE', True)
+
+    thumbnails.warm_thumbnails([image])
+    assert jobs.queue_counts() == {('thumbnails', 'queued'): 1}
+
+    assert worker.Worker(['thumbnails'], worker_id='w').run_once()
+    key = thumbnails.fingerprint_key(image)
+    assert all(thumbnails.get_store().contains(key, size) for size in thumbnails.THUMBNAIL_SIZES)
+
+def test_worker_stops_after_losing_its_lease(file_db, monkeypatch):
+    """Test that a job whose lease went to another worker stops at its next progress update and records nothing."""
+    job_id = jobs.enqueue('scan', {'dirs': []}, unique_key='scan')
+    progressed = []
+
+    def stalled_scan(payload, status, lease):
+        # The worker stalled past its lease and another worker took the job over
+        conn = database.get_db_connection()
+        with conn:
+            conn.execute('UPDATE jobs SET lease_expires = 0 WHERE id = ?', (job_id,))
+        assert jobs.claim('other', ['scan'])['id'] == job_id
+        lease.beat()
+        status.increment(progress=1)
+        progressed.append(True)
+
+    scan_worker = worker.Worker(['scan'], worker_id='w')
+    monkeypatch.setitem(scan_worker.handlers, 'scan', stalled_scan)
+    assert scan_worker.run_once()
+
+    assert progressed == []
+    job = jobs.get_job(job_id)
+    assert (job['status'], job['lease_owner'], job['attempts']) == ('running', 'other', 2)
+    assert not jobs.complete(job_id, 'w')
+    assert not jobs.fail(job_id, 'w', 'too late')
+
+def test_only_one_worker_watches(file_db, monkeypatch):
+    """Test that of two workers handling watch jobs only one runs the watcher, until new settings replace it."""
+    started, stopped = [], []
+
+    class FakeWatcher:
+        def __init__(self, dirs):
+            self.dirs = dirs
+
+        def stop(self):
+            stopped.append(self.dirs)
+
+    monkeypatch.setattr(worker.watcher, 'start_watcher', lambda dirs, **kwargs: started.append(dirs) or FakeWatcher(dirs))
+    monkeypatch.setattr(worker, 'WATCH_CHECK_INTERVAL', 0.05)
+    monkeypatch.setattr(worker, 'POLL_INTERVAL', 0.05)
+    watch = {'dirs': ['/a'], 'mode': 'poll', 'workers': 1}
+    stop = [threading.Event(), threading.Event()]
+    threads = [threading.Thread(target=worker.Worker(['watch'], worker_id=f'w{i}', watch=watch).run, args=(stop[i],))
+               for i in range(2)]
+    for thread in threads:
+        thread.start()
+    try:
+        _wait_for(lambda: started)
+        time.sleep(0.3)
+        assert started == [['/a']]
+
+        # New settings: the running watcher stops and the new job starts one
+        jobs.request_watch(['/b'], 'poll')
+        _wait_for(lambda: len(started) == 2)
+        assert started[1] == ['/b'] and stopped == [['/a']]
+        assert jobs.queue_counts()[('watch', 'done')] == 1
+
+        # Watching off: the watcher stops and nothing replaces it
+        jobs.request_watch(['/b'], None)
+        _wait_for(lambda: len(stopped) == 2)
+        time.sleep(0.3)
+        assert len(started) == 2
+    finally:
+        for event in stop:
+            event.set()
+        for thread in threads:
+            thread.join()
+
+def test_stopping_worker_hands_over_the_watch_job(file_db, monkeypatch):
+    """Test that a worker shutting down puts its watch job back in the queue for another worker."""
+    monkeypatch.setattr(worker.watcher, 'start_watcher', lambda dirs, **kwargs: FakeStoppable())
+    monkeypatch.setattr(worker, 'WATCH_CHECK_INTERVAL', 0.05)
+    jobs.request_watch(['/a'], 'poll')
+    watch_worker = worker.Worker(['watch'], worker_id='w')
+    watch_worker.stop_event.set()
+    assert watch_worker.run_once()
+
+    job = jobs.latest_job('watch')
+    assert (job['status'], job['attempts'], job['lease_owner']) == ('queued', 0, None)
+    assert jobs.claim('other', ['watch'])['id'] == job['id']
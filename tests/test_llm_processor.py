@@ -0,0 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import database
+import llm_processor
+
+def _insert_images(count):
+    database.insert_images_bulk({'filepath': f'/photos/img{i}.jpg', 'filename': f'img{i}.jpg'} for i in range(count))
+
+def test_iter_untagged_images(file_db):
+    """Test that the untagged queue is paged by id without skipping rows."""
+    _insert_images(7)
+    database.update_llm_tags(3, ['cat'])
+    images = list(llm_processor.iter_untagged_images(fetch_size=2))
+    assert [image['id'] for image in images] == [1, 2, 4, 5, 6, 7]
+
+def test_tag_images_batches_requests(file_db):
+    """Test that images are tagged in batched model calls and written back."""
+    _insert_images(10)
+    batch_sizes = []
+
+    def fake_batch(image_paths):
+        batch_sizes.append(len(image_paths))
+        return [['tag', path.rsplit('/', 1)[-1]] for path in image_paths]
+
+    with patch('llm_processor.process_images_batch', side_effect=fake_batch), \
+         ThreadPoolExecutor(max_workers=3) as executor:
+        tagged = llm_processor.tag_images(llm_processor.iter_untagged_images(fetch_size=4), executor, batch_size=4, max_pending=2)
+
+    assert tagged == 10
+    assert sorted(batch_sizes) == [2, 4, 4]
+    assert database.get_images_without_tags() == []
+    assert database.get_image_by_id(5)['llm_tags'] == 'tag,img4.jpg'
+    assert len(database.search_images_by_tag('tag')) == 10
+
+def test_tag_images_skips_failed_batches(file_db):
+    """Test that a failing model call leaves its images untagged for a later pass."""
+    _insert_images(4)
+
+    def flaky_batch(image_paths):
+        if '/photos/img0.jpg' in image_paths:
+            raise RuntimeError('model unavailable')
+        return [['ok'] for _ in image_paths]
+
+    with patch('llm_processor.process_images_batch', side_effect=flaky_batch), \
+         ThreadPoolExecutor(max_workers=2) as executor:
+        tagged = llm_processor.tag_images(llm_processor.iter_untagged_images(), executor, batch_size=2)
+
+    assert tagged == 2
+    assert [image['id'] for image in database.get_images_without_tags()] == [1, 2]
+
+def test_tag_images_once_per_content_hash(file_db):
+    """Test that exact duplicates are sent to the model once and share the tags."""
+    _insert_images(4)
+    database.update_hashes_bulk('content_hash', [(1, 'abc'), (2, 'abc'), (3, 'abc')])
+    submitted = []
+
+    def fake_batch(image_paths):
+        submitted.extend(image_paths)
+        return [['tag'] for _ in image_paths]
+
+    with patch('llm_processor.process_images_batch', side_effect=fake_batch), \
+         ThreadPoolExecutor(max_workers=2) as executor:
+        tagged = llm_processor.tag_images(llm_processor.iter_untagged_images(), executor, batch_size=4)
+
+    assert submitted == ['/photos/img0.jpg', '/photos/img3.jpg']
+    assert tagged == 4
+    assert database.get_images_without_tags() == []
+
+def test_tag_cache_survives_reimport(tmp_path, file_db, thumbnail_dir):
+    """Test that re-imported files are tagged from the cache, and that the cache is invalidated by model version."""
+    paths = []
+    for i in range(3):
+        path = tmp_path / f'photo{i}.jpg'
+        path.write_bytes(f'image {i}'.encode())
+        paths.append(str(path))
+
+    def tag_all():
+        submitted = []
+
+        def fake_batch(image_paths):
+            submitted.extend(image_paths)
+            return [['tag', path[-5]] for path in image_paths]
+
+        database.insert_images_bulk({'filepath': path, 'filename': path.rsplit('/', 1)[-1]} for path in paths)
+        with patch('llm_processor.process_images_batch', side_effect=fake_batch), \
+             ThreadPoolExecutor(max_workers=2) as executor:
+            assert llm_processor.tag_images(llm_processor.iter_untagged_images(), executor, batch_size=2) == 3
+        return submitted
+
+    assert sorted(tag_all()) == paths
+    assert all(image['content_hash'] for image in database.get_all_images())
+
+    database.remove_images_by_path(str(tmp_path))
+    assert tag_all() == []
+    assert sorted(image['llm_tags'] for image in database.get_all_images()) == ['tag,0', 'tag,1', 'tag,2']
+
+    assert llm_processor.invalidate_tag_cache() == 0
+    assert llm_processor.invalidate_tag_cache(llm_processor.MODEL_VERSION) == 3
+    database.remove_images_by_path(str(tmp_path))
+    assert len(tag_all()) == 3
+
+def test_tag_images_skips_rows_rewritten_meanwhile(tmp_path, file_db, thumbnail_dir):
+    """Test that tags and hashes computed from a file are not written to a row a scan updated in the meantime."""
+    paths = []
+    for i in range(2):
+        path = tmp_path / f'photo{i}.jpg'
+        path.write_bytes(f'image {i}'.encode())
+        paths.append(str(path))
+    database.insert_images_bulk({'filepath': path, 'filename': path.rsplit('/', 1)[-1], 'mtime_ns': 1, 'filesize': 7}
+                                for path in paths)
+
+    def edited_during_request(image_paths):
+        # A scan re-reads photo1.jpg, which changed while the model was looking at the old version
+        database.update_fingerprints_bulk([(paths[1], 2, 9, None)])
+        return [['old'] for _ in image_paths]
+
+    with patch('llm_processor.process_images_batch', side_effect=edited_during_request), \
+         ThreadPoolExecutor(max_workers=1) as executor:
+        assert llm_processor.tag_images(llm_processor.iter_untagged_images(), executor) == 1
+
+    first, second = database.get_image_by_id(1), database.get_image_by_id(2)
+    assert (first['llm_tags'], second['llm_tags']) == ('old', None)
+    assert first['content_hash'] is not None and second['content_hash'] is None
+    assert len(database.search_images_by_tag('old')) == 1
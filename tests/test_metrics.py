@@ -0,0 +1,42 @@
+import pytest
+import metrics
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Fixture that gives each test an empty metrics registry."""
+    monkeypatch.setattr(metrics, 'REGISTRY', [])
+    return metrics.REGISTRY
+
+def test_histogram_render(registry):
+    """Test cumulative buckets, sum, count and label escaping."""
+    histogram = metrics.Histogram('test_seconds', 'A test histogram.', ['name'], buckets=(0.1, 1))
+    histogram.observe(0.05, name='a"b')
+    histogram.observe(0.1, name='a"b')
+    histogram.observe(5, name='a"b')
+
+    lines = metrics.render().splitlines()
+    assert lines[:2] == ['# HELP test_seconds A test histogram.', '# TYPE test_seconds histogram']
+    assert 'test_seconds_bucket{name="a\\"b",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{name="a\\"b",le="1"} 2' in lines
+    assert 'test_seconds_bucket{name="a\\"b",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{name="a\\"b"} 5.15' in lines
+    assert 'test_seconds_count{name="a\\"b"} 3' in lines
+
+def test_counter_and_timed(registry):
+    """Test counters and the timing decorator."""
+    counter = metrics.Counter('test_total', 'A test counter.')
+    counter.inc()
+    counter.inc(2)
+    assert counter.value() == 3
+    assert 'test_total 3' in metrics.render()
+
+    histogram = metrics.Histogram('test_call_seconds', 'Call durations.', ['function'])
+
+    @metrics.timed(histogram)
+    def work():
+        return 42
+
+    assert work() == 42
+    assert histogram.count(function='work') == 1
+    with pytest.raises(ValueError):
+        histogram.observe(1, other='x')
@@ -0,0 +1,63 @@
+import json
+import threading
+from unittest.mock import patch
+import app as main_app
+import scan_jobs
+
+def test_scan_status_snapshot():
+    """Test that the snapshot derives throughput, phase timings and errors."""
+    status = scan_jobs.ScanStatus()
+    status.update(is_scanning=True, total=10)
+    status.start_phase('extract', 'Reading...')
+    status.increment(progress=4)
+    status.add_error('Could not read /p/x.jpg')
+
+    snapshot = status.snapshot()
+    assert snapshot['message'] == 'Reading...'
+    assert snapshot['progress'] == 4
+    assert snapshot['phase'] == 'extract'
+    assert 'extract' in snapshot['phases']
+    assert snapshot['files_per_sec'] > 0
+    assert snapshot['eta_seconds'] is not None
+    assert snapshot['errors'] == ['Could not read /p/x.jpg']
+
+    status['is_scanning'] = False
+    snapshot = status.snapshot()
+    assert snapshot['phase'] is None
+    assert snapshot['eta_seconds'] is None
+    assert status.wait_for_change(snapshot['version'], timeout=0.01) == snapshot['version']
+
+def test_scan_requests_are_coalesced():
+    """Test that requests during a scan collapse into one follow-up scan with the latest arguments."""
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fake_scan(dir_list, status_obj, workers):
+        calls.append(dir_list)
+        started.set()
+        release.wait(5)
+
+    manager = scan_jobs.ScanJobManager()
+    with patch('scanner.scan_directories', side_effect=fake_scan):
+        assert manager.request_scan(['/a']) is True
+        started.wait(5)
+        assert manager.request_scan(['/b']) is False
+        assert manager.request_scan(['/c']) is False
+        release.set()
+        manager.wait(5)
+    assert calls == [['/a'], ['/c']]
+    assert not manager.is_running()
+    assert [job['job_id'] for job in manager.history] == [2, 1]
+
+def test_scan_status_stream():
+    """Test that the SSE endpoint sends the current status as its first event."""
+    main_app.app.config['TESTING'] = True
+    with main_app.app.test_client() as client:
+        response = client.get('/api/scan-status/stream', buffered=False)
+        assert response.mimetype == 'text/event-stream'
+        event = next(response.response)
+        response.close()
+    event = event.decode() if isinstance(event, bytes) else event
+    assert event.startswith('data: ')
+    assert json.loads(event[len('data: '):])['message'] == main_app.scan_status['message']
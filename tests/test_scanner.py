@@ -0,0 +1,238 @@
+import multiprocessing
+import time
+import pytest
+from unittest.mock import patch
+from PIL import Image
+import database
+import scan_jobs
+import scanner
+
+def _make_image(path, size=(64, 48), date_taken=None):
+    img = Image.new('RGB', size, color='red')
+    exif = Image.Exif()
+    if date_taken:
+        exif[scanner.EXIF_DATE_TAG] = date_taken
+    img.save(path, 'JPEG', exif=exif)
+
+def test_process_single_image(tmp_path):
+    """Test that metadata is extracted from a single open of the file."""
+    path = tmp_path / 'photo.jpg'
+    _make_image(path, size=(64, 48), date_taken='2021:05:04 10:11:12')
+
+    data = scanner.process_single_image(str(path))
+    assert data['filename'] == 'photo.jpg'
+    assert (data['width'], data['height']) == (64, 48)
+    assert data['date_taken'] == '2021-05-04T10:11:12'
+    assert data['filesize'] == path.stat().st_size
+
+def test_process_single_image_unreadable(tmp_path):
+    """Test that files that are not images are skipped."""
+    path = tmp_path / 'broken.jpg'
+    path.write_bytes(b'not an image')
+    assert scanner.process_single_image(str(path)) is None
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_extract_metadata(tmp_path, workers):
+    """Test that every file is yielded exactly once, serially or in a pool."""
+    paths = []
+    for i in range(5):
+        path = tmp_path / f'img{i}.jpg'
+        _make_image(path)
+        paths.append(str(path))
+
+    results = dict(scanner.extract_metadata(iter(paths), workers=workers, chunk_size=2))
+    assert sorted(results) == sorted(paths)
+    assert all(data is not None for data in results.values())
+
+def test_scan_directories(tmp_path, file_db):
+    """Test a scan that adds new files and removes missing ones."""
+    photos = tmp_path / 'photos'
+    (photos / 'sub').mkdir(parents=True)
+    _make_image(photos / 'a.jpg')
+    _make_image(photos / 'sub' / 'b.jpg')
+    (photos / 'notes.txt').write_text('ignored')
+
+    status = scan_jobs.ScanStatus()
+    scanner.scan_directories([str(photos)], status, workers=2)
+    assert database.get_all_filepaths() == {str(photos / 'a.jpg'), str(photos / 'sub' / 'b.jpg')}
+    assert status['progress'] == status['total'] == 2
+    assert status['is_scanning'] is False
+
+    (photos / 'a.jpg').unlink()
+    scanner.scan_directories([str(photos)], status, workers=1)
+    assert database.get_all_filepaths() == {str(photos / 'sub' / 'b.jpg')}
+
+def test_incremental_rescan(tmp_path, file_db):
+    """Test that unchanged files are skipped and edited files are re-read."""
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    _make_image(photos / 'a.jpg', size=(64, 48))
+    _make_image(photos / 'b.jpg')
+    scanner.scan_directories([str(photos)], workers=1)
+    image_ids = {row['filename']: row['id'] for row in database.get_all_images()}
+    database.update_llm_tags(image_ids['a.jpg'], ['cat'])
+
+    _make_image(photos / 'a.jpg', size=(32, 32))
+    with patch('scanner.process_single_image', wraps=scanner.process_single_image) as mock_process:
+        scanner.scan_directories([str(photos)], workers=1)
+    mock_process.assert_called_once_with(str(photos / 'a.jpg'))
+
+    updated = database.get_image_by_id(image_ids['a.jpg'])
+    assert (updated['width'], updated['height']) == (32, 32)
+    assert updated['llm_tags'] is None
+
+def test_rescan_detects_moves(tmp_path, file_db):
+    """Test that a moved file keeps its id and tags instead of being re-added."""
+    photos = tmp_path / 'photos'
+    (photos / 'old').mkdir(parents=True)
+    (photos / 'new').mkdir()
+    _make_image(photos / 'old' / 'a.jpg')
+    scanner.scan_directories([str(photos)], workers=1)
+    image_id = database.get_all_images()[0]['id']
+    database.update_llm_tags(image_id, ['cat'])
+
+    (photos / 'old' / 'a.jpg').rename(photos / 'new' / 'a.jpg')
+    with patch('scanner.process_single_image') as mock_process:
+        scanner.scan_directories([str(photos)], workers=1)
+    mock_process.assert_not_called()
+
+    moved = database.get_image_by_id(image_id)
+    assert moved['filepath'] == str(photos / 'new' / 'a.jpg')
+    assert moved['llm_tags'] == 'cat'
+    assert database.get_all_filepaths() == {str(photos / 'new' / 'a.jpg')}
+
+def test_apply_changes(tmp_path, file_db):
+    """Test applying created, moved and deleted paths without a full scan."""
+    photos = tmp_path / 'photos'
+    (photos / 'album').mkdir(parents=True)
+    _make_image(photos / 'a.jpg')
+    _make_image(photos / 'album' / 'b.jpg')
+    _make_image(photos / 'album' / 'c.jpg')
+    scanner.apply_changes(updated=[str(photos / 'a.jpg'), str(photos / 'album')], workers=1)
+    assert len(database.get_all_filepaths()) == 3
+
+    (photos / 'a.jpg').rename(photos / 'renamed.jpg')
+    (photos / 'album').rename(photos / 'trip')
+    (photos / 'trip' / 'c.jpg').unlink()
+    scanner.apply_changes(deleted=[str(photos / 'trip' / 'c.jpg')],
+                          moved=[(str(photos / 'a.jpg'), str(photos / 'renamed.jpg')),
+                                 (str(photos / 'album'), str(photos / 'trip'))],
+                          workers=1)
+    assert database.get_all_filepaths() == {str(photos / 'renamed.jpg'), str(photos / 'trip' / 'b.jpg')}
+
+    scanner.apply_changes(deleted=[str(photos / 'trip')], workers=1)
+    assert database.get_all_filepaths() == {str(photos / 'renamed.jpg')}
+
+def test_apply_changes_discards_deleted_thumbnails(tmp_path, file_db, thumbnail_dir):
+    """Test that watcher deletes drop the thumbnails of removed files and of files under removed directories."""
+    import thumbnails
+    photos = tmp_path / 'photos'
+    (photos / 'album').mkdir(parents=True)
+    _make_image(photos / 'a.jpg')
+    _make_image(photos / 'album' / 'b.jpg', size=(32, 32))
+    scanner.apply_changes(updated=[str(photos / 'a.jpg'), str(photos / 'album')], workers=1)
+    keys = {}
+    for image in database.get_all_images():
+        keys[image['filename']] = thumbnails.fingerprint_key(image)
+        thumbnails.get_thumbnail(image)
+        assert thumbnails.get_store().get(keys[image['filename']], thumbnails.DEFAULT_SIZE) is not None
+
+    (photos / 'a.jpg').unlink()
+    scanner.apply_changes(deleted=[str(photos / 'a.jpg')], workers=1)
+    assert thumbnails.get_store().get(keys['a.jpg'], thumbnails.DEFAULT_SIZE) is None
+    assert thumbnails.get_store().get(keys['b.jpg'], thumbnails.DEFAULT_SIZE) is not None
+
+    (photos / 'album' / 'b.jpg').unlink()
+    (photos / 'album').rmdir()
+    scanner.apply_changes(deleted=[str(photos / 'album')], workers=1)
+    assert thumbnails.get_store().get(keys['b.jpg'], thumbnails.DEFAULT_SIZE) is None
+
+def _hold_scan_lock(db_path, held, seconds):
+    database.configure(db_path)
+    with scanner.scan_lock():
+        held.set()
+        time.sleep(seconds)
+
+def test_scan_lock_is_shared_between_processes(file_db):
+    """Test that a scan in one worker process holds off watcher batches in another."""
+    context = multiprocessing.get_context('fork')
+    held = context.Event()
+    holder = context.Process(target=_hold_scan_lock, args=(database.DB_PATH, held, 0.5))
+    holder.start()
+    try:
+        assert held.wait(5)
+        start = time.monotonic()
+        with scanner.scan_lock():
+            assert time.monotonic() - start > 0.3
+    finally:
+        holder.join()
+
+@pytest.mark.parametrize('traversal_workers', [1, 3])
+def test_iter_image_files(tmp_path, traversal_workers):
+    """Test that discovery finds supported images in every subtree, with their stat."""
+    expected = set()
+    for album in ('a', 'b', 'c/d'):
+        (tmp_path / album).mkdir(parents=True)
+        for name in ('one.JPG', 'two.png'):
+            (tmp_path / album / name).write_bytes(b'x')
+            expected.add(str(tmp_path / album / name))
+        (tmp_path / album / 'skip.txt').write_bytes(b'x')
+    (tmp_path / 'top.gif').write_bytes(b'xy')
+    expected.add(str(tmp_path / 'top.gif'))
+
+    found = dict(scanner.iter_image_files([str(tmp_path)], traversal_workers=traversal_workers))
+    assert set(found) == expected
+    assert found[str(tmp_path / 'top.gif')].st_size == 2
+
+def test_scan_backfills_exif_metadata(tmp_path, file_db):
+    """Test that images scanned before the EXIF fields existed get them on the next scan, keeping their tags."""
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    exif = Image.Exif()
+    exif[0x0110] = 'X100'
+    gps = exif.get_ifd(0x8825)
+    gps.update({1: 'N', 2: (48.0, 51.0, 36.0), 3: 'E', 4: (2.0, 21.0, 0.0)})
+    Image.new('RGB', (32, 32)).save(photos / 'a.jpg', exif=exif)
+    scanner.scan_directories([str(photos)], workers=1)
+    image = database.get_all_images()[0]
+    assert (image['camera_model'], image['latitude'], image['longitude']) == ('X100', 48.86, 2.35)
+    assert image['metadata_version'] == scanner.METADATA_VERSION
+
+    # As left by the migration for a row scanned by an older version
+    database.update_llm_tags(image['id'], ['street'])
+    database.update_metadata_bulk([{'filepath': image['filepath']}])
+    assert database.get_images_in_bbox(48, 2, 49, 3) == []
+    scanner.scan_directories([str(photos)], workers=1)
+
+    image = database.get_image_by_id(image['id'])
+    assert image['camera_model'] == 'X100'
+    assert image['llm_tags'] == 'street'
+    assert [row['id'] for row in database.get_images_in_bbox(48, 2, 49, 3)] == [image['id']]
+
+def test_scan_keeps_images_outside_its_directories(tmp_path, file_db):
+    """Test that scanning one directory does not remove the images of another (e.g. one imported meanwhile)."""
+    for name in ('old', 'imported'):
+        (tmp_path / name).mkdir()
+        Image.new('RGB', (8, 8)).save(tmp_path / name / 'a.jpg')
+    scanner.scan_directories([str(tmp_path / 'old'), str(tmp_path / 'imported')], workers=1)
+    (tmp_path / 'old' / 'a.jpg').unlink()
+
+    scanner.scan_directories([str(tmp_path / 'old')], workers=1)
+    assert [image['filepath'] for image in database.get_all_images()] == [str(tmp_path / 'imported' / 'a.jpg')]
+
+def test_relative_directory_keeps_stored_paths(tmp_path, file_db, monkeypatch):
+    """Test that rows scanned from a relative directory entry (even without fingerprints) survive rescans with their tags."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'photos').mkdir()
+    _make_image(tmp_path / 'photos' / 'a.jpg')
+    _make_image(tmp_path / 'photos' / 'legacy.jpg')
+    # Scanned before fingerprints were recorded
+    database.insert_images_bulk([{'filepath': 'photos/legacy.jpg', 'filename': 'legacy.jpg'}])
+    scanner.scan_directories(['photos'], workers=1)
+    images = {image['filename']: image for image in database.get_all_images()}
+    assert images['a.jpg']['filepath'] == 'photos/a.jpg'
+    database.update_llm_tags(images['legacy.jpg']['id'], ['kept'])
+
+    scanner.scan_directories(['photos', str(tmp_path / 'photos' / 'nested')], workers=1)
+    assert sorted(image['filepath'] for image in database.get_all_images()) == ['photos/a.jpg', 'photos/legacy.jpg']
+    assert database.get_image_by_id(images['legacy.jpg']['id'])['llm_tags'] == 'kept'
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+import pytest
+from PIL import Image
+import database
+import thumbnails
+
+def _image_row(path, image_id=1):
+    stat = os.stat(path)
+    return {'id': image_id, 'filepath': str(path), 'mtime_ns': stat.st_mtime_ns, 'filesize': stat.st_size, 'inode': stat.st_ino}
+
+def test_render_thumbnails(tmp_path, thumbnail_dir):
+    """Test that every size is rendered from one decode, fits its bounding box and is sharded by key."""
+    path = tmp_path / 'big.jpg'
+    Image.new('RGB', (3000, 2000), color='green').save(path, 'JPEG')
+
+    thumbnails.render_thumbnails(str(path), 'abcdef')
+    store = thumbnails.get_store()
+    for size in thumbnails.THUMBNAIL_SIZES:
+        thumb_path = store.get('abcdef', size)
+        assert thumb_path == os.path.join(thumbnail_dir, 'ab', 'cd', f'abcdef_{size}.jpg')
+        with Image.open(thumb_path) as thumb:
+            assert max(thumb.size) == size
+            assert thumb.size[0] > thumb.size[1]
+
+def test_fingerprint_key_changes_with_file(tmp_path):
+    """Test that the cache key follows the file content, not its path."""
+    path = tmp_path / 'a.jpg'
+    Image.new('RGB', (10, 10)).save(path, 'JPEG')
+    key = thumbnails.fingerprint_key(_image_row(path))
+
+    moved = tmp_path / 'b.jpg'
+    path.rename(moved)
+    assert thumbnails.fingerprint_key(_image_row(moved)) == key
+
+    Image.new('RGB', (20, 20)).save(moved, 'JPEG')
+    assert thumbnails.fingerprint_key(_image_row(moved)) != key
+
+def test_get_thumbnail(tmp_path, thumbnail_dir):
+    """Test on-demand rendering, size snapping and the placeholder for missing files."""
+    path = tmp_path / 'a.png'
+    Image.new('RGB', (900, 300)).save(path, 'PNG')
+    row = _image_row(path)
+
+    thumb_path = thumbnails.get_thumbnail(row, 300)
+    assert thumb_path == thumbnails.get_store().path(thumbnails.fingerprint_key(row), 400)
+    with Image.open(thumb_path) as thumb:
+        assert thumb.size == (400, 133)
+
+    path.unlink()
+    missing = thumbnails.get_thumbnail(dict(row, mtime_ns=1), 200)
+    with Image.open(missing) as thumb:
+        assert thumb.size == (200, 200)
+
+def test_truncated_image_gets_placeholder(tmp_path, thumbnail_dir):
+    """Test that a truncated file renders the placeholder thumbnail and no preview instead of raising."""
+    path = tmp_path / 'cut.jpg'
+    Image.new('RGB', (800, 600), color='blue').save(path, 'JPEG')
+    path.write_bytes(path.read_bytes()[:400])
+    row = _image_row(path)
+
+    with Image.open(thumbnails.get_thumbnail(row, 200)) as thumb:
+        assert thumb.size == (200, 200)
+    assert thumbnails.get_preview(row) is None
+
+def test_warm_chunk_skips_cached(tmp_path, thumbnail_dir):
+    """Test that warming renders missing thumbnails and leaves cached ones alone."""
+    path = tmp_path / 'a.jpg'
+    Image.new('RGB', (500, 500)).save(path, 'JPEG')
+    key = thumbnails.fingerprint_key(_image_row(path))
+
+    thumbnails._warm_chunk([(str(path), key)])
+    cached = thumbnails.get_store().path(key, 200)
+    mtime = os.stat(cached).st_mtime_ns
+    thumbnails._warm_chunk([(str(path), key)])
+    assert os.stat(cached).st_mtime_ns == mtime
+
+@pytest.mark.parametrize('store_class', [thumbnails.DirectoryStore, thumbnails.PackStore])
+def test_store_evicts_least_recently_used(tmp_path, monkeypatch, store_class):
+    """Test that exceeding the budget evicts the least recently accessed thumbnails first."""
+    store = store_class(str(tmp_path / 'store'), budget_bytes=3000)
+    monkeypatch.setattr(thumbnails, 'ACCESS_RESOLUTION', 0)
+    monkeypatch.setattr(time, 'time', lambda: 1000.0)
+    store.put('old', 200, b'x' * 1000)
+    store.put('hot', 200, b'x' * 1000)
+    monkeypatch.setattr(time, 'time', lambda: 2000.0)
+    store.put('new', 200, b'x' * 1000)
+    monkeypatch.setattr(time, 'time', lambda: 3000.0)
+    assert store.get('hot', 200) is not None
+    assert store.enforce_budget() == 0
+
+    store.put('newest', 200, b'x' * 1000)
+    assert store.enforce_budget() == 2
+    assert not store.contains('old', 200)
+    assert not store.contains('new', 200)
+    assert store.contains('hot', 200)
+    assert store.contains('newest', 200)
+
+def test_budget_checked_in_background_after_rendering(tmp_path, file_db, thumbnail_dir, monkeypatch):
+    """Test that rendering schedules one budget check off the calling thread, and scans do not walk the store."""
+    import scanner
+    checks = []
+    monkeypatch.setattr(thumbnails, 'BUDGET_CHECK_DELAY', 0.05)
+    monkeypatch.setattr(thumbnails, '_budget_check_pending', False)
+    monkeypatch.setattr(thumbnails.get_store(), 'enforce_budget', lambda: checks.append(threading.current_thread()) or 0)
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    for name in ('a.jpg', 'b.jpg'):
+        Image.new('RGB', (64, 48)).save(photos / name)
+    scanner.scan_directories([str(photos)], workers=1)
+    time.sleep(0.2)
+    assert checks == []
+
+    for image in database.get_all_images():
+        thumbnails.get_thumbnail(image)
+    time.sleep(0.2)
+    assert len(checks) == 1 and checks[0] is not threading.current_thread()
+
+@pytest.mark.parametrize('store_class', [thumbnails.DirectoryStore, thumbnails.PackStore])
+def test_store_rename(tmp_path, store_class):
+    """Test that renaming moves renditions, keeping those the new key already has."""
+    store = store_class(str(tmp_path / 'store'))
+    store.put('aaaa', 200, b'old 200')
+    store.put('aaaa', 400, b'old 400')
+    store.put('bbbb', 400, b'new 400')
+    store.rename([('aaaa', 'bbbb')])
+
+    def read(key, size):
+        stored = store.get(key, size)
+        if hasattr(stored, 'read'):
+            return stored.read()
+        with open(stored, 'rb') as f:
+            return f.read()
+
+    assert not store.contains('aaaa', 200) and not store.contains('aaaa', 400)
+    assert read('bbbb', 200) == b'old 200'
+    assert read('bbbb', 400) == b'new 400'
+
+def test_collect_garbage(tmp_path, file_db, thumbnail_dir):
+    """Test that thumbnails of images no longer in the database are removed."""
+    path = tmp_path / 'a.jpg'
+    Image.new('RGB', (50, 50)).save(path, 'JPEG')
+    row = _image_row(path)
+    database.insert_image(dict(row, filename='a.jpg', date_taken='2023-01-01T00:00:00', date_modified='2023-01-01T00:00:00', width=50, height=50))
+    live_key = thumbnails.fingerprint_key(row)
+    thumbnails.render_thumbnails(str(path), live_key, (200,))
+    thumbnails.render_placeholder('orphan', 200)
+
+    thumbnails.collect_garbage()
+    store = thumbnails.get_store()
+    assert store.contains(live_key, 200)
+    assert not store.contains('orphan', 200)
+
+@pytest.mark.parametrize('preview_format', ['JPEG', 'WEBP'])
+def test_get_preview(tmp_path, thumbnail_dir, monkeypatch, preview_format):
+    """Test that previews are bounded by PREVIEW_SIZE, encoded in PREVIEW_FORMAT and cached."""
+    monkeypatch.setattr(thumbnails, 'PREVIEW_FORMAT', preview_format)
+    path = tmp_path / 'big.jpg'
+    Image.new('RGB', (4000, 3000), color='red').save(path, 'JPEG')
+    row = _image_row(path)
+
+    preview = thumbnails.get_preview(row)
+    with Image.open(preview) as img:
+        assert img.format == preview_format
+        assert img.size == (2048, 1536)
+    assert thumbnails.get_store().contains(thumbnails.fingerprint_key(row), thumbnails.PREVIEW_SIZE)
+
+    path.unlink()
+    assert thumbnails.get_preview(dict(row, mtime_ns=1)) is None
+
+@pytest.mark.parametrize('settings', [{'preview_size': 400}, {'preview_format': 'png'}])
+def test_configure_rejects_invalid_previews(thumbnail_dir, settings):
+    """Test that a preview size shared with a thumbnail size, or a format without a mimetype, is refused and changes nothing."""
+    store = thumbnails.get_store()
+    with pytest.raises(ValueError):
+        thumbnails.configure(root=thumbnail_dir, **settings)
+    assert (thumbnails.PREVIEW_SIZE, thumbnails.PREVIEW_FORMAT) == (2048, 'JPEG')
+    assert thumbnails.get_store() is store
@@ -0,0 +1,79 @@
+import time
+import pytest
+from PIL import Image
+import database
+import watcher
+
+def _make_image(path):
+    Image.new('RGB', (16, 16), color='blue').save(path, 'JPEG')
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+def test_polling_watcher(tmp_path, file_db):
+    """Test that the polling watcher picks up created, renamed and deleted files."""
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    poller = watcher.PollingWatcher([str(photos)])
+
+    (photos / 'album').mkdir()
+    _make_image(photos / 'album' / 'a.jpg')
+    _make_image(photos / 'b.jpg')
+    poller.poll()
+    poller.flush()
+    assert database.get_all_filepaths() == {str(photos / 'album' / 'a.jpg'), str(photos / 'b.jpg')}
+
+    (photos / 'b.jpg').unlink()
+    poller.poll()
+    poller.flush()
+    assert database.get_all_filepaths() == {str(photos / 'album' / 'a.jpg')}
+
+def test_polling_watcher_sweep_finds_edits(tmp_path, file_db):
+    """Test that the stat sweep picks up a file rewritten in place, which leaves its directory's mtime alone."""
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    _make_image(photos / 'a.jpg')
+    _make_image(photos / 'b.jpg')
+    poller = watcher.PollingWatcher([str(photos)])
+    poller.full_rescan()
+    directory_mtime = photos.stat().st_mtime_ns
+
+    with open(photos / 'a.jpg', 'r+b') as f:
+        Image.new('RGB', (32, 8), color='red').save(f, 'JPEG')
+    assert photos.stat().st_mtime_ns == directory_mtime
+    poller.poll()
+    assert poller.pending_count() == 0
+
+    poller.sweep()
+    assert poller.pending_count() == 1
+    poller.flush()
+    edited = next(image for image in database.get_all_images() if image['filename'] == 'a.jpg')
+    assert (edited['width'], edited['height']) == (32, 8)
+
+def test_watchers_must_wait_for_events():
+    """Test that a watcher without wait_for_events cannot be created."""
+    with pytest.raises(TypeError):
+        watcher.BaseWatcher([])
+
+@pytest.mark.skipif(not watcher.inotify_available(), reason='inotify is only available on Linux')
+def test_inotify_watcher(tmp_path, file_db):
+    """Test that inotify events are debounced and applied in the background."""
+    photos = tmp_path / 'photos'
+    (photos / 'old').mkdir(parents=True)
+    library_watcher = watcher.start_watcher([str(photos)], mode='inotify', debounce=0.1)
+    try:
+        _make_image(photos / 'old' / 'a.jpg')
+        assert _wait_for(lambda: database.get_all_filepaths() == {str(photos / 'old' / 'a.jpg')})
+
+        (photos / 'old').rename(photos / 'new')
+        assert _wait_for(lambda: database.get_all_filepaths() == {str(photos / 'new' / 'a.jpg')})
+
+        (photos / 'new' / 'a.jpg').unlink()
+        assert _wait_for(lambda: database.get_all_filepaths() == set())
+    finally:
+        library_watcher.stop()
@@ -0,0 +1,564 @@
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+import database
+import jobs
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RENDER_SECONDS = metrics.Histogram('photomanager_thumbnail_render_seconds',
+                                   'Time to decode an image and render its thumbnails or preview, on request or by background warming.',
+                                   ['source'])
+
+THUMBNAIL_DIR = 'static/thumbnails'
+
+# Longest edge, in pixels, of each rendition that is generated.
+THUMBNAIL_SIZES = (200, 400, 1200)
+DEFAULT_SIZE = 200
+
+JPEG_QUALITY = 85
+
+# Longest edge of the screen-sized previews shown by the full-screen viewer,
+# and their encoding: 'JPEG' (progressive) or 'WEBP'.
+PREVIEW_SIZE = 2048
+PREVIEW_FORMAT = 'JPEG'
+PREVIEW_QUALITY = 82
+
+# Render previews along with thumbnails in the background (otherwise on first view).
+WARM_PREVIEWS = False
+
+MIMETYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+# Where thumbnails are kept: 'directory' (sharded files) or 'pack' (a single
+# SQLite file of blobs, which needs one inode instead of one per thumbnail).
+STORE_KIND = 'directory'
+
+# Disk budget for the thumbnail store. Least recently used thumbnails are
+# evicted down to EVICT_TARGET of the budget once it is exceeded.
+BUDGET_BYTES = 2 * 1024 ** 3
+EVICT_TARGET = 0.9
+
+# Seconds after rendering before the budget is checked on a background
+# thread; renders in the meantime share the check, and none is made (no
+# walk of the store) while nothing is rendered.
+BUDGET_CHECK_DELAY = 60
+
+# Access times are only recorded when older than this, so serving a hot
+# thumbnail does not write to disk on every request.
+ACCESS_RESOLUTION = 3600
+
+# Processes that render thumbnails in the background after a scan adds images.
+WARM_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# Images handed to a warming process per task.
+WARM_CHUNK_SIZE = 16
+
+# Render thumbnails in the background for images added or changed by scans.
+WARM_ON_SCAN = True
+
+# Queue warming as jobs for a worker process (worker.py --kinds thumbnails)
+# instead of rendering in this process's pool.
+WARM_VIA_QUEUE = False
+
+_executor = None
+_executor_lock = threading.Lock()
+_store = None
+_budget_check_lock = threading.Lock()
+_budget_check_pending = False
+
+
+class DirectoryStore:
+    """
+    Thumbnails as JPEG files, sharded into two levels of subdirectories by
+    key prefix so no directory grows beyond a few thousand entries. File
+    mtimes double as access times for LRU eviction.
+    """
+
+    def __init__(self, root, budget_bytes=BUDGET_BYTES):
+        self.root = root
+        self.budget_bytes = budget_bytes
+
+    def path(self, key, size):
+        return os.path.join(self.root, key[:2], key[2:4], f"{key}_{size}{EXTENSIONS[rendition_format(size)]}")
+
+    def contains(self, key, size):
+        return os.path.exists(self.path(key, size))
+
+    def get(self, key, size):
+        """Returns the thumbnail's file path, or None if it is not stored."""
+        path = self.path(key, size)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if now - stat.st_mtime > ACCESS_RESOLUTION:
+            os.utime(path, (now, now))
+        return path
+
+    def put(self, key, size, data):
+        path = self.path(key, size)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary file first so a request never serves a half-written thumbnail
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        now = time.time()
+        os.utime(tmp_path, (now, now))
+        os.replace(tmp_path, path)
+
+    def discard(self, keys):
+        for key in keys:
+            for size in THUMBNAIL_SIZES + (PREVIEW_SIZE,):
+                try:
+                    os.remove(self.path(key, size))
+                except FileNotFoundError:
+                    pass
+
+    def rename(self, moves):
+        for old_key, new_key in moves:
+            for size in THUMBNAIL_SIZES + (PREVIEW_SIZE,):
+                old_path, new_path = self.path(old_key, size), self.path(new_key, size)
+                try:
+                    if os.path.exists(new_path):
+                        os.remove(old_path)
+                    else:
+                        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                        os.replace(old_path, new_path)
+                except FileNotFoundError:
+                    pass
+
+    def _entries(self):
+        """Yields (key, path, stat) for every stored thumbnail."""
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                stem, extension = os.path.splitext(name)
+                if extension not in EXTENSIONS.values():
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    yield stem.rsplit('_', 1)[0], path, os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+    def collect_garbage(self, live_keys):
+        removed = 0
+        for key, path, _ in self._entries():
+            if key not in live_keys:
+                os.remove(path)
+                removed += 1
+        return removed
+
+    def enforce_budget(self):
+        entries = [(stat.st_mtime, stat.st_size, path) for _, path, stat in self._entries()]
+        total = sum(size for _, size, _ in entries)
+        if total <= self.budget_bytes:
+            return 0
+        evicted = 0
+        target = self.budget_bytes * EVICT_TARGET
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        return evicted
+
+
+class PackStore:
+    """
+    Thumbnails as blobs in a single SQLite file, with their size and last
+    access time alongside for LRU eviction.
+    """
+
+    def __init__(self, path, budget_bytes=BUDGET_BYTES):
+        self.path = path
+        self.budget_bytes = budget_bytes
+        self._local = threading.local()
+
+    def _conn(self):
+        # Per thread and per process: warming processes must not reuse a forked connection.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('PRAGMA busy_timeout = 10000')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS thumbnails (
+                    key TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    data BLOB NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    last_access INTEGER NOT NULL,
+                    PRIMARY KEY (key, size)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_thumbnails_last_access ON thumbnails (last_access)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def contains(self, key, size):
+        return self._conn().execute('SELECT 1 FROM thumbnails WHERE key = ? AND size = ?', (key, size)).fetchone() is not None
+
+    def get(self, key, size):
+        """Returns the thumbnail as a file-like object, or None if it is not stored."""
+        conn = self._conn()
+        row = conn.execute('SELECT data, last_access FROM thumbnails WHERE key = ? AND size = ?', (key, size)).fetchone()
+        if row is None:
+            return None
+        now = int(time.time())
+        if now - row[1] > ACCESS_RESOLUTION:
+            with conn:
+                conn.execute('UPDATE thumbnails SET last_access = ? WHERE key = ? AND size = ?', (now, key, size))
+        return io.BytesIO(row[0])
+
+    def put(self, key, size, data):
+        conn = self._conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO thumbnails (key, size, data, bytes, last_access) VALUES (?, ?, ?, ?, ?)',
+                         (key, size, data, len(data), int(time.time())))
+
+    def discard(self, keys):
+        conn = self._conn()
+        with conn:
+            conn.executemany('DELETE FROM thumbnails WHERE key = ?', [(key,) for key in keys])
+
+    def rename(self, moves):
+        moves = list(moves)
+        conn = self._conn()
+        with conn:
+            # Renditions the new key already has are dropped instead
+            conn.executemany('UPDATE OR IGNORE thumbnails SET key = ? WHERE key = ?', [(new, old) for old, new in moves])
+            conn.executemany('DELETE FROM thumbnails WHERE key = ?', [(old,) for old, _ in moves])
+
+    def collect_garbage(self, live_keys):
+        conn = self._conn()
+        stored_keys = {row[0] for row in conn.execute('SELECT DISTINCT key FROM thumbnails')}
+        dead_keys = stored_keys - live_keys
+        self.discard(dead_keys)
+        return len(dead_keys)
+
+    def enforce_budget(self):
+        conn = self._conn()
+        total = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM thumbnails').fetchone()[0]
+        if total <= self.budget_bytes:
+            return 0
+        evicted = 0
+        target = self.budget_bytes * EVICT_TARGET
+        rows = conn.execute('SELECT key, size, bytes FROM thumbnails ORDER BY last_access').fetchall()
+        with conn:
+            for key, size, nbytes in rows:
+                if total <= target:
+                    break
+                conn.execute('DELETE FROM thumbnails WHERE key = ? AND size = ?', (key, size))
+                total -= nbytes
+                evicted += 1
+        # Return the freed pages to the filesystem
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.execute('VACUUM')
+        return evicted
+
+
+def configure(kind=None, root=None, budget_bytes=None, preview_size=None, preview_format=None, warm_via_queue=None):
+    """
+    Selects the thumbnail store and preview settings. Arguments left as None
+    use the module settings. Raises ValueError for a preview size that is
+    also a thumbnail size (renditions are told apart by size) or a preview
+    format other than those in MIMETYPES.
+    """
+    global _store, STORE_KIND, THUMBNAIL_DIR, BUDGET_BYTES, PREVIEW_SIZE, PREVIEW_FORMAT, WARM_VIA_QUEUE
+    preview_size = preview_size or PREVIEW_SIZE
+    preview_format = (preview_format or PREVIEW_FORMAT).upper()
+    if preview_size in THUMBNAIL_SIZES:
+        raise ValueError(f"preview_size must differ from the thumbnail sizes {THUMBNAIL_SIZES}, got {preview_size}")
+    if preview_format not in MIMETYPES:
+        raise ValueError(f"preview_format must be one of {', '.join(name.lower() for name in MIMETYPES)}, got {preview_format.lower()}")
+    STORE_KIND = kind or STORE_KIND
+    THUMBNAIL_DIR = root or THUMBNAIL_DIR
+    BUDGET_BYTES = budget_bytes or BUDGET_BYTES
+    PREVIEW_SIZE = preview_size
+    PREVIEW_FORMAT = preview_format
+    if warm_via_queue is not None:
+        WARM_VIA_QUEUE = warm_via_queue
+    if STORE_KIND == 'pack':
+        _store = PackStore(os.path.join(THUMBNAIL_DIR, 'thumbnails.pack'), BUDGET_BYTES)
+    else:
+        _store = DirectoryStore(THUMBNAIL_DIR, BUDGET_BYTES)
+    return _store
+
+def get_store():
+    if _store is None:
+        configure()
+    return _store
+
+def fingerprint_key(image):
+    """
+    Returns the cache key for an image's thumbnails, derived from its stat
+    fingerprint: it changes whenever the file changes, which invalidates old
+    thumbnails, but survives renames and moves. Images with a content hash
+    (see dedupe.py) are keyed by it instead, so exact duplicates share their
+    thumbnails. Takes a database row or an image dict from the scanner.
+    """
+    content_hash = image['content_hash'] if 'content_hash' in image.keys() else None
+    return key_for_fingerprint(image['filepath'], (image['mtime_ns'], image['filesize'], image['inode']), content_hash)
+
+def key_for_fingerprint(filepath, fingerprint, content_hash=None):
+    """Like fingerprint_key, for a filepath, its (mtime_ns, filesize, inode) fingerprint and content hash."""
+    mtime_ns, filesize, inode = fingerprint
+    if content_hash:
+        source = f"content:{content_hash}"
+    elif mtime_ns is None:
+        # Not fingerprinted yet; fall back to the path until the next scan.
+        source = f"path:{filepath}"
+    else:
+        source = f"{inode}:{filesize}:{mtime_ns}"
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()[:20]
+
+def normalize_size(size):
+    """Returns the smallest generated size that is at least `size`."""
+    for available in THUMBNAIL_SIZES:
+        if size <= available:
+            return available
+    return THUMBNAIL_SIZES[-1]
+
+def rendition_format(size):
+    """Returns the image format renditions of this size are stored in."""
+    return PREVIEW_FORMAT if size == PREVIEW_SIZE else 'JPEG'
+
+def _encode(img, size):
+    buffer = io.BytesIO()
+    if size != PREVIEW_SIZE:
+        img.save(buffer, 'JPEG', quality=JPEG_QUALITY)
+    elif PREVIEW_FORMAT == 'WEBP':
+        img.save(buffer, 'WEBP', quality=PREVIEW_QUALITY, method=4)
+    else:
+        # Progressive, so the viewer shows a coarse image after the first few kilobytes
+        img.save(buffer, 'JPEG', quality=PREVIEW_QUALITY, progressive=True, optimize=True)
+    return buffer.getvalue()
+
+def render_thumbnails(filepath, key, sizes=THUMBNAIL_SIZES):
+    """
+    Renders the given sizes of an image (thumbnail sizes and/or PREVIEW_SIZE)
+    with a single decode and stores them. For JPEGs, draft mode lets the
+    decoder downscale by up to 8x while decoding, so the full-resolution
+    image is never materialized.
+    """
+    store = get_store()
+    largest = max(sizes)
+    with Image.open(filepath) as img:
+        img.draft('RGB', (largest, largest))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        for size in sorted(sizes, reverse=True):
+            # Each smaller size is downscaled from the previous, already small, one.
+            img.thumbnail((size, size))
+            store.put(key, size, _encode(img, size))
+
+def render_placeholder(key, size):
+    """Stores a gray placeholder for images that cannot be read."""
+    get_store().put(key, size, _encode(Image.new('RGB', (size, size), color='gray'), size))
+
+def _check_budget():
+    global _budget_check_pending
+    with _budget_check_lock:
+        _budget_check_pending = False
+    try:
+        evicted = get_store().enforce_budget()
+    except Exception:
+        logger.exception("Error enforcing the thumbnail disk budget")
+        return
+    if evicted:
+        logger.info("Evicted %d least recently used thumbnails to stay within the disk budget.", evicted)
+
+def schedule_budget_check():
+    """Checks the disk budget BUDGET_CHECK_DELAY seconds from now on a background thread, unless a check is already due."""
+    global _budget_check_pending
+    with _budget_check_lock:
+        if _budget_check_pending:
+            return
+        _budget_check_pending = True
+    timer = threading.Timer(BUDGET_CHECK_DELAY, _check_budget)
+    timer.daemon = True
+    timer.start()
+
+def get_thumbnail(image, size=DEFAULT_SIZE):
+    """
+    Returns an image's thumbnail as a path or file-like object (either can be
+    passed to send_file), rendering it now if the store does not have it yet
+    (e.g. background warming has not reached it or it was evicted).
+    """
+    store = get_store()
+    size = normalize_size(size)
+    key = fingerprint_key(image)
+    thumbnail = store.get(key, size)
+    if thumbnail is None:
+        try:
+            with RENDER_SECONDS.time(source='on_demand'):
+                render_thumbnails(image['filepath'], key, (size,))
+        except OSError:  # missing, not an image (UnidentifiedImageError) or truncated
+            render_placeholder(key, size)
+        schedule_budget_check()
+        thumbnail = store.get(key, size)
+    return thumbnail
+
+def get_preview(image):
+    """
+    Returns an image's screen-sized preview as a path or file-like object,
+    rendering it now if needed, or None if the original cannot be read.
+    """
+    store = get_store()
+    key = fingerprint_key(image)
+    preview = store.get(key, PREVIEW_SIZE)
+    if preview is None:
+        try:
+            with RENDER_SECONDS.time(source='on_demand'):
+                render_thumbnails(image['filepath'], key, (PREVIEW_SIZE,))
+        except OSError:  # missing, not an image (UnidentifiedImageError) or truncated
+            return None
+        schedule_budget_check()
+        preview = store.get(key, PREVIEW_SIZE)
+    return preview
+
+def discard_fingerprints(fingerprints):
+    """
+    Drops the thumbnails of removed or changed images, given (filepath,
+    (mtime_ns, filesize, inode, content_hash)) pairs of their old rows.
+    Thumbnails under a content key are shared by exact duplicates, so they
+    are kept while any image still has that content hash.
+    """
+    keys = set()
+    content_keys = {}
+    for filepath, (mtime_ns, filesize, inode, content_hash) in fingerprints:
+        key = key_for_fingerprint(filepath, (mtime_ns, filesize, inode), content_hash)
+        if content_hash:
+            content_keys[content_hash] = key
+        else:
+            keys.add(key)
+    if content_keys:
+        used = database.get_used_content_hashes(content_keys)
+        keys.update(key for content_hash, key in content_keys.items() if content_hash not in used)
+    if keys:
+        get_store().discard(keys)
+
+def rekey_to_content_hashes(images):
+    """
+    Moves the stored thumbnails of images that were just given a content
+    hash from their fingerprint key to the content key, so nothing is
+    rendered again. Takes (filepath, fingerprint, content_hash) triples.
+    """
+    moves = [(key_for_fingerprint(filepath, fingerprint), key_for_fingerprint(filepath, fingerprint, content_hash))
+             for filepath, fingerprint, content_hash in images]
+    if moves:
+        get_store().rename(moves)
+
+def collect_garbage():
+    """
+    Removes thumbnails that no longer belong to any image in the database,
+    e.g. after a folder was removed, then evicts down to the disk budget.
+    """
+    live_keys = {fingerprint_key(image) for image in database.get_thumbnail_sources()}
+    store = get_store()
+    removed = store.collect_garbage(live_keys)
+    evicted = store.enforce_budget()
+    logger.info("Thumbnail cleanup: removed %d orphaned and evicted %d least recently used thumbnails.", removed, evicted)
+
+def _content_key_moves(items):
+    """
+    Returns (key, content key) moves for (filepath, key) pairs whose key is
+    the fingerprint key of an image that has since been given a content
+    hash. Warm jobs are queued with the key an image had when it was
+    scanned, and dedupe.py may record its hash before they run.
+    """
+    items = list(items)
+    fingerprints = database.get_fingerprints_for_paths([filepath for filepath, _ in items])
+    moves = []
+    for filepath, key in items:
+        fingerprint = fingerprints.get(filepath)
+        if fingerprint and fingerprint[3] and key_for_fingerprint(filepath, fingerprint[:3]) == key:
+            moves.append((key, key_for_fingerprint(filepath, fingerprint[:3], fingerprint[3])))
+    return moves
+
+def _rekey_rendered(rendered):
+    """
+    Moves fresh renders to the content key of images hashed while they
+    were rendering; rekey_to_content_hashes only moves what was stored.
+    """
+    moves = _content_key_moves((filepath, key) for filepath, key, _ in rendered)
+    if moves:
+        get_store().rename(moves)
+
+def _warm_chunk(items):
+    """
+    Pool entry point: renders every size for (filepath, key) pairs that are
+    not cached yet. Returns (filepath, key, duration) for each render; the
+    parent process records the durations (metrics in pool processes would
+    be lost) and rekeys the renders (pool processes don't use the database).
+    """
+    store = get_store()
+    sizes = THUMBNAIL_SIZES + (PREVIEW_SIZE,) if WARM_PREVIEWS else THUMBNAIL_SIZES
+    rendered = []
+    for filepath, key in items:
+        if all(store.contains(key, size) for size in sizes):
+            continue
+        start = time.perf_counter()
+        try:
+            render_thumbnails(filepath, key, sizes)
+        except Exception as e:
+            logger.warning("Error rendering thumbnails for %s: %s", filepath, e)
+            continue
+        rendered.append((filepath, key, time.perf_counter() - start))
+    return rendered
+
+def _finish_warm(rendered):
+    for _, _, duration in rendered:
+        RENDER_SECONDS.observe(duration, source='warm')
+    if rendered:
+        _rekey_rendered(rendered)
+        schedule_budget_check()
+
+def _record_warm_durations(future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    _finish_warm(future.result())
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            get_store()  # configure before forking so workers share the settings
+            _executor = ProcessPoolExecutor(max_workers=WARM_WORKERS)
+        return _executor
+
+def warm_thumbnails(images):
+    """
+    Queues thumbnail rendering for image dicts or rows in the background
+    process pool, or as jobs for a thumbnail worker when WARM_VIA_QUEUE is
+    set, and returns immediately.
+    """
+    items = [(image['filepath'], fingerprint_key(image)) for image in images]
+    if WARM_VIA_QUEUE:
+        for start in range(0, len(items), WARM_CHUNK_SIZE):
+            jobs.enqueue('thumbnails', {'items': items[start:start + WARM_CHUNK_SIZE]}, priority=jobs.PRIORITY_THUMBNAILS)
+        return
+    executor = _get_executor()
+    for start in range(0, len(items), WARM_CHUNK_SIZE):
+        executor.submit(_warm_chunk, items[start:start + WARM_CHUNK_SIZE]).add_done_callback(_record_warm_durations)
+
+def warm_now(items):
+    """Renders the missing thumbnails of (filepath, key) pairs in this process, as a thumbnail job does."""
+    items = list(items)
+    current_keys = dict(_content_key_moves(items))
+    _finish_warm(_warm_chunk([(filepath, current_keys.get(key, key)) for filepath, key in items]))
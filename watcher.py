@@ -0,0 +1,393 @@
+import abc
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import database
+import scanner
+
+logger = logging.getLogger(__name__)
+
+# Seconds without new events before a batch of changes is applied.
+DEFAULT_DEBOUNCE = 2.0
+
+# A batch is applied once it holds this many paths, even if events keep coming.
+MAX_BATCH_SIZE = 5000
+
+# Seconds between directory checks for the polling watcher.
+DEFAULT_POLL_INTERVAL = 30.0
+
+# Seconds between the polling watcher's stat sweeps of every known file,
+# which catch files edited in place (that leaves directory mtimes alone).
+# None disables them: a sweep costs one stat per file, which is slow on
+# network mounts, and in-place edits are then left to the next full scan.
+DEFAULT_SWEEP_INTERVAL = None
+
+# Files compared with their stored fingerprints per database query in a sweep.
+SWEEP_CHUNK_SIZE = 500
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class BaseWatcher(abc.ABC, threading.Thread):
+    """
+    Collects filesystem events for the library directories and applies them
+    in debounced batches through scanner.apply_changes. Subclasses feed events
+    in via queue_update/queue_delete/queue_move from wait_for_events.
+    """
+
+    def __init__(self, dir_list, debounce=DEFAULT_DEBOUNCE, workers=1):
+        super().__init__(daemon=True)
+        self.dir_list = scanner._top_level_dirs(dir_list)
+        self.debounce = debounce
+        self.workers = workers
+        self._stop_event = threading.Event()
+        self._updated = set()
+        self._deleted = set()
+        self._moved = []
+        self._last_event = None
+
+    def queue_update(self, path):
+        self._deleted.discard(path)
+        self._updated.add(path)
+        self._last_event = time.monotonic()
+
+    def queue_delete(self, path):
+        self._updated.discard(path)
+        self._deleted.add(path)
+        self._last_event = time.monotonic()
+
+    def queue_move(self, old_path, new_path):
+        if old_path in self._updated:
+            # Created and moved within one batch: only the new path matters.
+            self._updated.discard(old_path)
+            self._updated.add(new_path)
+        else:
+            self._moved.append((old_path, new_path))
+        self._deleted.discard(new_path)
+        self._last_event = time.monotonic()
+
+    def pending_count(self):
+        return len(self._updated) + len(self._deleted) + len(self._moved)
+
+    def flush(self):
+        """Applies all queued events to the database."""
+        if not self.pending_count():
+            return
+        updated, deleted, moved = self._updated, self._deleted, self._moved
+        self._updated, self._deleted, self._moved = set(), set(), []
+        self._last_event = None
+        try:
+            scanner.apply_changes(updated, deleted, moved, workers=self.workers)
+        except Exception as e:
+            logger.error("Error applying filesystem changes: %s", e)
+
+    def full_rescan(self):
+        """Falls back to a full scan when events may have been lost."""
+        self._updated, self._deleted, self._moved = set(), set(), []
+        scanner.scan_directories(self.dir_list, workers=self.workers)
+
+    @abc.abstractmethod
+    def wait_for_events(self, timeout):
+        """Waits up to timeout seconds, queueing the events that arrive."""
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        logger.info("Watching %d directories for changes (%s).", len(self.dir_list), type(self).__name__)
+        while not self._stop_event.is_set():
+            self.wait_for_events(self.debounce)
+            if self._last_event is None:
+                continue
+            quiet = time.monotonic() - self._last_event >= self.debounce
+            if quiet or self.pending_count() >= MAX_BATCH_SIZE:
+                self.flush()
+        self.close()
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(BaseWatcher):
+    """Linux watcher built on inotify, with one watch per library directory."""
+
+    def __init__(self, dir_list, debounce=DEFAULT_DEBOUNCE, workers=1):
+        super().__init__(dir_list, debounce, workers)
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._paths = {}
+        self._watches = {}
+        # IN_MOVED_FROM events waiting for their IN_MOVED_TO half, by cookie.
+        self._move_sources = {}
+        for directory in self.dir_list:
+            self._add_tree(directory)
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            logger.warning("Could not watch %s: %s", directory, os.strerror(ctypes.get_errno()))
+            return
+        self._paths[wd] = directory
+        self._watches[directory] = wd
+
+    def _add_tree(self, directory):
+        """Adds watches for a directory and every directory below it."""
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            self._add_watch(current)
+            try:
+                with os.scandir(current) as entries:
+                    stack.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def _rename_tree(self, old_path, new_path):
+        old_prefix = old_path + os.sep
+        for wd, path in list(self._paths.items()):
+            if path == old_path or path.startswith(old_prefix):
+                renamed = new_path + path[len(old_path):]
+                self._paths[wd] = renamed
+                self._watches.pop(path, None)
+                self._watches[renamed] = wd
+
+    def _remove_tree(self, directory):
+        """Stops watching a directory tree that left the library."""
+        prefix = directory + os.sep
+        for wd, path in list(self._paths.items()):
+            if path == directory or path.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                self._forget_watch(wd)
+
+    def _forget_watch(self, wd):
+        path = self._paths.pop(wd, None)
+        if path is not None and self._watches.get(path) == wd:
+            del self._watches[path]
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            yield wd, mask, cookie, name
+
+    def _handle_event(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("inotify queue overflowed; running a full rescan.")
+            self.full_rescan()
+            return
+        if mask & IN_IGNORED:
+            self._forget_watch(wd)
+            return
+        directory = self._paths.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        is_dir = bool(mask & IN_ISDIR)
+
+        if mask & IN_MOVED_FROM:
+            self._move_sources[cookie] = (path, is_dir)
+            self._last_event = time.monotonic()
+        elif mask & IN_MOVED_TO:
+            source = self._move_sources.pop(cookie, None)
+            if source:
+                if is_dir:
+                    self._rename_tree(source[0], path)
+                self.queue_move(source[0], path)
+            else:
+                # Moved in from outside the library.
+                if is_dir:
+                    self._add_tree(path)
+                self.queue_update(path)
+        elif mask & IN_CREATE:
+            if is_dir:
+                # Files copied in before the watch was added are found by walking it.
+                self._add_tree(path)
+                self.queue_update(path)
+        elif mask & IN_CLOSE_WRITE:
+            self.queue_update(path)
+        elif mask & IN_DELETE:
+            self.queue_delete(path)
+
+    def wait_for_events(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if readable:
+            for event in self._read_events():
+                self._handle_event(*event)
+        if self._move_sources and self._last_event is not None and time.monotonic() - self._last_event >= self.debounce:
+            # A move whose destination never showed up left the library.
+            for path, is_dir in self._move_sources.values():
+                if is_dir:
+                    self._remove_tree(path)
+                self.queue_delete(path)
+            self._move_sources.clear()
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(BaseWatcher):
+    """
+    Portable fallback that polls directory modification times. Only
+    directories whose mtime changed are listed again, so a poll costs one
+    stat per directory rather than one per file. Files edited in place
+    without any rename leave their directory's mtime alone; a sweep every
+    sweep_interval seconds, if set, stats every known file to find them.
+    """
+
+    def __init__(self, dir_list, debounce=DEFAULT_DEBOUNCE, workers=1, poll_interval=DEFAULT_POLL_INTERVAL,
+                 sweep_interval=DEFAULT_SWEEP_INTERVAL):
+        super().__init__(dir_list, debounce, workers)
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self._next_poll = 0
+        self._next_sweep = time.monotonic() + sweep_interval if sweep_interval else None
+        # directory -> (mtime_ns, {name: is_dir})
+        self._snapshot = {}
+        for directory in self.dir_list:
+            self._snapshot_tree(directory, queue=False)
+
+    def _list_directory(self, directory):
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+            with os.scandir(directory) as entries:
+                listing = {entry.name: entry.is_dir(follow_symlinks=False) for entry in entries}
+        except OSError:
+            return None
+        return mtime_ns, listing
+
+    def _snapshot_tree(self, directory, queue=True):
+        stack = [directory]
+        while stack:
+            current = stack.pop()
+            result = self._list_directory(current)
+            if result is None:
+                continue
+            self._snapshot[current] = result
+            for name, is_dir in result[1].items():
+                path = os.path.join(current, name)
+                if is_dir:
+                    stack.append(path)
+                elif queue:
+                    self.queue_update(path)
+
+    def _forget_tree(self, directory):
+        prefix = directory + os.sep
+        for path in [p for p in self._snapshot if p == directory or p.startswith(prefix)]:
+            del self._snapshot[path]
+
+    def poll(self):
+        for directory, (mtime_ns, listing) in list(self._snapshot.items()):
+            if directory not in self._snapshot:
+                continue  # removed earlier in this pass
+            try:
+                if os.stat(directory).st_mtime_ns == mtime_ns:
+                    continue
+            except OSError:
+                continue  # reported by its parent's listing
+            result = self._list_directory(directory)
+            if result is None:
+                continue
+            self._snapshot[directory] = result
+            new_listing = result[1]
+            for name in listing.keys() - new_listing.keys():
+                path = os.path.join(directory, name)
+                if listing[name]:
+                    self._forget_tree(path)
+                self.queue_delete(path)
+            for name in new_listing.keys() - listing.keys():
+                path = os.path.join(directory, name)
+                if new_listing[name]:
+                    self._snapshot_tree(path)
+                else:
+                    self.queue_update(path)
+            for name in new_listing.keys() & listing.keys():
+                if not new_listing[name]:
+                    # Cheap to re-check: unchanged fingerprints are skipped.
+                    self.queue_update(os.path.join(directory, name))
+
+    def sweep(self):
+        """Queues the known files whose stat fingerprint no longer matches the database."""
+        paths = [os.path.join(directory, name) for directory, (_, listing) in self._snapshot.items()
+                 for name, is_dir in listing.items() if not is_dir and scanner.is_supported_image(name)]
+        for start in range(0, len(paths), SWEEP_CHUNK_SIZE):
+            chunk = paths[start:start + SWEEP_CHUNK_SIZE]
+            stored = database.get_fingerprints_for_paths(chunk)
+            for path in chunk:
+                fingerprint = stored.get(path)
+                if fingerprint is None or fingerprint[0] is None:
+                    continue  # new files are found by poll, legacy rows by the next full scan
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if scanner.file_fingerprint(stat) != fingerprint[:3]:
+                    self.queue_update(path)
+
+    def wait_for_events(self, timeout):
+        if time.monotonic() >= self._next_poll:
+            self.poll()
+            self._next_poll = time.monotonic() + self.poll_interval
+        if self._next_sweep is not None and time.monotonic() >= self._next_sweep:
+            self.sweep()
+            self._next_sweep = time.monotonic() + self.sweep_interval
+        self._stop_event.wait(timeout)
+
+
+def inotify_available():
+    if not sys.platform.startswith('linux'):
+        return False
+    libc_name = ctypes.util.find_library('c')
+    return bool(libc_name) and hasattr(ctypes.CDLL(libc_name), 'inotify_init1')
+
+
+def start_watcher(dir_list, mode='auto', workers=1, debounce=DEFAULT_DEBOUNCE, poll_interval=DEFAULT_POLL_INTERVAL,
+                  sweep_interval=DEFAULT_SWEEP_INTERVAL):
+    """
+    Starts a watcher thread for the library directories and returns it.
+    mode is 'inotify', 'poll' or 'auto' (inotify where available);
+    sweep_interval only applies to polling.
+    Renames and deletions that happen while nothing is watching are picked up
+    by the next full scan.
+    """
+    if mode == 'inotify' or (mode == 'auto' and inotify_available()):
+        try:
+            watcher = InotifyWatcher(dir_list, debounce, workers)
+        except OSError as e:
+            logger.warning("inotify unavailable (%s); falling back to polling.", e)
+            watcher = PollingWatcher(dir_list, debounce, workers, poll_interval, sweep_interval)
+    else:
+        watcher = PollingWatcher(dir_list, debounce, workers, poll_interval, sweep_interval)
+    watcher.start()
+    return watcher
@@ -0,0 +1,275 @@
+"""
+Standalone worker process for the job queue (jobs.py). Runs scans,
+thumbnail rendering, LLM tagging and the filesystem watcher outside the web
+server, which only queues work when "job_queue" is enabled in config.json.
+
+    python worker.py                          # every kind of job
+    python worker.py --kinds thumbnails       # a dedicated thumbnail renderer
+    python worker.py --kinds scan watch tag --metrics-port 9101
+
+Start as many workers as needed; each claims one job at a time, and jobs
+that belong together (scans, the tagging pass) never run side by side.
+The filesystem watcher is a single long-running watch job: only the
+worker holding it watches, on a thread of its own, and another worker
+takes it over if that one stops. Its batches of changes and scans running
+in other workers take turns under scanner.scan_lock().
+"""
+import argparse
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import database
+import embeddings
+import jobs
+import llm_processor
+import metrics
+import scan_jobs
+import scanner
+import thumbnails
+import watcher
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('scan', 'watch', 'thumbnails', 'tag')
+
+# Seconds between queue checks while there is nothing to do.
+POLL_INTERVAL = 1.0
+
+# Delay before the next tagging pass after a pass found nothing to tag.
+TAG_IDLE_SECONDS = 60
+
+# Seconds between deletions of old finished jobs.
+PRUNE_INTERVAL = 3600
+
+# Seconds between checks of the running watch job for a replacement (new settings).
+WATCH_CHECK_INTERVAL = 5
+
+# Returned by a handler that handed its job back to the queue unfinished.
+RELEASED = object()
+
+JOB_SECONDS = metrics.Histogram('photomanager_job_seconds', 'Duration of queued jobs run by workers.', ['kind', 'result'],
+                                buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600))
+
+
+class JobStatus(scan_jobs.ScanStatus):
+    """
+    Progress of a running job. Every progress update first checks the job's
+    lease, so a scan stops (raising jobs.LeaseLost) as soon as its worker
+    has lost the lease and the job may be running elsewhere.
+    """
+
+    def __init__(self, lease=None):
+        self.lease = lease
+        super().__init__()
+
+    def _check(self):
+        if self.lease is not None:
+            self.lease.check()
+
+    def update(self, **fields):
+        self._check()
+        super().update(**fields)
+
+    def increment(self, **counts):
+        self._check()
+        super().increment(**counts)
+
+    def start_phase(self, name, message=None):
+        self._check()
+        super().start_phase(name, message)
+
+
+def _checked(images, lease):
+    """Yields images until the lease is lost."""
+    for image in images:
+        lease.check()
+        yield image
+
+def request_tagging(delay=0):
+    """Queues a tagging pass, coalescing with one that is already queued."""
+    jobs.enqueue('tag', priority=jobs.PRIORITY_TAG, unique_key='tag', delay=delay)
+
+
+class Worker:
+    """Claims and runs jobs of the given kinds until stopped."""
+
+    def __init__(self, kinds=KINDS, worker_id=None, tagger_workers=llm_processor.WORKERS,
+                 tagger_batch_size=llm_processor.BATCH_SIZE, watch=None):
+        self.kinds = list(kinds)
+        self.worker_id = worker_id or jobs.new_worker_id()
+        self.tagger_workers = tagger_workers
+        self.tagger_batch_size = tagger_batch_size
+        # Payload of the watch job to queue when none is active, from the configuration, or None
+        self.watch = watch
+        self.library_watcher = None
+        self.stop_event = threading.Event()
+        self._tag_executor = None
+        self.handlers = {'scan': self.run_scan, 'watch': self.run_watch,
+                         'thumbnails': self.run_thumbnails, 'tag': self.run_tag}
+
+    def run_scan(self, payload, status, lease):
+        scanner.scan_directories(payload['dirs'], status, payload.get('workers'))
+        request_tagging()
+
+    def run_watch(self, payload, status, lease):
+        """Watches until the job is replaced by a newer watch job or the lease is lost; hands it back if the worker stops."""
+        if not payload.get('mode') or not payload.get('dirs'):
+            status.update(message='Watcher stopped')
+            return None
+        self.start_watcher(payload['dirs'], payload['mode'], payload.get('workers') or 1, payload.get('sweep_interval'))
+        status.update(message='Watching')
+        try:
+            while not self.stop_event.wait(WATCH_CHECK_INTERVAL):
+                lease.check()
+                if jobs.is_superseded(lease.job_id, 'watch'):
+                    return None
+            return RELEASED
+        finally:
+            self.start_watcher(None, None)
+
+    def run_thumbnails(self, payload, status, lease):
+        thumbnails.warm_now([tuple(item) for item in payload['items']])
+
+    def run_tag(self, payload, status, lease):
+        if self._tag_executor is None:
+            self._tag_executor = ThreadPoolExecutor(max_workers=self.tagger_workers)
+        tagged = llm_processor.tag_images(_checked(llm_processor.iter_untagged_images(), lease), self._tag_executor,
+                                          self.tagger_batch_size, max_pending=self.tagger_workers * 2)
+        status.update(progress=tagged, message=f"Tagged {tagged} images")
+        # Keep going while there is work; otherwise check back later
+        request_tagging(0 if tagged else TAG_IDLE_SECONDS)
+
+    def start_watcher(self, dirs, mode, workers=1, sweep_interval=None):
+        """(Re)starts the filesystem watcher in this process; a falsy mode or no dirs just stops it."""
+        if self.library_watcher:
+            self.library_watcher.stop()
+            self.library_watcher = None
+        if mode and dirs:
+            self.library_watcher = watcher.start_watcher(dirs, mode=mode, workers=workers, sweep_interval=sweep_interval)
+
+    def run_once(self, kinds=None):
+        """Claims and runs one job (of the given kinds, by default the worker's). Returns False if none was due."""
+        job = jobs.claim(self.worker_id, kinds or self.kinds)
+        if job is None:
+            return False
+        status = JobStatus()
+        status.reset(job['id'])
+        lease = jobs.Heartbeat(job['id'], self.worker_id, status.snapshot)
+        status.lease = lease
+        logger.info("Running %s job %d (attempt %d of %d)", job['kind'], job['id'], job['attempts'], job['max_attempts'])
+        start = time.perf_counter()
+        try:
+            with lease:
+                result = self.handlers[job['kind']](job['payload'], status, lease)
+            lease.check()
+            if result is RELEASED:
+                jobs.release(job['id'], self.worker_id)
+                JOB_SECONDS.observe(time.perf_counter() - start, kind=job['kind'], result='released')
+                return True
+        except Exception as e:
+            if lease.lost.is_set():
+                self._abandon(job, start)
+                return True
+            logger.exception("%s job %d failed", job['kind'], job['id'])
+            status.lease = None
+            status.add_error(str(e))
+            status.update(is_scanning=False, message=str(e))
+            retry = jobs.fail(job['id'], self.worker_id, str(e), status.snapshot())
+            JOB_SECONDS.observe(time.perf_counter() - start, kind=job['kind'], result='retry' if retry else 'failed')
+        else:
+            if not jobs.complete(job['id'], self.worker_id, status.snapshot()):
+                self._abandon(job, start)
+                return True
+            JOB_SECONDS.observe(time.perf_counter() - start, kind=job['kind'], result='done')
+        return True
+
+    def _abandon(self, job, start):
+        # The job went back to the queue (or to another worker); record nothing for it
+        logger.warning("Abandoned %s job %d after losing its lease", job['kind'], job['id'])
+        JOB_SECONDS.observe(time.perf_counter() - start, kind=job['kind'], result='lost')
+
+    def _watch_loop(self):
+        # Claims the watch job whenever it is free; run_watch blocks while watching
+        try:
+            while not self.stop_event.is_set():
+                if not self.run_once(['watch']):
+                    self.stop_event.wait(POLL_INTERVAL)
+        finally:
+            database.release_db_connection()
+
+    def run(self, stop_event=None):
+        """Runs jobs until stop_event is set (or forever)."""
+        if stop_event is not None:
+            self.stop_event = stop_event
+        stop_event = self.stop_event
+        logger.info("Worker %s handling %s", self.worker_id, ', '.join(self.kinds))
+        if 'tag' in self.kinds:
+            if embeddings.ENABLED:
+                added = embeddings.backfill()
+                if added:
+                    logger.info("Embedded %d images tagged before semantic search was enabled.", added)
+            request_tagging()
+        watch_thread = None
+        if 'watch' in self.kinds:
+            if self.watch:
+                jobs.request_watch(self.watch['dirs'], self.watch['mode'], self.watch['workers'], replace=False,
+                                   sweep_interval=self.watch.get('sweep_interval'))
+            watch_thread = threading.Thread(target=self._watch_loop, daemon=True)
+            watch_thread.start()
+        kinds = [kind for kind in self.kinds if kind != 'watch']
+        last_prune = 0
+        try:
+            while not stop_event.is_set():
+                if time.monotonic() - last_prune > PRUNE_INTERVAL:
+                    jobs.prune()
+                    last_prune = time.monotonic()
+                if not kinds or not self.run_once(kinds):
+                    stop_event.wait(POLL_INTERVAL)
+        finally:
+            stop_event.set()
+            if watch_thread is not None:
+                watch_thread.join()
+            if self._tag_executor is not None:
+                self._tag_executor.shutdown()
+            database.release_db_connection()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(port):
+    """Serves this process's metrics for Prometheus on a background thread."""
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs queued photo manager jobs.')
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS), help='job kinds to handle (default: all)')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # Shares config.json (directories, database, thumbnail store) with the web server
+    import app
+    app.load_config()
+    database.create_table()
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    watch = {'dirs': app.IMAGE_DIRS, 'mode': app.WATCH_MODE, 'workers': app.SCAN_WORKERS or 1,
+             'sweep_interval': app.poll_sweep_interval()} if app.WATCH_MODE else None
+    Worker(args.kinds, tagger_workers=app.TAGGER_WORKERS, tagger_batch_size=app.TAGGER_BATCH_SIZE, watch=watch).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""
+WSGI entry point for production servers, e.g.
+
+    gunicorn --workers 4 wsgi:app
+
+Every server process loads config.json and brings the database schema up
+to date on import. Background work is not started here: with "job_queue"
+enabled it runs in worker.py processes; without it, scans requested from
+the settings page run inside the web process that received the request
+and new images are only tagged by `python worker.py --kinds tag`.
+"""
+import logging
+import app as photo_app
+
+logger = logging.getLogger(__name__)
+
+photo_app.initial_setup()
+if not photo_app.JOB_QUEUE:
+    logger.warning('"job_queue" is disabled: scans run inside web server processes and only '
+                   'worker.py tags new images. Enable it and run worker.py when serving with several processes.')
+
+app = photo_app.app